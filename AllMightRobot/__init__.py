@@ -19,10 +19,12 @@
 import asyncio
 import logging
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.contrib.fsm_storage.redis import RedisStorage2
 from AllMightRobot.config import get_str_key, get_int_key, get_list_key, get_bool_key
 from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.outbound import ScheduledBot
+from AllMightRobot.utils.startup import STARTUP
 from AllMightRobot.versions import AllMight_VERSION
 
 log.info("----------------------")
@@ -45,17 +47,28 @@ OPERATORS.append(483808054)
 OPERATORS.append(DEVS)
 
 # AIOGram
-bot = Bot(token=TOKEN, parse_mode=types.ParseMode.HTML)
+# Every request goes through the outbound scheduler, see utils/outbound.py
+bot = ScheduledBot(token=TOKEN, parse_mode=types.ParseMode.HTML)
 storage = RedisStorage2(
     host=get_str_key("REDIS_URI"),
     port=get_int_key("REDIS_PORT"),
     db=get_int_key("REDIS_DB_FSM")
 )
 dp = Dispatcher(bot, storage=storage)
+# Telegram doesn't send chat_member updates by default, admins cache relies on them
+ALLOWED_UPDATES = types.AllowedUpdates.all()
 
 loop = asyncio.get_event_loop()
 
-log.debug("Getting bot info...")
-bot_info = loop.run_until_complete(bot.get_me())
+# Services don't depend on each other, so connect to all of them at once
+from AllMightRobot.services.mongo import connect_mongo  # noqa: E402
+from AllMightRobot.services.redis import connect_redis  # noqa: E402
+from AllMightRobot.services.telethon import connect_telethon  # noqa: E402
+
+log.debug("Getting bot info and connecting to services...")
+with STARTUP.phase('connections'):
+    bot_info, *_ = loop.run_until_complete(asyncio.gather(
+        bot.get_me(), connect_mongo(), connect_redis(), connect_telethon()
+    ))
 BOT_USERNAME = bot_info.username
 BOT_ID = bot_info.id
@@ -22,10 +22,16 @@ from importlib import import_module
 from aiogram import executor
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 
-from AllMightRobot import dp
+from AllMightRobot import ALLOWED_UPDATES, dp
 from AllMightRobot.config import get_bool_key, get_list_key
 from AllMightRobot.modules import ALL_MODULES, LOADED_MODULES, MOD_HELP
+from AllMightRobot.services.http import close_session
+from AllMightRobot.services.mongo import db
+from AllMightRobot.utils.db_structure_migrator import run_migrations
+from AllMightRobot.utils.indexes import collect_indexes, ensure_indexes
 from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.startup import STARTUP
+from AllMightRobot.utils.updates_stream import ROLE, is_leader, start_ingest, start_worker
 
 
 if get_bool_key("DEBUG_MODE"):
@@ -35,7 +41,9 @@ if get_bool_key("DEBUG_MODE"):
 LOAD = get_list_key("LOAD")
 DONT_LOAD = get_list_key("DONT_LOAD")
 
-if get_bool_key('LOAD_MODULES'):
+if ROLE == 'ingest':
+    log.info("Ingest role: updates will be pushed to the stream, not importing modules")
+elif get_bool_key('LOAD_MODULES'):
     if len(LOAD) > 0:
         modules = LOAD
     else:
@@ -49,7 +57,8 @@ if get_bool_key('LOAD_MODULES'):
         if module_name == 'pm_menu':
             continue
         log.debug(f"Importing <d><n>{module_name}</></>")
-        imported_module = import_module("AllMightRobot.modules." + module_name)
+        with STARTUP.phase('import ' + module_name):
+            imported_module = import_module("AllMightRobot.modules." + module_name)
         if hasattr(imported_module, '__help__'):
             if hasattr(imported_module, '__mod_name__'):
                 MOD_HELP[imported_module.__mod_name__] = imported_module.__help__
@@ -62,7 +71,8 @@ else:
 
 loop = asyncio.get_event_loop()
 
-import_module("AllMightRobot.modules.pm_menu")
+if ROLE != 'ingest':
+    import_module("AllMightRobot.modules.pm_menu")
 # Import misc stuff
 
 import_module("AllMightRobot.utils.exit_gracefully")
@@ -71,24 +81,57 @@ if not get_bool_key('DEBUG_MODE'):
 
 
 async def before_srv_task(loop):
-    for module in [m for m in LOADED_MODULES if hasattr(m, '__before_serving__')]:
+    modules = [m for m in LOADED_MODULES if hasattr(m, '__before_serving__')]
+    for module in modules:
         log.debug('Before serving: ' + module.__name__)
-        loop.create_task(module.__before_serving__(loop))
+    # Long-running jobs are started as separate tasks by modules, so these are quick
+    await asyncio.gather(*[module.__before_serving__(loop) for module in modules])
 
 
-import_module("AllMightRobot.utils.db_structure_migrator")
+async def after_srv_task(loop):
+    for module in [m for m in LOADED_MODULES if hasattr(m, '__after_serving__')]:
+        log.debug('After serving: ' + module.__name__)
+        await module.__after_serving__(loop)
+
+
+with STARTUP.phase('db structure migrator'):
+    loop.run_until_complete(run_migrations())
 
 
 async def start(_):
-    log.debug("Starting before serving task for all modules...")
-    loop.create_task(before_srv_task(loop))
+    log.debug("Running before serving task for all modules...")
+    # Awaited instead of fixed sleep, so middlewares are set before first updates and nothing more
+    with STARTUP.phase('before serving'):
+        await before_srv_task(loop)
+
+    # Indexes are created in background, other processes only load them to report unindexed queries
+    asyncio.ensure_future(ensure_indexes(db, collect_indexes(LOADED_MODULES), create=is_leader()))
+
+    STARTUP.report()
 
-    if not get_bool_key("DEBUG_MODE"):
-        log.debug("Waiting 2 seconds...")
-        await asyncio.sleep(2)
+
+async def stop(_):
+    log.debug("Running after serving task for all modules...")
+    await after_srv_task(loop)
+    await close_session()
 
 
 log.info("Starting loop..")
-log.info("Aiogram: Using polling method")
 
-executor.start_polling(dp, loop=loop, on_startup=start)
+if ROLE == 'worker':
+    log.info("Aiogram: Consuming updates stream")
+    start_worker(dp, loop, on_startup=start, on_shutdown=stop)
+elif get_bool_key('WEBHOOK'):
+    from AllMightRobot.utils.webhook import start_webhook
+
+    if ROLE == 'ingest':
+        log.info("Aiogram: Pushing webhook updates into the stream")
+    else:
+        log.info("Aiogram: Using webhook method")
+    start_webhook(dp, loop, on_startup=start, on_shutdown=stop, ingest=ROLE == 'ingest')
+elif ROLE == 'ingest':
+    log.info("Aiogram: Polling updates into the stream")
+    start_ingest(dp, loop, allowed_updates=ALLOWED_UPDATES, on_startup=start, on_shutdown=stop)
+else:
+    log.info("Aiogram: Using polling method")
+    executor.start_polling(dp, loop=loop, on_startup=start, on_shutdown=stop, allowed_updates=ALLOWED_UPDATES)
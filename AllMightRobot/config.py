@@ -31,13 +31,24 @@ DEFAULTS = {
     'REDIS_HOST': 'localhost',
     'REDIS_PORT': 6379,
     'REDIS_DB_FSM': 1,
+    'REDIS_MAX_CONNECTIONS': 64,
+    'REDIS_POOL_TIMEOUT': 20,
 
     'MONGODB_URI': 'localhost',
     'MONGO_DB': 'AllMight',
 
     'API_PORT': 8080,
+    'WEBHOOK': False,
+    'WEBHOOK_HOST': '0.0.0.0',
+    'WEBHOOK_MAX_CONCURRENCY': 100,
+
+    'ROLE': 'single',
+    'STREAM_PARTITIONS': 16,
+    'STREAM_WORKERS': 1,
 
     'JOIN_CONFIRM_DURATION': '30m',
+
+    'DB_MIGRATIONS_DELAY': 20,
 }
 
 CONFIG_PATH = 'data/bot_conf.yaml'
@@ -16,6 +16,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.db_structure_migrator import Migration
 
-log.warn('Blank DB update, nothing to-do, skipping!')
+
+class BlankMigration(Migration):
+    description = 'Blank DB update, nothing to-do, skipping!'
+
+
+migration = BlankMigration()
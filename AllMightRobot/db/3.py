@@ -16,28 +16,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from AllMightRobot.services.mongo import mongodb
-from AllMightRobot.utils.logger import log
-
-log.info('AllMight Database v3')
-log.info('Support notes aliases')
-log.info('Starting updating all notes...')
-
-all_notes = mongodb.notes_v2.find({})
-all_notes_count = all_notes.count()
-counter = 0
-changed_notes = 0
-for note in all_notes:
-    counter += 1
-    log.info(f'Updating {counter} of {all_notes_count}...')
-
-    if 'name' in note:
-        changed_notes += 1
-        names = [note['name']]
-        del note['name']
-        note['names'] = names
-        mongodb.notes_v2.replace_one({'_id': note['_id']}, note)
-
-log.info('Update done!')
-log.info('Modified notes - ' + str(changed_notes))
-log.info('Unchanged notes - ' + str(all_notes_count - changed_notes))
+from pymongo import UpdateOne
+
+from AllMightRobot.utils.db_structure_migrator import Migration
+
+
+class NotesAliases(Migration):
+    description = 'Support notes aliases'
+    collection = 'notes_v2'
+    query = {'name': {'$exists': True}}
+
+    def ops(self, note):
+        yield 'notes_v2', UpdateOne(
+            {'_id': note['_id']},
+            {'$set': {'names': [note['name']]}, '$unset': {'name': 1}}
+        )
+
+
+migration = NotesAliases()
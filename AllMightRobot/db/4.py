@@ -16,27 +16,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from AllMightRobot.services.mongo import mongodb
-from AllMightRobot.utils.logger import log
-
-log.info('AllMight Database v4')
-log.info("Filters: move 'note' to 'note_name'")
-log.info('Starting updating all filters...')
-
-all_filters = mongodb.filters.find({})
-all_filters_count = all_filters.count()
-counter = 0
-changed_filters = 0
-for item in all_filters:
-    counter += 1
-    log.info(f'Updating {counter} of {all_filters_count}...')
-
-    if 'note' in item:
-        changed_filters += 1
-        item['note_name'] = item['note']
-        del item['note']
-        mongodb.notes_v2.replace_one({'_id': item['_id']}, item)
-
-log.info('Update done!')
-log.info('Modified filters - ' + str(changed_filters))
-log.info('Unchanged filters - ' + str(all_filters_count - changed_filters))
+from pymongo import UpdateOne
+
+from AllMightRobot.utils.db_structure_migrator import Migration
+
+
+class FiltersNoteName(Migration):
+    description = "Filters: move 'note' to 'note_name'"
+    collection = 'filters'
+    query = {'note': {'$exists': True}}
+
+    def ops(self, item):
+        yield 'filters', UpdateOne({'_id': item['_id']}, {'$rename': {'note': 'note_name'}})
+
+
+migration = FiltersNoteName()
@@ -16,50 +16,37 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from pymongo import InsertOne
+from pymongo import UpdateOne
 
-from AllMightRobot.services.mongo import mongodb
-from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.db_structure_migrator import Migration
 
-log.info('AllMight Database v5')
-log.info("Feds: migrate to old feds database structure")
-log.info('Starting updating all feds...')
 
-all_feds = mongodb.feds.find({})
-all_feds_count = all_feds.count()
-counter = 0
-changed_feds = 0
-for fed in all_feds:
-    counter += 1
-    log.info(f'Updating {counter} of {all_feds_count}...')
+class FedBansCollection(Migration):
+    description = 'Feds: migrate to old feds database structure'
+    collection = 'feds'
+    query = {'banned': {'$exists': True}}
+    # Every fed yields all its bans
+    batch_size = 10
 
-    queue = []
-    if 'banned' not in fed:
-        continue
+    def ops(self, fed):
+        for user_id, ban in fed['banned'].items():
+            new = {
+                'fed_id': fed['fed_id'],
+                'user_id': user_id,
+                'by': ban['by'],
+                'time': ban['time']
+            }
 
-    for item in fed['banned'].items():
-        user_id = item[0]
-        ban = item[1]
-        new = {
-            'fed_id': fed['fed_id'],
-            'user_id': user_id,
-            'by': ban['by'],
-            'time': ban['time']
-        }
+            if 'reason' in ban:
+                new['reason'] = ban['reason']
 
-        if 'reason' in ban:
-            new['reason'] = ban['reason']
+            if 'banned_chats' in ban:
+                new['banned_chats'] = ban['banned_chats']
 
-        if 'banned_chats' in ban:
-            new['banned_chats'] = ban['banned_chats']
+            # Upsert, so repeating of interrupted batch doesn't duplicate bans
+            yield 'fed_bans', UpdateOne({'fed_id': fed['fed_id'], 'user_id': user_id}, {'$set': new}, upsert=True)
 
-        queue.append(InsertOne(new))
+        yield 'feds', UpdateOne({'_id': fed['_id']}, {'$unset': {'banned': 1}})
 
-    mongodb.fed_bans.bulk_write(queue)
-    mongodb.feds.update_one({'fed_id': fed['fed_id']}, {'$unset': {'banned': 1}})
-    changed_feds += 1
 
-
-log.info('Update done!')
-log.info('Modified feds - ' + str(changed_feds))
-log.info('Unchanged feds - ' + str(all_feds_count - changed_feds))
+migration = FedBansCollection()
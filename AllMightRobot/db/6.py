@@ -16,28 +16,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from AllMightRobot.services.mongo import mongodb
-from AllMightRobot.utils.logger import log
-
 from pymongo import DeleteOne
 
-log.info('AllMight Database v6')
-log.info("Feds: fix str user_id and fix duplications")
-log.info('Starting updating all feds...')
+from AllMightRobot.utils.db_structure_migrator import Migration
 
-queue = []
 
-all_bans = mongodb.fed_bans.find({'user_id': {'$type': 'string'}})
-all_bans_count = all_bans.count()
-counter = 0
-changed_feds = 0
+class FedBansStrUserId(Migration):
+    description = 'Feds: fix str user_id and fix duplications'
+    collection = 'fed_bans'
+    query = {'user_id': {'$type': 'string'}}
 
-for ban in all_bans:
-    counter += 1
-    changed_feds += 1
-    queue.append(DeleteOne({'_id': ban['_id']}))
+    def ops(self, ban):
+        yield 'fed_bans', DeleteOne({'_id': ban['_id']})
 
-mongodb.fed_bans.bulk_write(queue)
 
-log.info('Update done!')
-log.info('Modified feds - ' + str(changed_feds))
+migration = FedBansStrUserId()
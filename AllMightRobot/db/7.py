@@ -17,29 +17,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from AllMightRobot.services.mongo import mongodb
-from AllMightRobot.utils.logger import log
-
 from pymongo import UpdateOne
 
-log.info('AllMight Database v6')
-log.info("Filters: migrate 'reply_message'")
-log.info('Starting to updating all filters...')
-
-all_filters = mongodb.filters.find({'action': 'reply_message'})
-count = all_filters.count()
-changed = 0
-updated_list = []
-
-for i in all_filters:
-    if not isinstance(i['reply_text'], dict):
-        changed += 1
-        log.info(f'Updated {changed} filters of {count}')
-        updated_list.append(UpdateOne(
-            {'_id': i['_id']},
-            {'$set': {'reply_text': {'parse_mode': 'md', 'text': i['reply_text']}}}
-        ))
-
-log.info('Updating Database ...')
-if updated_list:
-    mongodb.filters.bulk_write(updated_list)
+from AllMightRobot.utils.db_structure_migrator import Migration
+
+
+class FiltersReplyMessage(Migration):
+    description = "Filters: migrate 'reply_message'"
+    collection = 'filters'
+    query = {'action': 'reply_message'}
+
+    def ops(self, item):
+        if not isinstance(item['reply_text'], dict):
+            yield 'filters', UpdateOne(
+                {'_id': item['_id']},
+                {'$set': {'reply_text': {'parse_mode': 'md', 'text': item['reply_text']}}}
+            )
+
+
+migration = FiltersReplyMessage()
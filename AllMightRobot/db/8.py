@@ -17,28 +17,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from datetime import timedelta
+
 from pymongo import UpdateOne
 
-from AllMightRobot.services.mongo import mongodb
+from AllMightRobot.utils.db_structure_migrator import Migration
 from AllMightRobot.utils.logger import log
 
-changelog = \
-    """
-    AllMight database v8
-    Warns: Change serialization method of warnmodes (time based)
-    """
-log.info(changelog)
-log.info("Fetching all documents needed to update (in 'warnmode' collection)!")
-
-data = mongodb['warnmode'].find({'time': {"$exists": True}})
-count = data.count()
-changed, deleted = 0, 0
-updated_list = []
-
 
 def _convert_time(__t: dict) -> str:
-    from datetime import timedelta
-
     sec = timedelta(**__t).total_seconds()
     # this works on basis that days, hours, minutes are whole numbers!
     # check days first
@@ -54,17 +41,14 @@ def _convert_time(__t: dict) -> str:
         log.warning(f"Found unexpected value {sec}...!")
 
 
-for i in data:
-    time = i['time']
-    if new_t := _convert_time(time):
-        updated_list.append(UpdateOne({"_id": i['_id']}, {"$set": {'time': new_t}}))
-        changed += 1
-    else:
-        # deleted += 1
-        # updated_list.append(DeleteOne({'_id': i['_id']}))
-        pass
+class WarnmodeTime(Migration):
+    description = 'Warns: Change serialization method of warnmodes (time based)'
+    collection = 'warnmode'
+    query = {'time': {'$type': 'object'}}
+
+    def ops(self, item):
+        if new_t := _convert_time(item['time']):
+            yield 'warnmode', UpdateOne({'_id': item['_id']}, {'$set': {'time': new_t}})
+
 
-if updated_list:
-    log.info("Updating database...")
-    mongodb['warnmode'].bulk_write(updated_list, ordered=False)
-    log.info(f"Updated {changed} documents!")
+migration = WarnmodeTime()
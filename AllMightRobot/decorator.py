@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import time
 from importlib import import_module
 
@@ -27,6 +28,8 @@ from AllMightRobot import BOT_USERNAME, dp
 from AllMightRobot.config import get_bool_key
 from AllMightRobot.utils.filters import ALL_FILTERS
 from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.outbound import Priority, outbound_priority
+from AllMightRobot.utils.update_context import UpdateContextMiddleware
 from AllMightRobot.modules.error import parse_update
 
 DEBUG_MODE = get_bool_key('DEBUG_MODE')
@@ -37,6 +40,9 @@ CMD_NOT_MONO = get_bool_key("DISALLOW_MONO_CMDS")
 REGISTRED_COMMANDS = []
 COMMANDS_ALIASES = {}
 
+# Lookups of chat, language, admins and connection are done once per update
+dp.middleware.setup(UpdateContextMiddleware())
+
 # Import filters
 log.info("Filters to load: %s", str(ALL_FILTERS))
 for module_name in ALL_FILTERS:
@@ -101,8 +107,12 @@ def register(*args, cmds=None, f=None, allow_edited=True, allow_kwargs=False, **
     register_kwargs.update(kwargs)
 
     def decorator(func):
+        # Modules can lower or raise priority of their replies with __outbound_priority__
+        priority = getattr(sys.modules.get(func.__module__), '__outbound_priority__', Priority.NORMAL)
+
         async def new_func(*def_args, **def_kwargs):
             message = def_args[0]
+            outbound_priority.set(priority)
 
             if cmds:
                 message.conf['cmds'] = cmds
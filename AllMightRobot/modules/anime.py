@@ -13,20 +13,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import requests
-import jikanpy
 import html
-import bs4
+import time
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from AllMightRobot.decorator import register
 from .utils.anime import (
-    shorten, t, airing_query, manga_query,
-    character_query, anime_query
+    shorten, t, anilist_lookup
 )
 from .utils.disable import disableable_dec
+from ..services.http import get_session
+from ..utils.outbound import Priority
 
-url = 'https://graphql.anilist.co'
+__outbound_priority__ = Priority.FUN
 
 
 @register(cmds='airing')
@@ -37,12 +36,13 @@ async def anime_airing(message):
         await message.reply('Provide anime name!')
         return
 
-    variables = {'search': search_str[1]}
-    response = requests.post(
-        url, json={'query': airing_query, 'variables': variables}).json()['data']['Media']
+    if not (response := await anilist_lookup('airing', search_str[1])):
+        await message.reply('Anime not found!')
+        return
     ms_g = f"<b>Name</b>: <b>{response['title']['romaji']}</b>(<code>{response['title']['native']}</code>)\n<b>ID</b>: <code>{response['id']}</code>"
     if response['nextAiringEpisode']:
-        airing_time = response['nextAiringEpisode']['timeUntilAiring'] * 1000
+        # Cached response could be fetched a while ago, so countdown is counted from airing time
+        airing_time = max(response['nextAiringEpisode']['airingAt'] - time.time(), 0) * 1000
         airing_time_final = t(airing_time)
         ms_g += f"\n<b>Episode</b>: <code>{response['nextAiringEpisode']['episode']}</code>\n<b>Airing In</b>: <code>{airing_time_final}</code>"
     else:
@@ -59,9 +59,7 @@ async def anime_search(message):
         return
     else:
         search = search[1]
-    variables = {'search': search}
-    json = requests.post(url, json={'query': anime_query, 'variables': variables}).json()[
-        'data'].get('Media', None)
+    json = await anilist_lookup('anime', search)
     if json:
         msg = f"<b>{json['title']['romaji']}</b>(<code>{json['title']['native']}</code>)\n<b>Type</b>: {json['format']}\n<b>Status</b>: {json['status']}\n<b>Episodes</b>: {json.get('episodes', 'N/A')}\n<b>Duration</b>: {json.get('duration', 'N/A')} Per Ep.\n<b>Score</b>: {json['averageScore']}\n<b>Genres</b>: <code>"
         for x in json['genres']:
@@ -107,9 +105,7 @@ async def character_search(message):
         await message.reply('Provide character name!')
         return
     search = search[1]
-    variables = {'query': search}
-    json = requests.post(url, json={'query': character_query, 'variables': variables}).json()[
-        'data'].get('Character', None)
+    json = await anilist_lookup('character', search)
     if json:
         ms_g = f"<b>{json.get('name').get('full')}</b>(<code>{json.get('name').get('native')}</code>)\n"
         description = (f"{json['description']}").replace('__', '')
@@ -131,9 +127,7 @@ async def manga_search(message):
         await message.reply('Provide manga name!')
         return
     search = search[1]
-    variables = {'search': search}
-    json = requests.post(url, json={'query': manga_query, 'variables': variables}).json()[
-        'data'].get('Media', None)
+    json = await anilist_lookup('manga', search)
     ms_g = ''
     if json:
         title, title_native = json['title'].get(
@@ -171,6 +165,9 @@ async def manga_search(message):
 @register(cmds='upcoming')
 @disableable_dec('upcoming')
 async def upcoming(message):
+    # Heavy optional dependencies are imported on first use to speed up startup
+    import jikanpy
+
     jikan = jikanpy.jikan.Jikan()
     upcoming = jikan.top('anime', page=1, subtype="upcoming")
 
@@ -186,6 +183,8 @@ async def upcoming(message):
 
 
 async def site_search(message, site: str):
+    import bs4
+
     args = message.text.split(' ', 1)
     more_results = True
 
@@ -197,7 +196,8 @@ async def site_search(message, site: str):
 
     if site == "kaizoku":
         search_url = f"https://animekaizoku.com/?s={search_query}"
-        html_text = requests.get(search_url).text
+        async with get_session().get(search_url) as response:
+            html_text = await response.text()
         soup = bs4.BeautifulSoup(html_text, "html.parser")
         search_result = soup.find_all("h2", {'class': "post-title"})
 
@@ -213,7 +213,8 @@ async def site_search(message, site: str):
 
     elif site == "kayo":
         search_url = f"https://animekayo.com/?s={search_query}"
-        html_text = requests.get(search_url).text
+        async with get_session().get(search_url) as response:
+            html_text = await response.text()
         soup = bs4.BeautifulSoup(html_text, "html.parser")
         search_result = soup.find_all("h2", {'class': "title"})
 
@@ -16,9 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle
-from dataclasses import dataclass
-from typing import Optional
+import time
 
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher.handler import CancelHandler
@@ -39,42 +37,76 @@ from AllMightRobot.modules.utils.restrictions import ban_user, kick_user, mute_u
 from AllMightRobot.modules.utils.user_details import is_user_admin, get_user_link
 from AllMightRobot.services.mongo import db
 from AllMightRobot.services.redis import bredis, redis
-from AllMightRobot.utils.cached import cached
+from AllMightRobot.utils.cached import cached, L1Cache, register_l1, ensure_listener, publish_invalidation
 from AllMightRobot.utils.logger import log
 
 cancel_state = CallbackData('cancel_state', 'user_id')
 
+SUPPORTED_MODES = ('consecutive', 'window')
+
+SETTINGS_CACHE_KEY = 'antiflood_settings:{}'
+# chat_id: settings or False for chats without antiflood, changes are broadcasted through cached invalidation channel
+SETTINGS_L1 = register_l1(L1Cache(maxsize=50000, ttl=60 * 60))
+
+# Counts the message and tells whether the limit is exceeded, in one atomic call.
+# KEYS: counter, chat state (last sender); ARGV: user_id, limit, expire (ms, 0 - never), mode, now (ms), message_id
+# Returns messages count when the limit is reached (and resets the counter), 0 otherwise.
+FLOOD_SCRIPT = bredis.register_script("""
+local limit = tonumber(ARGV[2])
+local expire = tonumber(ARGV[3])
+local count
+
+if ARGV[4] == 'window' then
+    local now = tonumber(ARGV[5])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - expire)
+    redis.call('ZADD', KEYS[1], now, ARGV[6])
+    count = redis.call('ZCARD', KEYS[1])
+    redis.call('PEXPIRE', KEYS[1], expire)
+else
+    if redis.call('GETSET', KEYS[2], ARGV[1]) == ARGV[1] then
+        count = redis.call('INCR', KEYS[1])
+    else
+        count = 1
+        redis.call('SET', KEYS[1], 1)
+    end
+    if expire > 0 then
+        redis.call('PEXPIRE', KEYS[1], expire)
+    else
+        redis.call('PERSIST', KEYS[1])
+    end
+end
+
+if count >= limit then
+    redis.call('DEL', KEYS[1])
+    return count
+end
+return 0
+""")
+
 
 class AntiFloodConfigState(StatesGroup):
     expiration_proc = State()
 
 
-@dataclass
-class CacheModel:
-    count: int
-
-
 class AntifloodEnforcer(BaseMiddleware):
     state_cache_key = "floodstate:{chat_id}"
 
-    async def enforcer(self, message: Message, database: dict):
-        if (not (data := self.get_flood(message))) or int(self.get_state(message)) != message.from_user.id:
-            to_set = CacheModel(count=1)
-            self.insert_flood(to_set, message, database)
-            self.set_state(message)
-            return False  # we aint banning anybody
-
-        # update count
-        data.count += 1
-
-        # check exceeding
-        if data.count >= database['count']:
-            if await self.do_action(message, database):
-                self.reset_flood(message)
-                return True
-
-        self.insert_flood(data, message, database)
-        return False
+    async def enforcer(self, message: Message, database: dict) -> bool:
+        mode = database.get('mode', 'consecutive')
+        expire = convert_time(database['time']) if database.get('time', None) is not None else None
+        exceeded = await FLOOD_SCRIPT(
+            keys=[self.cache_key(message, mode), self.state_cache_key.format(chat_id=message.chat.id)],
+            args=[
+                message.from_user.id,
+                database['count'],
+                int(expire.total_seconds() * 1000) if expire else 0,
+                mode,
+                int(time.time() * 1000),
+                message.message_id
+            ]
+        )
+        # Counter is already reset by script, so concurrent messages can't trigger action twice
+        return bool(exceeded) and await self.do_action(message, database)
 
     @classmethod
     def is_message_valid(cls, message) -> bool:
@@ -87,35 +119,14 @@ class AntifloodEnforcer(BaseMiddleware):
             return False
         return True
 
-    def get_flood(self, message) -> Optional[CacheModel]:
-        if data := bredis.get(self.cache_key(message)):
-            data = pickle.loads(data)
-            return data
-        return None
-
-    def insert_flood(self, data: CacheModel, message: Message, database: dict):
-        ex = convert_time(database['time']) if database.get('time', None) is not None else None
-        return bredis.set(self.cache_key(message), pickle.dumps(data), ex=ex)
-
-    def reset_flood(self, message):
-        return bredis.delete(self.cache_key(message))
-
-    def check_flood(self, message):
-        return bredis.exists(self.cache_key(message))
-
-    def set_state(self, message: Message):
-        return bredis.set(
+    def set_state(self, message: Message, client=bredis):
+        return client.set(
             self.state_cache_key.format(chat_id=message.chat.id), message.from_user.id
         )
 
-    def get_state(self, message: Message):
-        return bredis.get(
-            self.state_cache_key.format(chat_id=message.chat.id)
-        )
-
     @classmethod
-    def cache_key(cls, message: Message):
-        return f"antiflood:{message.chat.id}:{message.from_user.id}"
+    def cache_key(cls, message: Message, mode: str = 'consecutive'):
+        return f"antiflood_{mode}:{message.chat.id}:{message.from_user.id}"
 
     @classmethod
     async def do_action(cls, message: Message, database: dict):
@@ -131,23 +142,29 @@ class AntifloodEnforcer(BaseMiddleware):
             return False
 
     async def on_pre_process_message(self, message: Message, _):
+        if not self.is_message_valid(message):
+            return
+        # Most chats don't have antiflood, they are skipped without Redis or DB round trips
+        if not (database := await get_settings(message.chat.id)):
+            return
+
         log.debug(f"Enforcing flood control on {message.from_user.id} in {message.chat.id}")
-        if self.is_message_valid(message):
-            if await is_user_admin(message.chat.id, message.from_user.id):
-                return self.set_state(message)
-            if (database := await get_data(message.chat.id)) is None:
-                return
-
-            if await self.enforcer(message, database):
-                await message.delete()
-                strings = await get_strings(message.chat.id, 'antiflood')
-                await message.answer(
-                    strings['flood_exceeded'].format(
-                        action=(strings[database['action']] if 'action' in database else 'banned').capitalize(),
-                        user=await get_user_link(message.from_user.id)
-                    )
+        if await is_user_admin(message.chat.id, message.from_user.id):
+            # Admin message breaks consecutive messages of others
+            if database.get('mode', 'consecutive') == 'consecutive':
+                await self.set_state(message)
+            return
+
+        if await self.enforcer(message, database):
+            await message.delete()
+            strings = await get_strings(message.chat.id, 'antiflood')
+            await message.answer(
+                strings['flood_exceeded'].format(
+                    action=(strings[database['action']] if 'action' in database else 'banned').capitalize(),
+                    user=await get_user_link(message.from_user.id)
                 )
-                raise CancelHandler
+            )
+            raise CancelHandler
 
 
 @register(cmds=["setflood"], user_can_restrict_members=True, bot_can_restrict_members=True)
@@ -163,7 +180,7 @@ async def setflood_command(message: Message, chat: dict, strings: dict):
         return await message.reply(strings['overflowed_count'])
 
     await AntiFloodConfigState.expiration_proc.set()
-    redis.set(f"antiflood_setup:{chat['chat_id']}", args)
+    await redis.set(f"antiflood_setup:{chat['chat_id']}", args)
     await message.reply(
         strings['config_proc_1'],
         reply_markup=InlineKeyboardMarkup().add(
@@ -184,15 +201,19 @@ async def antiflood_expire_proc(message: Message, chat: dict, strings: dict, sta
     except (TypeError, ValueError):
         await message.reply(strings['invalid_time'])
     else:
-        if not (data := redis.get(f'antiflood_setup:{chat["chat_id"]}')):
+        if not (data := await redis.get(f'antiflood_setup:{chat["chat_id"]}')):
             await message.reply(strings['setup_corrupted'])
         else:
+            new_data = {"time": time, "count": int(data)}
+            if time is None:
+                # Sliding window needs the time
+                new_data['mode'] = 'consecutive'
             await db.antiflood.update_one(
                 {"chat_id": chat['chat_id']},
-                {"$set": {"time": time, "count": int(data)}},
+                {"$set": new_data},
                 upsert=True
             )
-            await get_data.reset_cache(chat['chat_id'])
+            await reset_settings(chat['chat_id'])
             kw = {'count': data}
             if time is not None:
                 kw.update({'time': format_timedelta(parsed_time, locale=strings['language_info']['babel'])})
@@ -212,7 +233,7 @@ async def antiflood(message: Message, chat: dict, strings: dict):
 
     if message.get_args().lower() in ('off', '0', 'no'):
         await db.antiflood.delete_one({"chat_id": chat['chat_id']})
-        await get_data.reset_cache(chat['chat_id'])
+        await reset_settings(chat['chat_id'])
         return await message.reply(strings['turned_off'].format(chat_title=chat['chat_title']))
 
     if data['time'] is None:
@@ -223,7 +244,7 @@ async def antiflood(message: Message, chat: dict, strings: dict):
             )
         )
     return await message.reply(
-        strings['configuration_info:with_time'].format(
+        strings['configuration_info:window' if data.get('mode') == 'window' else 'configuration_info:with_time'].format(
             action=strings[data['action']] if 'action' in data else strings['ban'],
             count=data['count'],
             time=format_timedelta(
@@ -247,7 +268,7 @@ async def setfloodaction(message: Message, chat: dict, strings: dict):
         {"$set": {"action": action}},
         upsert=True
     )
-    await get_data.reset_cache(message.chat.id)
+    await reset_settings(chat['chat_id'])
     return await message.reply(
         strings['setfloodaction_success'].format(
             action=action
@@ -255,6 +276,33 @@ async def setfloodaction(message: Message, chat: dict, strings: dict):
     )
 
 
+@register(cmds=['setfloodmode'], user_can_restrict_members=True)
+@need_args_dec()
+@chat_connection(admin=True)
+@get_strings_dec('antiflood')
+async def setfloodmode(message: Message, chat: dict, strings: dict):
+    if (mode := message.get_args().lower()) not in SUPPORTED_MODES:
+        return await message.reply(
+            strings['invalid_args:setfloodmode'].format(supported_modes=", ".join(SUPPORTED_MODES))
+        )
+
+    if not (data := await get_data(chat['chat_id'])):
+        return await message.reply(strings['not_configured'])
+    if mode == 'window' and data.get('time') is None:
+        return await message.reply(strings['window_needs_time'])
+
+    await db.antiflood.update_one(
+        {"chat_id": chat['chat_id']},
+        {"$set": {"mode": mode}}
+    )
+    await reset_settings(chat['chat_id'])
+    return await message.reply(
+        strings['setfloodmode_success'].format(
+            mode=mode
+        )
+    )
+
+
 async def __before_serving__(_):
     dp.middleware.setup(AntifloodEnforcer())
 
@@ -271,6 +319,25 @@ async def get_data(chat_id: int):
     )
 
 
+async def get_settings(chat_id: int):
+    key = SETTINGS_CACHE_KEY.format(chat_id)
+    if (data := SETTINGS_L1.get(key)) is None:
+        ensure_listener()
+        data = await get_data(chat_id) or False
+        SETTINGS_L1.set(key, data)
+    return data
+
+
+async def reset_settings(chat_id: int):
+    key = SETTINGS_CACHE_KEY.format(chat_id)
+    SETTINGS_L1.delete(key)
+    await get_data.reset_cache(chat_id)
+    await publish_invalidation(key)
+
+
+__indexes__ = {'antiflood': [[('chat_id', 1)]]}
+
+
 async def __export__(chat_id: int):
     data = await get_data(chat_id)
     if not data:
@@ -285,6 +352,7 @@ async def __import__(chat_id: int, data: dict):  # noqa
         {"chat_id": chat_id},
         {"$set": data}
     )
+    await reset_settings(chat_id)
 
 
 __mod_name__ = "AntiFlood"
@@ -313,6 +381,11 @@ Me: <code>5m</code> (5 minutes)
 DONE!
 
 - /setfloodaction (action): Sets the action to taken when user exceeds flood limit
+- /setfloodmode (mode): Sets how messages are counted
+
+<b>Currently supported modes:</b>
+--consecutive: messages in a row, not interrupted by other users (default)
+--window: any messages of the user within the expiration time, needs the time to be set
 
 <b>Currently supported actions:</b>
 --ban
@@ -73,7 +73,7 @@ async def connect_to_chat_direct(message, strings):
         await def_connect_chat(message, user_id, chat_id, chat_title)
     except (BotBlocked, CantInitiateConversation):
         await message.reply(strings['connected_pm_to_me'].format(chat_name=chat_title))
-        redis.set('AllMight_connected_start_state:' + str(user_id), 1)
+        await redis.set('AllMight_connected_start_state:' + str(user_id), 1)
 
 
 # In pm without args - show last connected chats
@@ -210,9 +210,9 @@ async def allow_users_to_connect(message, strings, chat):
 @chat_connection()
 async def connected_start_state(message, strings, chat):
     key = 'AllMight_connected_start_state:' + str(message.from_user.id)
-    if redis.get(key):
+    if await redis.get(key):
         await message.reply(strings['pm_connected'].format(chat_name=chat['chat_title']))
-        redis.delete(key)
+        await redis.delete(key)
 
 
 BUTTONS.update({'connect': 'btn_connect_start'})
@@ -236,6 +236,13 @@ async def connect_start(message, strings, regexp=None, **kwargs):
 
     await def_connect_chat(message, message.from_user.id, chat['chat_id'], chat['chat_title'])
 
+
+__indexes__ = {
+    'connections': [[('user_id', 1)]],
+    'chat_connection_settings': [[('chat_id', 1)]]
+}
+
+
 __mod_name__ = "Connections"
 
 __help__ = """
@@ -149,6 +149,9 @@ async def enable_all_notes_cb(event, chat, strings):
     await event.message.edit_text(text)
 
 
+__indexes__ = {'disabled': [[('chat_id', 1)]]}
+
+
 async def __export__(chat_id):
     disabled = await db.disabled.find_one({'chat_id': chat_id})
 
@@ -87,15 +87,20 @@ async def all_errors_handler(update: Update, error):
 
     log.warn('Error caused update is: \n' + html.escape(str(parse_update(message)), quote=False))
 
-    if redis.get(chat_id) == str(error):
+    if await redis.get(chat_id) == str(error):
         # by err_tlt we assume that it is same error
         return
 
     if err_tlt == 'BadRequest' and err_msg == 'Have no rights to send a message':
         return True
 
+    if err_tlt in ('FloodWaitError', 'RetryAfter'):
+        # Outbound scheduler already retried, so it's a long flood wait or a flood loop
+        log.warning(f'Flood limit was not handled by outbound scheduler: {err_msg}')
+        return True
+
     ignored_errors = (
-        'FloodWaitError', 'RetryAfter', 'SlowModeWaitError', 'InvalidQueryID'
+        'SlowModeWaitError', 'InvalidQueryID'
     )
     if err_tlt in ignored_errors:
         return True
@@ -107,7 +112,7 @@ async def all_errors_handler(update: Update, error):
 
     text = "<b>Sorry, I encountered a error!</b>\n"
     text += f'<code>{html.escape(err_tlt, quote=False)}: {html.escape(err_msg, quote=False)}</code>'
-    redis.set(chat_id, str(error), ex=600)
+    await redis.set(chat_id, str(error), ex=600)
     await bot.send_message(chat_id, text)
 
 
@@ -20,6 +20,7 @@
 
 import asyncio
 import csv
+import gzip
 import html
 import io
 import re
@@ -28,18 +29,21 @@ import babel
 import ujson
 import uuid
 import os
+import tempfile
 import time
 
 from contextlib import suppress
 from datetime import datetime, timedelta
-from typing import Optional
-from pymongo import DeleteMany, InsertOne
+from typing import Optional, Tuple
+from pymongo import UpdateOne
 from aiogram import types
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InputFile, Message
 from aiogram.types.inline_keyboard import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.callback_data import CallbackData
-from aiogram.utils.exceptions import Unauthorized, NeedAdministratorRightsInTheChannel, ChatNotFound
+from aiogram.utils.exceptions import (
+    Unauthorized, NeedAdministratorRightsInTheChannel, ChatNotFound, TelegramAPIError, MessageNotModified, FileIsTooBig
+)
 
 from babel.dates import format_timedelta
 from datetime import datetime, timedelta
@@ -50,6 +54,11 @@ from AllMightRobot.services.redis import redis
 from AllMightRobot.services.telethon import tbot
 
 from .utils.connections import get_connected_chat, chat_connection
+from .utils.fanout import FANOUT_KINDS, submit_job, resume_jobs
+from .utils.feds import (
+    add_to_fbans_bloom, drop_fbans_bloom, may_be_fbanned, rebuild_fbans_bloom,
+    get_feds_graph, reset_feds_graph
+)
 from .utils.language import get_strings_dec, get_strings, get_string
 from .utils.message import need_args_dec, get_cmd
 from .utils.restrictions import ban_user, unban_user
@@ -58,6 +67,7 @@ from .utils.user_details import (
     is_user_admin, get_chat_dec
 )
 from ..utils.cached import cached
+from ..utils.updates_stream import is_leader
 
 class ImportFbansFileWait(StatesGroup):
     waiting = State()
@@ -73,8 +83,10 @@ async def get_fed_f(message):
         if chat['status'] == 'private':
             # return fed which user is created
             fed = await get_fed_by_creator(chat['chat_id'])
+        elif fed_id := await get_chat_fed_id(chat['chat_id']):
+            fed = await get_fed_by_id(fed_id)
         else:
-            fed = await db.feds.find_one({'chats': {'$in': [chat['chat_id']]}})
+            fed = None
         if not fed:
             return False
         return fed
@@ -282,6 +294,7 @@ async def join_fed(message, chat, strings):
         {"$addToSet": {'chats': {'$each': [chat_id]}}}
     )
     await get_fed_by_id.reset_cache(fed['fed_id'])
+    await get_chat_fed_id.reset_cache(chat_id)
     await message.reply(strings['join_fed_success'].format(
         chat=chat['chat_title'], fed=html.escape(fed['fed_name'], False))
     )
@@ -308,6 +321,7 @@ async def leave_fed_comm(message, chat, fed, strings):
         {'$pull': {'chats': chat['chat_id']}}
     )
     await get_fed_by_id.reset_cache(fed['fed_id'])
+    await get_chat_fed_id.reset_cache(chat['chat_id'])
     await message.reply(strings['leave_fed_success'].format(
         chat=chat['chat_title'], fed=html.escape(fed['fed_name'], False))
     )
@@ -346,6 +360,7 @@ async def fed_sub(message, fed, strings):
         {"$addToSet": {'subscribed': {'$each': [fed_id]}}}
     )
     await get_fed_by_id.reset_cache(fed['fed_id'])
+    await reset_feds_graph()
     await message.reply(strings['subsed_success'].format(
         name=html.escape(fed['fed_name'], False),
         name2=html.escape(fed2['fed_name'], False)
@@ -376,6 +391,7 @@ async def fed_unsub(message, fed, strings):
         {'$pull': {'subscribed': str(fed_id)}}
     )
     await get_fed_by_id.reset_cache(fed['fed_id'])
+    await reset_feds_graph()
     await message.reply(strings['unsubsed_success'].format(
         name=html.escape(fed['fed_name'], False),
         name2=html.escape(fed2['fed_name'], False)
@@ -540,18 +556,6 @@ async def fed_info(message, fed, strings):
     await message.reply(text, disable_notification=True)
 
 
-async def get_all_subs_feds_r(fed_id, new):
-    new.append(fed_id)
-
-    fed = await get_fed_by_id(fed_id)
-    async for item in db.feds.find({'subscribed': {'$in': [fed['fed_id']]}}):
-        if item['fed_id'] in new:
-            continue
-        new = await get_all_subs_feds_r(item['fed_id'], new)
-
-    return new
-
-
 @decorator.register(cmds=['fban', 'sfban'])
 @get_fed_user_text()
 @is_fed_admin
@@ -598,129 +602,89 @@ async def fed_ban_user(message, fed, user, reason, strings):
     if reason:
         text += strings['fbanned_reason'].format(reason=reason)
 
-    # fban processing msg
-    num = len(fed['chats']) if 'chats' in fed else 0
-    msg = await message.reply(text + strings['fbanned_process'].format(num=num))
-
-    user = await db.user_list.find_one({'user_id': user_id})
+    # Check if silent
+    silent = False
+    if get_cmd(message) == 'sfban':
+        silent = True
+        key = f'leave_silent:{message.chat.id}:{user_id}'
+        await redis.set(key, user_id, ex=30)
+        text += strings['fbanned_silence']
 
-    banned_chats = []
+    num = len(fed['chats']) if 'chats' in fed else 0
+    sfeds_list = list((await get_feds_graph()).subscribers_closure(fed['fed_id']))[1:]
 
-    if 'chats' in fed:
-        for chat_id in fed['chats']:
-            # We not found the user or user wasn't detected
-            if not user or 'chats' not in user:
-                continue
+    # fban processing msg
+    if sfeds_list:
+        msg = await message.reply(text + strings['fbanned_subs_process'].format(feds=len(sfeds_list)))
+    else:
+        msg = await message.reply(text + strings['fbanned_process'].format(num=num))
 
-            if chat_id in user['chats']:
-                await asyncio.sleep(0)  # Do not slow down other updates
-                if await ban_user(chat_id, user_id):
-                    banned_chats.append(chat_id)
+    user_data = await db.user_list.find_one({'user_id': user_id})
+    # We not found the user or user wasn't detected
+    user_chats = set(user_data['chats']) if user_data and 'chats' in user_data else set()
 
+    # Bans are saved before fan-out, banned chats are added to them by the job as it goes
     new = {
         'fed_id': fed['fed_id'],
         'user_id': user_id,
-        'banned_chats': banned_chats,
+        'banned_chats': [],
         'time': datetime.now(),
         'by': message.from_user.id
     }
-
     if reason:
         new['reason'] = reason
 
     await db.fed_bans.insert_one(new)
+    await add_to_fbans_bloom(fed['fed_id'], [user_id])
 
-    channel_text = strings['fban_log_fed_log'].format(
-        fed_name=html.escape(fed['fed_name'], False),
-        fed_id=fed['fed_id'],
-        user=await get_user_link(user_id),
-        user_id=user_id,
-        by=await get_user_link(message.from_user.id),
-        chat_count=len(banned_chats),
-        all_chats=num
-    )
-
-    if reason:
-        channel_text += strings['fban_reason_fed_log'].format(reason=reason)
-
-    # Check if silent
-    silent = False
-    if get_cmd(message) == 'sfban':
-        silent = True
-        key = 'leave_silent:' + str(message.chat.id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
-        text += strings['fbanned_silence']
+    targets = [[fed['fed_id'], chat_id] for chat_id in fed.get('chats', []) if chat_id in user_chats]
 
     # SubsFeds process
-    if len(sfeds_list := await get_all_subs_feds_r(fed['fed_id'], [])) > 1:
-        sfeds_list.remove(fed['fed_id'])
-        this_fed_banned_count = len(banned_chats)
-
-        await msg.edit_text(text + strings['fbanned_subs_process'].format(feds=len(sfeds_list)))
-
-        all_banned_chats_count = 0
-        for s_fed_id in sfeds_list:
-            if await db.fed_bans.find_one({'fed_id': s_fed_id, 'user_id': user_id}) is not None:
-                # user is already banned in subscribed federation, skip
-                continue
-            s_fed = await get_fed_by_id(s_fed_id)
-            banned_chats = []
-            new = {
-                'fed_id': s_fed_id,
-                'user_id': user_id,
-                'banned_chats': banned_chats,
-                'time': datetime.now(),
-                'origin_fed': fed['fed_id'],
-                'by': message.from_user.id
-            }
-            for chat_id in s_fed['chats']:
-                if not user:
-                    continue
-
-                elif chat_id == user['user_id']:
-                    continue
-
-                elif 'chats' not in user:
-                    continue
-
-                elif chat_id not in user['chats']:
-                    continue
-
-                # Do not slow down other updates
-                await asyncio.sleep(0.2)
-
-                if await ban_user(chat_id, user_id):
-                    banned_chats.append(chat_id)
-                    all_banned_chats_count += 1
-
-                    if reason:
-                        new['reason'] = reason
-
-            await db.fed_bans.insert_one(new)
+    for s_fed_id in sfeds_list:
+        if await db.fed_bans.find_one({'fed_id': s_fed_id, 'user_id': user_id}) is not None:
+            # user is already banned in subscribed federation, skip
+            continue
+        s_fed = await get_fed_by_id(s_fed_id)
+        new = {
+            'fed_id': s_fed_id,
+            'user_id': user_id,
+            'banned_chats': [],
+            'time': datetime.now(),
+            'origin_fed': fed['fed_id'],
+            'by': message.from_user.id
+        }
+        if reason:
+            new['reason'] = reason
 
-        await msg.edit_text(text + strings['fbanned_subs_done'].format(
-            chats=this_fed_banned_count,
-            subs_chats=all_banned_chats_count,
-            feds=len(sfeds_list)
-        ))
+        await db.fed_bans.insert_one(new)
+        await add_to_fbans_bloom(s_fed_id, [user_id])
 
-        channel_text += strings['fban_subs_fed_log'].format(
-            subs_chats=all_banned_chats_count,
-            feds=len(sfeds_list)
+        targets.extend(
+            [s_fed_id, chat_id] for chat_id in s_fed.get('chats', [])
+            if chat_id != user_id and chat_id in user_chats
         )
 
-    else:
-        await msg.edit_text(text + strings['fbanned_done'].format(num=len(banned_chats)))
-
-    await fed_post_log(fed, channel_text)
-
+    to_del = []
     if silent:
         to_del = [msg.message_id, message.message_id]
         if 'reply_to_message' in message and message.reply_to_message.from_user.id == user_id:
             to_del.append(message.reply_to_message.message_id)
-        await asyncio.sleep(5)
-        await tbot.delete_messages(message.chat.id, to_del)
+
+    await submit_job({
+        'kind': 'fban',
+        'targets': targets,
+        'fed_id': fed['fed_id'],
+        'user_id': user_id,
+        'by': message.from_user.id,
+        'reason': reason,
+        'chat_id': message.chat.id,
+        'msg_id': msg.message_id,
+        'text': text,
+        'all_chats': num,
+        'sub_feds': len(sfeds_list),
+        'silent': silent,
+        'to_del': to_del
+    })
 
 
 @decorator.register(cmds=['unfban', 'funban'])
@@ -746,72 +710,151 @@ async def unfed_ban_user(message, fed, user, text, strings):
         user_id=user['user_id']
     )
 
-    banned_chats = []
-    if 'banned_chats' in banned:
-        banned_chats = banned['banned_chats']
+    sfeds_list = list((await get_feds_graph()).subscribers_closure(fed['fed_id']))[1:]
 
     # unfban processing msg
-    msg = await message.reply(text + strings['un_fbanned_process'].format(num=len(banned_chats)))
+    if sfeds_list:
+        msg = await message.reply(text + strings['un_fbanned_subs_process'].format(feds=len(sfeds_list)))
+    else:
+        msg = await message.reply(text + strings['un_fbanned_process'].format(
+            num=len(banned.get('banned_chats', []))))
 
-    counter = 0
-    for chat_id in banned_chats:
-        await asyncio.sleep(0)  # Do not slow down other updates
-        if await unban_user(chat_id, user_id):
-            counter += 1
+    # Bits can't be removed from fbans filter, the user will just cost a database lookup till next rebuild.
+    # Read and delete are atomic, so chats saved by a running fban job are either here or unbanned by the job itself.
+    banned = await db.fed_bans.find_one_and_delete({'_id': banned['_id']}) or {}
+    targets = [[fed['fed_id'], chat_id] for chat_id in banned.get('banned_chats', [])]
 
-    await db.fed_bans.delete_one({'fed_id': fed['fed_id'], 'user_id': user_id})
+    # Subs feds
+    for sfed_id in sfeds_list:
+        # revision 19/10/2020: unfbans only those who got banned by `this` fed
+        ban = await db.fed_bans.find_one({'fed_id': sfed_id, 'origin_fed': fed['fed_id'], 'user_id': user_id})
+        if ban is None:
+            # probably old fban
+            ban = await db.fed_bans.find_one({'fed_id': sfed_id, 'user_id': user_id})
+            # if ban['time'] > `replace here with datetime of release of v2.2`:
+            #    continue
+        if ban is None:
+            continue
 
-    channel_text = strings['un_fban_log_fed_log'].format(
-        fed_name=html.escape(fed['fed_name'], False),
-        fed_id=fed['fed_id'],
-        user=await get_user_link(user['user_id']),
-        user_id=user['user_id'],
-        by=await get_user_link(message.from_user.id),
-        chat_count=len(banned_chats),
-        all_chats=len(fed['chats']) if 'chats' in fed else 0
-    )
+        ban = await db.fed_bans.find_one_and_delete({'_id': ban['_id']}) or {}
+        targets.extend([sfed_id, chat_id] for chat_id in ban.get('banned_chats', []))
+
+    await submit_job({
+        'kind': 'unfban',
+        'targets': targets,
+        'fed_id': fed['fed_id'],
+        'user_id': user_id,
+        'by': message.from_user.id,
+        'chat_id': message.chat.id,
+        'msg_id': msg.message_id,
+        'text': text,
+        'all_chats': len(fed['chats']) if 'chats' in fed else 0,
+        'sub_feds': len(sfeds_list)
+    })
+
+
+async def fban_job_progress(job):
+    strings = await get_strings(job['chat_id'], 'feds')
+    with suppress(TelegramAPIError):
+        await bot.edit_message_text(
+            job['text'] + strings['fanout_progress'].format(done=job['offset'], total=len(job['targets'])),
+            job['chat_id'], job['msg_id']
+        )
 
-    # Subs feds
-    if len(sfeds_list := await get_all_subs_feds_r(fed['fed_id'], [])) > 1:
-        sfeds_list.remove(fed['fed_id'])
-        this_fed_unbanned_count = counter
-
-        await msg.edit_text(text + strings['un_fbanned_subs_process'].format(feds=len(sfeds_list)))
-
-        all_unbanned_chats_count = 0
-        for sfed_id in sfeds_list:
-            # revision 19/10/2020: unfbans only those who got banned by `this` fed
-            ban = await db.fed_bans.find_one({'fed_id': sfed_id, 'origin_fed': fed['fed_id'], 'user_id': user_id})
-            if ban is None:
-                # probably old fban
-                ban = await db.fed_bans.find_one({'fed_id': sfed_id, 'user_id': user_id})
-                # if ban['time'] > `replace here with datetime of release of v2.2`:
-                #    continue
-            banned_chats = []
-            if ban is not None and 'banned_chats' in ban:
-                banned_chats = ban['banned_chats']
-
-            for chat_id in banned_chats:
-                await asyncio.sleep(0.2)  # Do not slow down other updates
-                if await unban_user(chat_id, user_id):
-                    all_unbanned_chats_count += 1
-
-                    await db.fed_bans.delete_one({'fed_id': sfed_id, 'user_id': user_id})
-
-        await msg.edit_text(text + strings['un_fbanned_subs_done'].format(
-            chats=this_fed_unbanned_count,
-            subs_chats=all_unbanned_chats_count,
-            feds=len(sfeds_list)
-        ))
 
-        channel_text += strings['fban_subs_fed_log'].format(
-            subs_chats=all_unbanned_chats_count,
-            feds=len(sfeds_list)
+async def fban_job_action(job, target):
+    # Ban in this sub fed was removed while the job was running
+    if target[0] in job.get('dropped_feds', ()):
+        return False
+    return await ban_user(target[1], job['user_id'])
+
+
+async def fban_job_checkpoint(job, succeeded):
+    banned_chats = {}
+    for fed_id, chat_id in succeeded:
+        banned_chats.setdefault(fed_id, []).append(chat_id)
+
+    dropped = {}
+    for fed_id, chats in banned_chats.items():
+        result = await db.fed_bans.update_one(
+            {'fed_id': fed_id, 'user_id': job['user_id']},
+            {'$addToSet': {'banned_chats': {'$each': chats}}}
         )
+        if not result.matched_count:
+            dropped[fed_id] = chats
+
+    # Removed bans were seen by unfban without the chats of this chunk
+    if dropped:
+        await asyncio.gather(*[
+            unban_user(chat_id, job['user_id']) for chats in dropped.values() for chat_id in chats
+        ], return_exceptions=True)
+
+    # User was unfbanned while the job was running
+    if not await db.fed_bans.count_documents({'fed_id': job['fed_id'], 'user_id': job['user_id']}):
+        return False
+
+    # Only a sub fed ban was removed, e.g. it was unsubscribed, skip the rest of its chats
+    if dropped:
+        job.setdefault('dropped_feds', []).extend(dropped)
+        await db.fanout_jobs.update_one({'_id': job['_id']}, {'$addToSet': {'dropped_feds': {'$each': list(dropped)}}})
+    return True
+
+
+async def fban_job_done(job, unban=False):
+    strings = await get_strings(job['chat_id'], 'feds')
+    fed_id = job['fed_id']
+    chats = job['counts'].get(fed_id, 0)
+    subs_chats = sum(count for s_fed_id, count in job['counts'].items() if s_fed_id != fed_id)
+
+    prefix = 'un_' if unban else ''
+    text = job['text']
+    if job['sub_feds']:
+        text += strings[prefix + 'fbanned_subs_done'].format(chats=chats, subs_chats=subs_chats, feds=job['sub_feds'])
     else:
-        await msg.edit_text(text + strings['un_fbanned_done'].format(num=counter))
+        text += strings[prefix + 'fbanned_done'].format(num=chats)
+
+    with suppress(TelegramAPIError):
+        await bot.edit_message_text(text, job['chat_id'], job['msg_id'])
+
+    if fed := await get_fed_by_id(fed_id):
+        channel_text = strings[prefix + 'fban_log_fed_log'].format(
+            fed_name=html.escape(fed['fed_name'], False),
+            fed_id=fed_id,
+            user=await get_user_link(job['user_id']),
+            user_id=job['user_id'],
+            by=await get_user_link(job['by']),
+            chat_count=chats,
+            all_chats=job['all_chats']
+        )
+        if job.get('reason'):
+            channel_text += strings['fban_reason_fed_log'].format(reason=job['reason'])
+        if job['sub_feds']:
+            channel_text += strings[prefix + 'fban_subs_fed_log'].format(subs_chats=subs_chats, feds=job['sub_feds'])
 
-    await fed_post_log(fed, channel_text)
+        await fed_post_log(fed, channel_text)
+
+    if job.get('silent'):
+        await asyncio.sleep(5)
+        await tbot.delete_messages(job['chat_id'], job['to_del'])
+
+
+async def unfban_job_checkpoint(job, succeeded):
+    # Bans were already removed when the job was created
+    pass
+
+
+FANOUT_KINDS['fban'] = {
+    'action': fban_job_action,
+    'checkpoint': fban_job_checkpoint,
+    'progress': fban_job_progress,
+    'done': fban_job_done
+}
+FANOUT_KINDS['unfban'] = {
+    'action': lambda job, target: unban_user(target[1], job['user_id']),
+    'checkpoint': unfban_job_checkpoint,
+    'progress': fban_job_progress,
+    'done': lambda job: fban_job_done(job, unban=True)
+}
 
 
 @decorator.register(cmds=['delfed', 'fdel'])
@@ -840,8 +883,12 @@ async def del_fed_func(event, strings, callback_data=None, **kwargs):
     if event.from_user.id != int(fed_owner):
         return
 
+    fed = await get_fed_by_id(fed_id)
     await db.feds.delete_one({'fed_id': fed_id})
     await get_fed_by_id.reset_cache(fed_id)
+    if fed:
+        for chat_id in fed.get('chats', []):
+            await get_chat_fed_id.reset_cache(chat_id)
     await get_fed_by_creator.reset_cache(int(fed_owner))
     async for subscribed_fed in db.feds.find({'subscribed': fed_id}):
         await db.feds.update_one(
@@ -849,9 +896,11 @@ async def del_fed_func(event, strings, callback_data=None, **kwargs):
             {'$pull': {'subscribed': fed_id}}
         )
         await get_fed_by_id.reset_cache(subscribed_fed['fed_id'])
+    await reset_feds_graph()
 
     # delete all fbans of it
     await db.fed_bans.delete_many({'fed_id': fed_id})
+    await drop_fbans_bloom(fed_id)
 
     await event.message.edit_text(strings['delfed_success'])
 
@@ -888,6 +937,30 @@ async def fed_rename(message, fed, strings):
     )
 
 
+EXPORT_FIELDS = ['user_id', 'reason', 'by', 'time', 'banned_chats']
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_BATCH_SIZE = 1000
+EXPORT_PROGRESS_INTERVAL = 5
+
+
+def fban_export_row(banned_data: dict) -> dict:
+    data = {'user_id': banned_data['user_id']}
+
+    if 'reason' in banned_data:
+        data['reason'] = banned_data['reason']
+
+    if 'time' in banned_data:
+        data['time'] = int(time.mktime(banned_data['time'].timetuple()))
+
+    if 'by' in banned_data:
+        data['by'] = banned_data['by']
+
+    if 'banned_chats' in banned_data:
+        data['banned_chats'] = banned_data['banned_chats']
+
+    return data
+
+
 @decorator.register(cmds=['fbanlist', 'exportfbans', 'fexport'])
 @get_fed_dec
 @is_fed_admin
@@ -895,42 +968,55 @@ async def fed_rename(message, fed, strings):
 async def fban_export(message, fed, strings):
     fed_id = fed['fed_id']
     key = 'fbanlist_lock:' + str(fed_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if await redis.get(key) and message.from_user.id not in OPERATORS:
+        ttl = format_timedelta(timedelta(seconds=await redis.ttl(key)), strings['language_info']['babel'])
         await message.reply(strings['fbanlist_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 600)
-
-    msg = await message.reply(strings['creating_fbanlist'])
-    fields = ['user_id', 'reason', 'by', 'time', 'banned_chats']
-    with io.StringIO() as f:
-        writer = csv.DictWriter(f, fields)
-        writer.writeheader()
-        async for banned_data in db.fed_bans.find({'fed_id': fed_id}):
-            await asyncio.sleep(0)
-
-            data = {'user_id': banned_data['user_id']}
-
-            if 'reason' in banned_data:
-                data['reason'] = banned_data['reason']
-
-            if 'time' in banned_data:
-                data['time'] = int(time.mktime(banned_data['time'].timetuple()))
-
-            if 'by' in banned_data:
-                data['by'] = banned_data['by']
+    args = [arg.lower() for arg in message.get_args().split() if arg != fed_id]
+    file_format = next((arg for arg in args if arg in EXPORT_FORMATS), 'csv')
+    compress = 'gz' in args or 'gzip' in args
 
-            if 'banned_chats' in banned_data:
-                data['banned_chats'] = banned_data['banned_chats']
-
-            writer.writerow(data)
+    await redis.set(key, 1, ex=600)
 
+    msg = await message.reply(strings['creating_fbanlist'])
+    total = await db.fed_bans.count_documents({'fed_id': fed_id})
+
+    # Bans are streamed from the cursor to the file, so memory doesn't depend on the fed size
+    with tempfile.TemporaryFile() as raw:
+        binary = gzip.GzipFile(fileobj=raw, mode='wb') if compress else raw
+        f = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        if file_format == 'csv':
+            writer = csv.DictWriter(f, EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(row):
+                f.write(ujson.dumps(row) + '\n')
+
+        count = 0
+        last_progress = time.monotonic()
+        projection = {field: 1 for field in EXPORT_FIELDS}
+        projection['_id'] = 0
+        async for banned_data in db.fed_bans.find({'fed_id': fed_id}, projection, batch_size=EXPORT_BATCH_SIZE):
+            write(fban_export_row(banned_data))
+            count += 1
+
+            if time.monotonic() - last_progress > EXPORT_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                with suppress(MessageNotModified):
+                    await msg.edit_text(strings['fbanlist_progress'].format(count=count, total=total))
+
+        # Flush buffered text and gzip trailer, but leave the underlying file open
+        f.detach()
+        if compress:
+            binary.close()
+        raw.seek(0)
+
+        filename = f'fban_export.{file_format}' + ('.gz' if compress else '')
         text = strings['fbanlist_done'] % html.escape(fed['fed_name'], False)
-        f.seek(0)
         await message.answer_document(
-            InputFile(f, filename='fban_export.csv'),
+            InputFile(raw, filename=filename),
             text
         )
     await msg.delete()
@@ -943,13 +1029,12 @@ async def fban_export(message, fed, strings):
 async def importfbans_cmd(message, fed, strings):
     fed_id = fed['fed_id']
     key = 'importfbans_lock:' + str(fed_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if await redis.get(key) and message.from_user.id not in OPERATORS:
+        ttl = format_timedelta(timedelta(seconds=await redis.ttl(key)), strings['language_info']['babel'])
         await message.reply(strings['importfbans_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 600)
+    await redis.set(key, 1, ex=600)
 
     if 'document' in message:
         document = message.document
@@ -967,95 +1052,136 @@ async def importfbans_cmd(message, fed, strings):
     await importfbans_func(message, fed, document=document)
 
 
+# Legacy JSON is loaded at once, other formats are parsed while read, only files limits apply to them
+IMPORT_JSON_MAX_SIZE = 1000000
+# Telegram Bot API server doesn't give bots bigger files
+IMPORT_DOWNLOAD_MAX_MB = 20
+IMPORT_MAX_SIZE = IMPORT_DOWNLOAD_MAX_MB * 1024 * 1024
+IMPORT_BATCH_SIZE = 1000
+
+
+def iter_fban_rows(f, file_type: str, position: dict):
+    """
+    Yields ban rows as dicts, reading the file lazily for csv and jsonl.
+    position['line'] is set to the line (entry for json) being read, to report where the file is broken.
+    """
+    if file_type == 'json':
+        for position['line'], (user_id, data) in enumerate(ujson.load(f).items(), 1):
+            yield {**data, 'user_id': user_id}
+    elif file_type == 'csv':
+        reader = csv.DictReader(f)
+        while True:
+            position['line'] = reader.line_num + 1
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            position['line'] = reader.line_num
+            yield row
+    elif file_type == 'jsonl':
+        for position['line'], line in enumerate(f, 1):
+            if line.strip():
+                yield ujson.loads(line)
+
+
+def fban_import_op(row: dict, fed_id: str, by: int, current_time: datetime) -> Optional[Tuple[int, UpdateOne]]:
+    if 'user_id' in row:
+        user_id = int(row['user_id'])
+    elif 'id' in row:
+        user_id = int(row['id'])
+    else:
+        return None
+
+    new = {
+        'fed_id': fed_id,
+        'user_id': user_id,
+        'by': int(row['by']) if row.get('by') else by,
+        'time': datetime.fromtimestamp(int(row['time'])) if row.get('time') else current_time
+    }
+
+    if 'reason' in row:
+        new['reason'] = row['reason']
+
+    if 'banned_chats' in row and type(row['banned_chats']) == list:
+        new['banned_chats'] = row['banned_chats']
+
+    return user_id, UpdateOne({'fed_id': fed_id, 'user_id': user_id}, {'$set': new}, upsert=True)
+
+
 @get_strings_dec('feds')
 async def importfbans_func(message, fed, strings, document=None):
-    global user_id
-    file_type = os.path.splitext(document['file_name'])[1][1:]
+    fed_id = fed['fed_id']
+    name, file_type = os.path.splitext(document['file_name'].lower())
+    if compressed := file_type == '.gz':
+        file_type = os.path.splitext(name)[1]
+    file_type = file_type[1:]
 
-    if file_type == 'json':
-        if document['file_size'] > 1000000:
+    if file_type == 'json' and not compressed:
+        if document['file_size'] > IMPORT_JSON_MAX_SIZE:
             await message.reply(strings['big_file_json'].format(num='1'))
             return
-    elif file_type == 'csv':
-        if document['file_size'] > 52428800:
-            await message.reply(strings['big_file_csv'].format(num='50'))
+    elif file_type in ('csv', 'jsonl'):
+        if document['file_size'] > IMPORT_MAX_SIZE:
+            # Can't be downloaded, so don't keep others from importing
+            await redis.delete('importfbans_lock:' + str(fed_id))
+            text = strings['big_file_csv'] if compressed else strings['big_file_gz']
+            await message.reply(text.format(num=IMPORT_DOWNLOAD_MAX_MB))
             return
     else:
         await message.reply(strings['wrong_file_ext'])
         return
 
-    f = await bot.download_file_by_id(document.file_id, io.BytesIO())
     msg = await message.reply(strings['importing_process'])
 
-    data = None
-    if file_type == 'json':
+    with tempfile.TemporaryFile() as raw:
         try:
-            data = ujson.load(f).items()
-        except ValueError:
-            return await message.reply(strings['invalid_file'])
-    elif file_type == 'csv':
-        data = csv.DictReader(io.TextIOWrapper(f))
-
-    real_counter = 0
-
-    queue_del = []
-    queue_insert = []
-    current_time = datetime.now()
-    for row in data:
-        if file_type == 'json':
-            user_id = row[0]
-            data = row[1]
-        elif file_type == 'csv':
-            if 'user_id' in row:
-                user_id = int(row['user_id'])
-            elif 'id' in row:
-                user_id = int(row['id'])
-            else:
-                continue
-        else:
-            raise NotImplementedError
-
-        new = {
-            'fed_id': fed['fed_id'],
-            'user_id': user_id
-        }
-
-        if 'reason' in row:
-            new['reason'] = row['reason']
-
-        if 'by' in row:
-            new['by'] = int(row['by'])
-        else:
-            new['by'] = message.from_user.id
+            await bot.download_file_by_id(document.file_id, raw)
+        except FileIsTooBig:
+            return await msg.edit_text(strings['big_file_csv'].format(num=IMPORT_DOWNLOAD_MAX_MB))
+        raw.seek(0)
 
-        if 'time' in row:
-            new['time'] = datetime.fromtimestamp(int(row['time']))
-        else:
-            new['time'] = current_time
-
-        if 'banned_chats' in row and type(row['banned_chats']) == list:
-            new['banned_chats'] = row['banned_chats']
-
-        queue_del.append(DeleteMany({'fed_id': fed['fed_id'], 'user_id': user_id}))
-        queue_insert.append(InsertOne(new))
+        binary = gzip.GzipFile(fileobj=raw, mode='rb') if compressed else raw
+        f = io.TextIOWrapper(binary, encoding='utf-8', newline='' if file_type == 'csv' else None)
 
-        if len(queue_insert) == 1000:
-            real_counter += len(queue_insert)
+        real_counter = 0
+        position = {'line': 0}
+        last_progress = time.monotonic()
+        current_time = datetime.now()
+        # user_id: operation, so the last row of the user in the batch wins
+        queue = {}
 
-            # Make delete operation ordered before inserting.
-            if queue_del:
-                await db.fed_bans.bulk_write(queue_del, ordered=False)
-            await db.fed_bans.bulk_write(queue_insert, ordered=False)
+        async def write_batch():
+            await db.fed_bans.bulk_write(list(queue.values()), ordered=False)
+            await add_to_fbans_bloom(fed_id, list(queue.keys()))
 
-            queue_del = []
-            queue_insert = []
+        try:
+            for row in iter_fban_rows(f, file_type, position):
+                if not (ban := fban_import_op(row, fed_id, message.from_user.id, current_time)):
+                    continue
+                user_id, op = ban
+                queue[user_id] = op
+
+                if len(queue) == IMPORT_BATCH_SIZE:
+                    await write_batch()
+                    real_counter += len(queue)
+                    queue = {}
+
+                    if time.monotonic() - last_progress > EXPORT_PROGRESS_INTERVAL:
+                        last_progress = time.monotonic()
+                        with suppress(MessageNotModified):
+                            await msg.edit_text(strings['importing_progress'].format(num=real_counter))
+        except (ValueError, TypeError, AttributeError, OSError, csv.Error):
+            # Previous batches are already written, so tell how far it went
+            if real_counter:
+                return await msg.edit_text(
+                    strings['invalid_file_partial'].format(line=position['line'], num=real_counter)
+                )
+            return await msg.edit_text(strings['invalid_file'])
 
-    # Process last bans
-    real_counter += len(queue_insert)
-    if queue_del:
-        await db.fed_bans.bulk_write(queue_del, ordered=False)
-    if queue_insert:
-        await db.fed_bans.bulk_write(queue_insert, ordered=False)
+        # Process last bans
+        if queue:
+            await write_batch()
+            real_counter += len(queue)
 
     await msg.edit_text(strings['import_done'].format(num=real_counter))
 
@@ -1082,13 +1208,15 @@ async def check_fbanned(message: Message, chat, strings):
     if not (fed := await get_fed_f(message)):
         return
 
-    elif await is_user_admin(chat_id, user_id):
-        return
+    # Chat's fed and all feds it's subscribed on
+    feds_list = list((await get_feds_graph()).subscriptions_closure(fed['fed_id']))
 
-    feds_list = [fed['fed_id']]
+    # Most of users aren't banned, so don't touch database for them
+    if not await may_be_fbanned(feds_list, user_id):
+        return
 
-    if 'subscribed' in fed:
-        feds_list.extend(fed['subscribed'])
+    elif await is_user_admin(chat_id, user_id):
+        return
 
     if ban := await db.fed_bans.find_one({'fed_id': {'$in': feds_list}, 'user_id': user_id}):
 
@@ -1129,10 +1257,8 @@ async def fedban_check(message, fed, user, _, strings):
 
     total_count = await db.fed_bans.count_documents({'user_id': user['user_id']})
     if fed:
-        fed_list = [fed['fed_id']]
         # check fbanned in subscribed
-        if 'subscribed' in fed:
-            fed_list.extend(fed['subscribed'])
+        fed_list = list((await get_feds_graph()).subscriptions_closure(fed['fed_id']))
 
         if fban_data := await db.fed_bans.find_one({'user_id': user['user_id'], 'fed_id': {'$in': fed_list}}):
             fbanned_fed = True
@@ -1199,6 +1325,16 @@ async def fedban_check(message, fed, user, _, strings):
     await message.reply(text)
 
 
+@decorator.register(cmds='frebuildbloom', is_owner=True)
+async def rebuild_fbans_bloom_cmd(message):
+    msg = await message.reply("Rebuilding federation bans filters...")
+    feds_count, bans_count = 0, 0
+    async for fed in db.feds.find({}, {'_id': 0, 'fed_id': 1}):
+        bans_count += await rebuild_fbans_bloom(fed['fed_id'])
+        feds_count += 1
+    await msg.edit_text(f"Rebuilt filters of <code>{feds_count}</code> feds with <code>{bans_count}</code> bans.")
+
+
 @cached()
 async def get_fed_by_id(fed_id: str) -> Optional[dict]:
     return await db.feds.find_one({'fed_id': fed_id})
@@ -1209,6 +1345,18 @@ async def get_fed_by_creator(creator: int) -> Optional[dict]:
     return await db.feds.find_one({'creator': creator})
 
 
+@cached()
+async def get_chat_fed_id(chat_id: int) -> Optional[str]:
+    if fed := await db.feds.find_one({'chats': chat_id}, {'_id': 0, 'fed_id': 1}):
+        return fed['fed_id']
+
+
+__indexes__ = {
+    'fed_bans': [[('fed_id', 1), ('user_id', 1)], [('user_id', 1)]],
+    'feds': [[('fed_id', 1)], [('chats', 1)], [('subscribed', 1)], [('creator', 1)]]
+}
+
+
 async def __export__(chat_id):
     if chat_fed := await db.feds.find_one({'chats': [chat_id]}):
         return {'feds': {'fed_id': chat_fed['fed_id']}}
@@ -1221,8 +1369,13 @@ async def __import__(chat_id, data):
             await get_fed_by_id.reset_cache(current_fed['fed_id'])
         await db.feds.update_one({'fed_id': fed_id}, {'$addToSet': {'chats': chat_id}})
         await get_fed_by_id.reset_cache(fed_id)
+        await get_chat_fed_id.reset_cache(chat_id)
 
 
+async def __before_serving__(loop):
+    # Every worker would resume the same jobs otherwise
+    if is_leader():
+        await resume_jobs()
 
 
 __mod_name__ = "Federations"
@@ -1251,8 +1404,8 @@ In both cases AllMight will help you.
 - /funsub (Fed ID): unsubscibes your Federation from provided
 - /fsetlog (? Fed ID) (? chat/channel id) or /setfedlog (? Fed ID) (? chat/channel id): Set's a log chat/channel for your Federation
 - /funsetlog (?Fed ID) or /unsetfedlog (?Fed ID): Unsets a Federation log chat\channel
-- /fexport (?Fed ID): Exports Federation bans
-- /fimport (?Fed ID) (file): Imports Federation bans
+- /fexport (?Fed ID) (?csv/jsonl) (?gz): Exports Federation bans, CSV by default, gz compresses the file
+- /fimport (?Fed ID) (file): Imports Federation bans from json, csv or jsonl file, csv and jsonl can be gz compressed
 
 <b>Only Chat owner:</b>
 - /fjoin (Fed ID) or /joinfed (Fed ID): Joins current chat to provided Federation
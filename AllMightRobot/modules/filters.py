@@ -16,11 +16,9 @@
 
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-import asyncio
-import functools
 import random
-import re
 from contextlib import suppress
+from copy import deepcopy
 from string import printable
 
 import regex
@@ -29,7 +27,6 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.types.inline_keyboard import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import MessageCantBeDeleted, MessageToDeleteNotFound
-from async_timeout import timeout
 from bson.objectid import ObjectId
 from pymongo import UpdateOne
 
@@ -41,6 +38,7 @@ from AllMightRobot.services.redis import redis
 from AllMightRobot.utils.logger import log
 from .utils.connections import chat_connection, get_connected_chat
 from .utils.language import get_strings_dec, get_string
+from .utils.matcher import ChatFilters, FiltersIndex
 from .utils.message import need_args_dec, get_args_str
 from .utils.user_details import is_user_admin, is_chat_creator
 
@@ -49,6 +47,7 @@ filter_remove_cp = CallbackData('filter_remove_cp', 'id')
 filter_delall_yes_cb = CallbackData('filter_delall_yes_cb', 'chat_id')
 
 FILTERS_ACTIONS = {}
+FILTERS_INDEX = FiltersIndex()
 
 
 class NewFilter(StatesGroup):
@@ -57,18 +56,19 @@ class NewFilter(StatesGroup):
 
 
 async def update_handlers_cache(chat_id):
-    redis.delete(f'filters_cache_{chat_id}')
-    filters = db.filters.find({'chat_id': chat_id})
-    handlers = []
-    async for filter in filters:
-        handler = filter['handler']
-        if handler in handlers:
-            continue
+    # Bumping the version makes every process drop its copy of chat filters
+    FILTERS_INDEX.invalidate(chat_id)
+    await redis.incr(f'filters_ver_{chat_id}')
 
-        handlers.append(handler)
-        redis.lpush(f'filters_cache_{chat_id}', handler)
 
-    return handlers
+async def get_chat_filters(chat_id) -> ChatFilters:
+    version = await redis.get(f'filters_ver_{chat_id}')
+    if (chat_filters := FILTERS_INDEX.get(chat_id, version)) is None:
+        filters = await db.filters.find({'chat_id': chat_id}).to_list(None)
+        chat_filters = ChatFilters(version, filters)
+        FILTERS_INDEX.set(chat_id, chat_filters)
+
+    return chat_filters
 
 
 @register()
@@ -79,10 +79,7 @@ async def check_msg(message):
         return
 
     chat_id = chat['chat_id']
-    if not (filters := redis.lrange(f'filters_cache_{chat_id}', 0, -1)):
-        filters = await update_handlers_cache(chat_id)
-
-    if len(filters) == 0:
+    if not (chat_filters := await get_chat_filters(chat_id)):
         return
 
     text = message.text
@@ -92,25 +89,19 @@ async def check_msg(message):
         if text[1:].startswith('addfilter') or text[1:].startswith('delfilter'):
             return
 
-    for handler in filters:  # type: str
-        if handler.startswith("re:"):
-            func = functools.partial(regex.search, handler.replace("re:", '', 1), text, timeout=0.1)
-        else:
-            # TODO: Remove this (handler.replace(...)). kept for backward compatibility
-            func = functools.partial(re.search, re.escape(handler).replace('(+)', '(.*)'), text, flags=re.IGNORECASE)
-
-        try:
-            async with timeout(0.1):
-                matched = await loop.run_in_executor(None, func)
-        except (asyncio.TimeoutError, TimeoutError):
-            continue
+    matcher = chat_filters.matcher
+    if matcher.has_patterns:
+        # Run all regex handlers in one executor call, they share a single time budget
+        matched = await loop.run_in_executor(None, matcher.match, text)
+    else:
+        matched = matcher.match(text)
 
-        if matched:
-            # We can have few filters with same handler, that's why we create a new loop.
-            filters = db.filters.find({'chat_id': chat_id, 'handler': handler})
-            async for filter in filters:
-                action = filter['action']
-                await FILTERS_ACTIONS[action]['handle'](message, chat, filter)
+    for handler in matched:
+        # We can have few filters with same handler
+        for filter in chat_filters.by_handler[handler]:
+            action = filter['action']
+            # Actions may change the filter data, don't let them touch the cached one
+            await FILTERS_ACTIONS[action]['handle'](message, chat, deepcopy(filter))
 
 
 @register(cmds=['addfilter', 'newfilter'], is_admin=True)
@@ -150,7 +141,7 @@ async def add_handler(message, chat, strings):
 
     user_id = message.from_user.id
     chat_id = chat['chat_id']
-    redis.set(f'add_filter:{user_id}:{chat_id}', handler)
+    await redis.set(f'add_filter:{user_id}:{chat_id}', handler)
     if handler is not None:
         await message.reply(text, reply_markup=buttons)
 
@@ -178,7 +169,7 @@ async def register_action(event, chat, strings, callback_data=None, state=None,
     user_id = event.from_user.id
     chat_id = chat['chat_id']
 
-    handler = redis.get(f'add_filter:{user_id}:{chat_id}')
+    handler = await redis.get(f'add_filter:{user_id}:{chat_id}')
 
     if not handler:
         return await event.answer("Something went wrong! Please try again!", show_alert=True)
@@ -356,16 +347,26 @@ async def __before_serving__(loop):
             FILTERS_ACTIONS[data[0]] = data[1]
 
 
+__indexes__ = {'filters': [[('chat_id', 1), ('handler', 1)]]}
+
+
+EXPORT_CHUNK_SIZE = 100
+
+
 async def __export__(chat_id):
+    # Yields filters in parts, so chats with many filters are never fully in memory
     data = []
-    filters = db.filters.find({'chat_id': chat_id})
-    async for filter in filters:
-        del filter['_id'], filter['chat_id']
+    async for filter in db.filters.find({'chat_id': chat_id}, {'_id': 0, 'chat_id': 0}):
         if 'time' in filter:
             filter['time'] = str(filter['time'])
         data.append(filter)
 
-    return {'filters': data}
+        if len(data) == EXPORT_CHUNK_SIZE:
+            yield {'filters': data}
+            data = []
+
+    if data:
+        yield {'filters': data}
 
 
 async def __import__(chat_id, data):
@@ -3,6 +3,9 @@ from AllMightRobot import bot
 from AllMightRobot.decorator import register
 from .utils.disable import disableable_dec
 from .utils.message import need_args_dec, get_args_str
+from ..utils.outbound import Priority
+
+__outbound_priority__ = Priority.FUN
 
 SLAP_TEMPLATES = (
     "{user2} was killed by magic.",
@@ -17,7 +17,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import io
+import asyncio
 import random
 import re
 from contextlib import suppress
@@ -33,7 +33,6 @@ from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import MessageToDeleteNotFound, MessageCantBeDeleted, BadRequest, ChatAdminRequired
 from apscheduler.jobstores.base import JobLookupError
 from babel.dates import format_timedelta
-from captcha.image import ImageCaptcha
 from telethon.tl.custom import Button
 
 from AllMightRobot import BOT_USERNAME, BOT_ID, bot, dp
@@ -41,16 +40,25 @@ from AllMightRobot.config import get_str_key
 from AllMightRobot.decorator import register
 from AllMightRobot.services.apscheduller import scheduler
 from AllMightRobot.services.mongo import db
-from AllMightRobot.services.redis import redis
+from AllMightRobot.services.redis import redis, pipeline
 from AllMightRobot.services.telethon import tbot
-from AllMightRobot.stuff.fonts import ALL_FONTS
+from AllMightRobot.utils.logger import log
+from .utils.captcha import CAPTCHA_POOL
 from .utils.connections import chat_connection
-from .utils.language import get_strings_dec
+from .utils.language import get_strings_dec, get_strings
 from .utils.message import need_args_dec, convert_time
 from .utils.notes import get_parsed_note_list, t_unparse_note_item, send_note
 from .utils.restrictions import mute_user, restrict_user, unmute_user, kick_user
 from .utils.user_details import is_user_admin, get_user_link, check_admin_rights
 from ..utils.cached import cached
+from ..utils.outbound import Priority
+
+__outbound_priority__ = Priority.WELCOME
+
+# Joins of a chat are greeted together if they come within this window (seconds)
+JOIN_BATCH_WINDOW = 1.5
+# Greeted right away when so many joins are collected, keeps the message in Telegram limits
+JOIN_BATCH_MAX = 30
 
 
 class WelcomeSecurityState(StatesGroup):
@@ -460,40 +468,79 @@ async def reset_security_note(message, chat, strings):
     await message.reply(text % chat['chat_title'])
 
 
+class JoinBatcher:
+    """
+    Collects joins of every chat for a short window, so joins of a raid are greeted with one message
+    and their restrictions are sent together.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}
+
+    def add(self, message: Message, members: list):
+        chat_id = message.chat.id
+        if (batch := self._batches.get(chat_id)) is None:
+            handle = asyncio.get_event_loop().call_later(self.window, self.flush, chat_id)
+            batch = self._batches[chat_id] = ([], handle)
+
+        batch[0].extend((message, member) for member in members)
+        if len(batch[0]) >= self.max_size:
+            self.flush(chat_id)
+
+    def flush(self, chat_id: int):
+        if not (batch := self._batches.pop(chat_id, None)):
+            return
+        joins, handle = batch
+        handle.cancel()
+        asyncio.ensure_future(handle_joins(chat_id, joins))
+
+
+JOINS = JoinBatcher(JOIN_BATCH_WINDOW, JOIN_BATCH_MAX)
+
+
 @register(only_groups=True, f='welcome')
-@get_strings_dec('greetings')
-async def welcome_security_handler(message: Message, strings):
-    if len(message.new_chat_members) > 1:
-        # FIXME: AllMightRobot doesnt support adding multiple users currently
-        return
+async def join_trigger(message: Message):
+    if members := [member for member in message.new_chat_members if member.id != BOT_ID]:
+        JOINS.add(message, members)
 
-    new_user = message.new_chat_members[0]
-    chat_id = message.chat.id
-    user_id = new_user.id
 
-    if user_id == BOT_ID:
-        return
+async def handle_joins(chat_id: int, joins: list):
+    try:
+        db_item = await get_greetings_data(chat_id) or {}
+        strings = await get_strings(chat_id, 'greetings')
 
-    db_item = await get_greetings_data(message.chat.id)
-    if not db_item or 'welcome_security' not in db_item:
-        return
+        if 'welcome_security' in db_item and db_item['welcome_security']['enabled']:
+            await welcome_security_handler(chat_id, joins, db_item, strings)
+        elif not db_item.get('welcome_disabled', False):
+            await welcome_trigger(chat_id, joins, db_item, strings)
+    except Exception:  # noqa
+        log.error(f'Greetings: failed to handle {len(joins)} joins in {chat_id}', exc_info=True)
 
-    if not await check_admin_rights(message, chat_id, BOT_ID, ['can_restrict_members']):
-        await message.reply(strings['not_admin_ws'])
+
+async def welcome_security_handler(chat_id: int, joins: list, db_item: dict, strings: dict):
+    if not await check_admin_rights(joins[-1][0], chat_id, BOT_ID, ['can_restrict_members']):
+        await joins[-1][0].reply(strings['not_admin_ws'])
         return
 
-    user = await message.chat.get_member(user_id)
-    # Check if user was muted before
-    if user['status'] == 'restricted':
-        if user['can_send_messages'] is False:
-            return
+    async def needs_security(join_message, new_user):
+        user = await bot.get_chat_member(chat_id, new_user.id)
+        # Check if user was muted before
+        if user['status'] == 'restricted' and user['can_send_messages'] is False:
+            return False
 
-    # Check on OPs and chat owner
-    if await is_user_admin(chat_id, user_id):
-        return
+        # Check on OPs and chat owner
+        if await is_user_admin(chat_id, new_user.id):
+            return False
+
+        # check if user added is a bot
+        if new_user.is_bot and await is_user_admin(chat_id, join_message.from_user.id):
+            return False
+        return True
 
-    # check if user added is a bot
-    if new_user.is_bot and await is_user_admin(chat_id, message.from_user.id):
+    checks = await asyncio.gather(*[needs_security(*join) for join in joins])
+    if not (joins := [join for join, check in zip(joins, checks) if check]):
         return
 
     if 'security_note' not in db_item:
@@ -501,58 +548,107 @@ async def welcome_security_handler(message: Message, strings):
         db_item['security_note']['text'] = strings['default_security_note']
         db_item['security_note']['parse_mode'] = 'md'
 
-    text, kwargs = await t_unparse_note_item(message, db_item['security_note'], chat_id)
+    # Reply to the join of the users who are really greeted
+    message = joins[-1][0]
+    members = [member for _, member in joins]
+    text, kwargs = await t_unparse_note_item(
+        message, db_item['security_note'], chat_id, user=members[0], members=members
+    )
 
     kwargs['reply_to'] = (None if 'clean_service' in db_item and db_item['clean_service']['enabled'] is True
                           else message.message_id)
 
+    # Button of several users is shared, everyone is checked by welcome_security_users key
+    button_user_id = members[0].id if len(members) == 1 else 0
     kwargs['buttons'] = [] if not kwargs['buttons'] else kwargs['buttons']
-    kwargs['buttons'] += [Button.inline(strings['click_here'], f'ws_{chat_id}_{user_id}')]
+    kwargs['buttons'] += [Button.inline(strings['click_here'], f'ws_{chat_id}_{button_user_id}')]
 
     # FIXME: Better workaround
     if not (msg := await send_note(chat_id, text, **kwargs)):
         # Wasn't able to sent message
         return
 
-    # Mute user
-    try:
-        await mute_user(chat_id, user_id)
-    except BadRequest as error:
+    # Mute users, requests are paced by outbound scheduler
+    results = await asyncio.gather(*[mute_user(chat_id, member.id) for member in members], return_exceptions=True)
+    for result in results:
+        if not isinstance(result, BaseException):
+            continue
+        if not isinstance(result, BadRequest):
+            raise result
+        log.debug(f'Greetings: welcome security mute failed in {chat_id} - {result}')
+    if not (joins := [join for join, result in zip(joins, results) if result is True]):
         # TODO: Delete the "sent" message ^
-        return await message.reply(f'welcome security failed due to {error.args[0]}')
+        return await message.reply(f'welcome security failed due to {results[0].args[0]}')
 
-    redis.set(f'welcome_security_users:{user_id}:{chat_id}', msg.id)
+    user_ids = [member.id for _, member in joins]
+    async with pipeline() as pipe:
+        for user_id in user_ids:
+            pipe.set(f'welcome_security_users:{user_id}:{chat_id}', msg.id)
+        # Shared message is deleted when the last of its users passes
+        pipe.sadd(f'welcome_security_msg:{chat_id}:{msg.id}', *user_ids)
 
     if raw_time := db_item['welcome_security'].get('expire', None):
         time = convert_time(raw_time)
     else:
         time = convert_time(get_str_key('JOIN_CONFIRM_DURATION'))
 
+    # One job expires the whole batch
     scheduler.add_job(
-        join_expired,
+        joins_expired,
         "date",
-        id=f"wc_expire:{chat_id}:{user_id}",
+        id=f"wc_expire:{chat_id}:{msg.id}",
         run_date=datetime.utcnow() + time,
-        kwargs={'chat_id': chat_id, 'user_id': user_id, 'message_id': msg.id, 'wlkm_msg_id': message.message_id},
+        kwargs={
+            'chat_id': chat_id,
+            'user_ids': user_ids,
+            'message_id': msg.id,
+            # Service message of every user, in the same order
+            'wlkm_msg_ids': [join_message.message_id for join_message, _ in joins]
+        },
         replace_existing=True
     )
 
 
-async def join_expired(chat_id, user_id, message_id, wlkm_msg_id):
-    user = await bot.get_chat_member(chat_id, user_id)
-    if user.status != 'restricted':
-        return
-
+async def joins_expired(chat_id, user_ids, message_id, wlkm_msg_ids):
     bot_user = await bot.get_chat_member(chat_id, BOT_ID)
     if 'can_restrict_members' not in bot_user or bot_user['can_restrict_members'] is False:
         return
 
-    key = 'leave_silent:' + str(chat_id)
-    redis.set(key, user_id)
+    # Users who passed don't have the key anymore
+    pipe = redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.exists(f'welcome_security_users:{user_id}:{chat_id}')
+    pending = await pipe.execute()
+
+    async def expire(user_id) -> bool:
+        user = await bot.get_chat_member(chat_id, user_id)
+        if user.status != 'restricted':
+            return False
+
+        key = f'leave_silent:{chat_id}:{user_id}'
+        await redis.set(key, 1, ex=30)
+
+        await unmute_user(chat_id, user_id)
+        await kick_user(chat_id, user_id)
+        return True
+
+    kicked = await asyncio.gather(
+        *[expire(user_id) if exists else asyncio.sleep(0, False) for user_id, exists in zip(user_ids, pending)],
+        return_exceptions=True
+    )
+    async with pipeline() as pipe:
+        for user_id in user_ids:
+            pipe.delete(f'welcome_security_users:{user_id}:{chat_id}')
+        pipe.delete(f'welcome_security_msg:{chat_id}:{message_id}')
+
+    # Join messages of users who passed stay
+    wlkm_to_delete = {msg_id for msg_id, is_kicked in zip(wlkm_msg_ids, kicked) if is_kicked is True}
+    await tbot.delete_messages(chat_id, [message_id, *wlkm_to_delete])
+
 
-    await unmute_user(chat_id, user_id)
-    await kick_user(chat_id, user_id)
-    await tbot.delete_messages(chat_id, [message_id, wlkm_msg_id])
+async def join_expired(chat_id, user_id, message_id, wlkm_msg_id):
+    # Jobs which were scheduled before joins were batched
+    await joins_expired(chat_id, [user_id], message_id, [wlkm_msg_id])
 
 
 @register(regexp=re.compile(r'ws_'), f='cb')
@@ -566,7 +662,7 @@ async def ws_redirecter(message, strings):
     url = f'https://t.me/{BOT_USERNAME}?start=ws_{chat_id}_{called_user_id}_{message.message.message_id}'
     if not called_user_id == real_user_id:
         # The persons which are muted before wont have their signatures registered on cache
-        if not redis.exists(f"welcome_security_users:{called_user_id}:{chat_id}"):
+        if not await redis.exists(f"welcome_security_users:{called_user_id}:{chat_id}"):
             await message.answer(strings['not_allowed'], show_alert=True)
             return
         else:
@@ -620,19 +716,9 @@ async def wc_button_btn_cb(event, state=None, **kwargs):
     await welcome_security_passed(event, state)
 
 
-def generate_captcha(number=None):
-    if not number:
-        number = str(random.randint(10001, 99999))
-    captcha = ImageCaptcha(fonts=ALL_FONTS, width=200, height=100).generate_image(number)
-    img = io.BytesIO()
-    captcha.save(img, 'PNG')
-    img.seek(0)
-    return img, number
-
-
 @get_strings_dec('greetings')
 async def send_captcha(message, state, strings):
-    img, num = generate_captcha()
+    img, num = await CAPTCHA_POOL.get()
     async with state.proxy() as data:
         data['captcha_num'] = num
     text = strings['ws_captcha_text'].format(user=await get_user_link(message.from_user.id))
@@ -656,12 +742,12 @@ async def change_captcha(event, strings, state=None, **kwargs):
         regen_num = data['regen_num']
 
         if regen_num > 3:
-            img, num = generate_captcha(number=data['captcha_num'])
+            img, num = await CAPTCHA_POOL.render(number=data['captcha_num'])
             text = strings['last_chance']
             await message.edit_media(InputMediaPhoto(img, caption=text))
             return
 
-        img, num = generate_captcha()
+        img, num = await CAPTCHA_POOL.get()
         data['captcha_num'] = num
 
     text = strings['ws_captcha_text'].format(user=await get_user_link(event.from_user.id))
@@ -790,12 +876,15 @@ async def welcome_security_passed(message: Union[CallbackQuery, Message], state,
     await state.finish()
 
     with suppress(MessageToDeleteNotFound, MessageCantBeDeleted):
-        message_id = redis.get(f"welcome_security_users:{user_id}:{chat_id}")
-        # Delete the person's real security button if exists!
-        if message_id:
+        message_id = await redis.get(f"welcome_security_users:{user_id}:{chat_id}")
+        # Delete the person's real security button if exists and nobody else from the batch waits for it
+        if message_id and await release_security_message(chat_id, user_id, message_id):
+            # Nobody waits for the batch anymore
+            with suppress(JobLookupError):
+                scheduler.remove_job(f"wc_expire:{chat_id}:{message_id}")
             await bot.delete_message(chat_id, message_id)
 
-    redis.delete(f"welcome_security_users:{user_id}:{chat_id}")
+    await redis.delete(f"welcome_security_users:{user_id}:{chat_id}")
 
     with suppress(JobLookupError):
         scheduler.remove_job(f"wc_expire:{chat_id}:{user_id}")
@@ -844,30 +933,19 @@ async def welcome_security_passed(message: Union[CallbackQuery, Message], state,
     )
 
 
-# End Welcome Security
+async def release_security_message(chat_id, user_id, message_id) -> bool:
+    key = f'welcome_security_msg:{chat_id}:{message_id}'
+    async with redis.pipeline(transaction=True) as pipe:
+        _, left = await pipe.srem(key, user_id).scard(key).execute()
+    return left == 0
 
-# Welcomes
-@register(only_groups=True, f='welcome')
-@get_strings_dec('greetings')
-async def welcome_trigger(message: Message, strings):
-    if len(message.new_chat_members) > 1:
-        # FIXME: AllMightRobot doesnt support adding multiple users currently
-        return
-
-    chat_id = message.chat.id
-    user_id = message.new_chat_members[0].id
-
-    if user_id == BOT_ID:
-        return
-
-    if not (db_item := await get_greetings_data(message.chat.id)):
-        db_item = {}
 
-    if 'welcome_disabled' in db_item and db_item['welcome_disabled'] is True:
-        return
+# End Welcome Security
 
-    if 'welcome_security' in db_item and db_item['welcome_security']['enabled']:
-        return
+# Welcomes
+async def welcome_trigger(chat_id: int, joins: list, db_item: dict, strings: dict):
+    message = joins[-1][0]
+    members = [member for _, member in joins]
 
     # Welcome
     if 'note' not in db_item:
@@ -877,27 +955,31 @@ async def welcome_trigger(message: Message, strings):
         }
     reply_to = (message.message_id if 'clean_welcome' in db_item and db_item['clean_welcome']['enabled'] is not False
                 else None)
-    text, kwargs = await t_unparse_note_item(message, db_item['note'], chat_id)
+    text, kwargs = await t_unparse_note_item(message, db_item['note'], chat_id, user=members[0], members=members)
     msg = await send_note(chat_id, text, reply_to=reply_to, **kwargs)
     # Clean welcome
     if 'clean_welcome' in db_item and db_item['clean_welcome']['enabled'] is not False:
         if 'last_msg' in db_item['clean_welcome']:
             with suppress(MessageToDeleteNotFound, MessageCantBeDeleted):
-                if value := redis.get(_clean_welcome.format(chat=chat_id)):
+                if value := await redis.get(_clean_welcome.format(chat=chat_id)):
                     await bot.delete_message(chat_id, value)
-        redis.set(_clean_welcome.format(chat=chat_id), msg.id)
+        await redis.set(_clean_welcome.format(chat=chat_id), msg.id)
 
     # Welcome mute
-    if user_id == BOT_ID:
-        return
     if 'welcome_mute' in db_item and db_item['welcome_mute']['enabled'] is not False:
-        user = await bot.get_chat_member(chat_id, user_id)
-        if 'can_send_messages' not in user or user['can_send_messages'] is True:
-            if not await check_admin_rights(message, chat_id, BOT_ID, ['can_restrict_members']):
-                await message.reply(strings['not_admin_wm'])
-                return
+        users = await asyncio.gather(*[bot.get_chat_member(chat_id, member.id) for member in members])
+        if not (to_mute := [
+            member.id for member, user in zip(members, users)
+            if 'can_send_messages' not in user or user['can_send_messages'] is True
+        ]):
+            return
 
-            await restrict_user(chat_id, user_id, until_date=convert_time(db_item['welcome_mute']['time']))
+        if not await check_admin_rights(message, chat_id, BOT_ID, ['can_restrict_members']):
+            await message.reply(strings['not_admin_wm'])
+            return
+
+        until_date = convert_time(db_item['welcome_mute']['time'])
+        await asyncio.gather(*[restrict_user(chat_id, user_id, until_date=until_date) for user_id in to_mute])
 
 
 # Clean service trigger
@@ -931,6 +1013,17 @@ async def get_greetings_data(chat: int) -> Optional[dict]:
     return await db.greetings.find_one({'chat_id': chat})
 
 
+__indexes__ = {'greetings': [[('chat_id', 1)]]}
+
+
+async def __before_serving__(loop):
+    CAPTCHA_POOL.refill()
+
+
+async def __after_serving__(loop):
+    CAPTCHA_POOL.close()
+
+
 async def __export__(chat_id):
     if greetings := await get_greetings_data(chat_id):
         del greetings['_id']
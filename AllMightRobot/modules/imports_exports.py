@@ -18,7 +18,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import inspect
 import io
+import itertools
+import tempfile
 from datetime import datetime, timedelta
 
 import ujson
@@ -34,7 +37,13 @@ from . import LOADED_MODULES
 from .utils.connections import chat_connection
 from .utils.language import get_strings_dec
 
-VERSION = 5
+# Since version 6 export is a JSON lines file: first line has 'general' section, every next line is a part of
+# modules data ({module_name: data}). Modules with big data (async generator __export__) write it in several lines,
+# every line is passed to their __import__ separately.
+VERSION = 6
+MAX_IMPORT_SIZE = 52428800
+# Parts waiting to be written or imported, bounds memory of big exports
+QUEUE_SIZE = 16
 
 
 # Waiting for import file state
@@ -48,16 +57,15 @@ class ImportFileWait(StatesGroup):
 async def export_chat_data(message, chat, strings):
     chat_id = chat['chat_id']
     key = 'export_lock:' + str(chat_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if await redis.get(key) and message.from_user.id not in OPERATORS:
+        ttl = format_timedelta(timedelta(seconds=await redis.ttl(key)), strings['language_info']['babel'])
         await message.reply(strings['exports_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 7200)
+    await redis.set(key, 1, ex=7200)
 
     msg = await message.reply(strings['started_exporting'])
-    data = {
+    general = {
         'general': {
             'chat_name': chat['chat_title'],
             'chat_id': chat_id,
@@ -66,17 +74,43 @@ async def export_chat_data(message, chat, strings):
         }
     }
 
-    for module in [m for m in LOADED_MODULES if hasattr(m, '__export__')]:
-        await asyncio.sleep(0)  # Switch to other events before continue
-        if k := await module.__export__(chat_id):
-            data.update(k)
+    with tempfile.TemporaryFile() as raw:
+        f = io.TextIOWrapper(raw, encoding='utf-8')
+        f.write(ujson.dumps(general) + '\n')
+        await export_sections(chat_id, lambda part: f.write(ujson.dumps(part) + '\n'))
+        f.detach()
+        raw.seek(0)
 
-    jfile = InputFile(io.StringIO(ujson.dumps(data, indent=2)), filename=f'{chat_id}_export.json')
-    text = strings['export_done'].format(chat_name=chat['chat_title'])
-    await message.answer_document(jfile, text, reply=message.message_id)
+        jfile = InputFile(raw, filename=f'{chat_id}_export.jsonl')
+        text = strings['export_done'].format(chat_name=chat['chat_title'])
+        await message.answer_document(jfile, text, reply=message.message_id)
     await msg.delete()
 
 
+async def export_sections(chat_id: int, write):
+    """Runs all modules exports concurrently, parts are written as soon as they are ready"""
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async def export_module(module):
+        if inspect.isasyncgenfunction(module.__export__):
+            async for part in module.__export__(chat_id):
+                await queue.put(part)
+        elif part := await module.__export__(chat_id):
+            await queue.put(part)
+
+    async def export_all():
+        try:
+            await asyncio.gather(*[export_module(m) for m in LOADED_MODULES if hasattr(m, '__export__')])
+        finally:
+            await queue.put(None)
+
+    async def writer():
+        while (part := await queue.get()) is not None:
+            write(part)
+
+    await asyncio.gather(export_all(), writer())
+
+
 @register(cmds='import', user_admin=True)
 @get_strings_dec('imports_exports')
 async def import_reply(message, strings):
@@ -107,49 +141,90 @@ async def import_state(message, state=None, **kwargs):
 async def import_fun(message, document, chat, strings):
     chat_id = chat['chat_id']
     key = 'import_lock:' + str(chat_id)
-    if redis.get(key) and message.from_user.id not in OPERATORS:
-        ttl = format_timedelta(timedelta(seconds=redis.ttl(key)), strings['language_info']['babel'])
+    if await redis.get(key) and message.from_user.id not in OPERATORS:
+        ttl = format_timedelta(timedelta(seconds=await redis.ttl(key)), strings['language_info']['babel'])
         await message.reply(strings['imports_locked'] % ttl)
         return
 
-    redis.set(key, 1)
-    redis.expire(key, 7200)
+    await redis.set(key, 1, ex=7200)
 
     msg = await message.reply(strings['started_importing'])
-    if document['file_size'] > 52428800:
+    if document['file_size'] > MAX_IMPORT_SIZE:
         await message.reply(strings['big_file'])
         return
-    data = await bot.download_file_by_id(document.file_id, io.BytesIO())
-    try:
-        data = ujson.load(data)
-    except ValueError:
-        return await message.reply(strings['invalid_file'])
-
-    if 'general' not in data:
-        await message.reply(strings['bad_file'])
-        return
 
-    file_version = data['general']['version']
+    with tempfile.TemporaryFile() as raw:
+        await bot.download_file_by_id(document.file_id, raw)
+        raw.seek(0)
+        f = io.TextIOWrapper(raw, encoding='utf-8')
+
+        try:
+            general = ujson.loads(f.readline())
+            if 'general' not in general:
+                raise ValueError
+            parts = itertools.chain([general], (ujson.loads(line) for line in f if line.strip()))
+        except ValueError:
+            # Files before version 6 are one JSON document
+            f.seek(0)
+            try:
+                general = ujson.load(f)
+            except ValueError:
+                return await message.reply(strings['invalid_file'])
+            parts = iter([general])
+
+        if 'general' not in general:
+            await message.reply(strings['bad_file'])
+            return
 
-    if file_version > VERSION:
-        await message.reply(strings['file_version_so_new'])
-        return
+        file_version = general['general']['version']
 
-    imported = []
-    for module in [m for m in LOADED_MODULES if hasattr(m, '__import__')]:
-        module_name = module.__name__.replace('AllMightRobot.modules.', '')
-        if module_name not in data:
-            continue
-        if not data[module_name]:
-            continue
+        if file_version > VERSION:
+            await message.reply(strings['file_version_so_new'])
+            return
 
-        imported.append(module_name)
-        await asyncio.sleep(0)  # Switch to other events before continue
-        await module.__import__(chat_id, data[module_name])
+        try:
+            await import_sections(chat_id, parts)
+        except ValueError:
+            return await message.reply(strings['invalid_file'])
 
     await msg.edit_text(strings['import_done'])
 
 
+async def import_sections(chat_id: int, parts):
+    """Passes parts to modules as they are parsed, modules import concurrently, parts of one module in order"""
+    modules = {
+        m.__name__.replace('AllMightRobot.modules.', ''): m for m in LOADED_MODULES if hasattr(m, '__import__')
+    }
+    queues = {}
+    workers = []
+
+    async def import_module(module, queue):
+        # Queue is drained even after a failure, so parser never waits for a dead worker
+        error = None
+        while (data := await queue.get()) is not None:
+            if error is None:
+                try:
+                    await module.__import__(chat_id, data)
+                except Exception as err:  # noqa
+                    error = err
+        if error:
+            raise error
+
+    try:
+        for part in parts:
+            for module_name, data in part.items():
+                if module_name not in modules or not data:
+                    continue
+
+                if (queue := queues.get(module_name)) is None:
+                    queue = queues[module_name] = asyncio.Queue(maxsize=QUEUE_SIZE)
+                    workers.append(asyncio.ensure_future(import_module(modules[module_name], queue)))
+                await queue.put(data)
+    finally:
+        for queue in queues.values():
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
 
 __mod_name__ = "Backups"
 
@@ -157,8 +232,8 @@ __help__ = """
 Sometimes you want to see all of your data in your chats or you want to copy your data to another chats or you even want to shift bots, in all these cases imports/exports for you!
 
 <b>Available commands:</b>
-- /export: Export chat's data to JSON file
-- /import: Import JSON file to chat
+- /export: Export chat's data to JSON lines file
+- /import: Import exported file to chat
 
 <b>Notes:</b> Exporting / importing avaible every 2 hours to prevent flooding.
 """
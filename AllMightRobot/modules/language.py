@@ -120,6 +120,9 @@ async def __stats__():
     return f"* <code>{len(LANGUAGES)}</code> languages loaded.\n"
 
 
+__indexes__ = {'lang': [[('chat_id', 1)]]}
+
+
 async def __export__(chat_id):
     lang = await get_chat_lang_info(chat_id)
 
@@ -475,7 +475,7 @@ async def note_start(message, strings, regexp=None, **kwargs):
 @get_strings_dec('connections')
 async def btn_note_start_state(message, strings):
     key = 'btn_note_start_state:' + str(message.from_user.id)
-    if not (cached := redis.hgetall(key)):
+    if not (cached := await redis.hgetall(key)):
         return
 
     chat_id = int(cached['chat_id'])
@@ -485,7 +485,7 @@ async def btn_note_start_state(message, strings):
     note = await db.notes.find_one({'chat_id': chat_id, 'names': {'$in': [note_name]}})
     await get_note(message, db_item=note, chat_id=chat_id, send_id=user_id, rpl_id=None)
 
-    redis.delete(key)
+    await redis.delete(key)
 
 
 @register(cmds='privatenotes', is_admin=True)
@@ -570,18 +570,31 @@ async def __stats__():
     return text
 
 
+__indexes__ = {
+    'notes': [[('chat_id', 1), ('names', 1)]],
+    'privatenotes': [[('chat_id', 1)]],
+    'clean_notes': [[('chat_id', 1)]]
+}
+
+
+EXPORT_CHUNK_SIZE = 100
+
+
 async def __export__(chat_id):
+    # Yields notes in parts, so chats with many notes are never fully in memory
     data = []
-    notes = await db.notes.find({'chat_id': chat_id}).sort("names", 1).to_list(length=300)
-    for note in notes:
-        del note['_id']
-        del note['chat_id']
+    async for note in db.notes.find({'chat_id': chat_id}, {'_id': 0, 'chat_id': 0}).sort("names", 1):
         note['created_date'] = str(note['created_date'])
         if 'edited_date' in note:
             note['edited_date'] = str(note['edited_date'])
         data.append(note)
 
-    return {'notes': data}
+        if len(data) == EXPORT_CHUNK_SIZE:
+            yield {'notes': data}
+            data = []
+
+    if data:
+        yield {'notes': data}
 
 
 ALLOWED_COLUMNS_NOTES = ALLOWED_COLUMNS + [
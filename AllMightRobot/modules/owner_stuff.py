@@ -29,6 +29,8 @@ from AllMightRobot.modules import LOADED_MODULES
 from AllMightRobot.services.mongo import db, mongodb
 from AllMightRobot.services.redis import redis
 from AllMightRobot.services.telethon import tbot
+from AllMightRobot.utils.indexes import QUERY_SHAPES
+from AllMightRobot.utils.updates_stream import ROLE, get_workers_stats
 from .utils.covert import convert_size
 from .utils.language import get_strings_dec
 from .utils.message import need_args_dec
@@ -128,7 +130,7 @@ async def check_message_for_smartbroadcast(message):
 
 @register(cmds="purgecache", is_owner=True)
 async def purge_caches(message):
-    redis.flushdb()
+    await redis.flushdb()
     await message.reply("Redis cache was cleaned.")
 
 
@@ -194,6 +196,44 @@ async def stats(message):
     await message.reply(text)
 
 
+@register(cmds="workers", is_op=True)
+async def workers_stats(message):
+    if ROLE == 'single':
+        await message.reply("Updates stream isn't used, the bot runs as a single process.")
+        return
+
+    data = await get_workers_stats()
+    text = "<b>Workers:</b>\n"
+    for worker_id, worker in data['workers'].items():
+        text += "* <code>{}</code>: processed <code>{}</code>, errors <code>{}</code>, ".format(
+            worker_id, worker['processed'], worker['errors']
+        )
+        text += "lag <code>{:.1f}s</code>\n".format(worker['lag'])
+    if not data['workers']:
+        text += "* No alive workers!\n"
+
+    text += "\n<b>Partitions:</b>\n"
+    for partition, info in data['partitions'].items():
+        text += "* <code>{}</code>: length <code>{}</code>, pending <code>{}</code>, ".format(
+            partition, info['length'], info['pending']
+        )
+        text += "not delivered <code>{}</code>\n".format(info['lag'])
+
+    await message.reply(text)
+
+
+@register(cmds="unindexed", is_op=True)
+async def unindexed_queries(message):
+    if not (shapes := QUERY_SHAPES.top()):
+        await message.reply("No queries without indexes were seen.")
+        return
+
+    text = "<b>Queries without indexes:</b>\n"
+    for (collection, shape), count in shapes:
+        text += "* <code>{}</code> by <code>{}</code>: {} times\n".format(collection, ', '.join(shape), count)
+    await message.reply(text)
+
+
 async def __stats__():
     text = ""
     text += "* Database structure version <code>{}</code>\n".format(
@@ -211,7 +251,7 @@ async def __stats__():
             convert_size(536870912 - local_db['storageSize'])
         )
 
-    text += "* <code>{}</code> total keys in Redis database\n".format(len(redis.keys()))
+    text += "* <code>{}</code> total keys in Redis database\n".format(await redis.dbsize())
     text += "* <code>{}</code> total commands registred, in <code>{}</code> modules\n".format(
         len(REGISTRED_COMMANDS), len(LOADED_MODULES))
     return text
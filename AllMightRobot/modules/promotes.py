@@ -21,7 +21,7 @@ from aiogram.utils.exceptions import ChatAdminRequired
 from .utils.connections import chat_connection
 from .utils.language import get_strings_dec
 from .utils.user_details import (get_user_dec, get_user_and_text_dec,
-                                 get_user_link, get_admins_rights)
+                                 get_user_link, drop_admins_cache)
 
 from telethon.errors import AdminRankEmojiNotAllowedError
 
@@ -68,7 +68,7 @@ async def promote(message, chat, user, args, strings):
         return await message.reply(strings['cant_get_user'])
     except AdminRankEmojiNotAllowedError:
         return await message.reply(strings['emoji_not_allowed'])
-    await get_admins_rights(chat_id, force_update=True)  # Reset a cache
+    await drop_admins_cache(chat_id)
     await message.reply(text)
 
 
@@ -89,7 +89,7 @@ async def demote(message, chat, user, strings):
     except ChatAdminRequired:
         return await message.reply(strings['demote_failed'])
 
-    await get_admins_rights(chat_id, force_update=True)  # Reset a cache
+    await drop_admins_cache(chat_id)
     await message.reply(strings['demote_success'].format(
         user=await get_user_link(user['user_id']),
         chat_name=chat['chat_title']
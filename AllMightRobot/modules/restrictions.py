@@ -70,9 +70,8 @@ async def kick_user_cmd(message, chat, user, args, strings):
     silent = False
     if get_cmd(message) == 'skick':
         silent = True
-        key = 'leave_silent:' + str(chat_id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        key = f'leave_silent:{chat_id}:{user_id}'
+        await redis.set(key, user_id, ex=30)
         text += strings['purge']
 
     await kick_user(chat_id, user_id)
@@ -143,9 +142,8 @@ async def mute_user_cmd(message, chat, user, args, strings):
     silent = False
     if curr_cmd in ('smute', 'stmute'):
         silent = True
-        key = 'leave_silent:' + str(chat_id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        key = f'leave_silent:{chat_id}:{user_id}'
+        await redis.set(key, user_id, ex=30)
         text += strings['purge']
 
     await mute_user(chat_id, user_id, until_date=until_date)
@@ -247,9 +245,8 @@ async def ban_user_cmd(message, chat, user, args, strings):
     silent = False
     if curr_cmd in ('sban', 'stban'):
         silent = True
-        key = 'leave_silent:' + str(chat_id)
-        redis.set(key, user_id)
-        redis.expire(key, 30)
+        key = f'leave_silent:{chat_id}:{user_id}'
+        await redis.set(key, user_id, ex=30)
         text += strings['purge']
 
     await ban_user(chat_id, user_id, until_date=until_date)
@@ -301,7 +298,8 @@ async def leave_silent(message):
     if not message.from_user.id == BOT_ID:
         return
 
-    if redis.get('leave_silent:' + str(message.chat.id)) == message.left_chat_member.id:
+    # Key per user, so several silent kicks at once are all hidden
+    if await redis.delete(f'leave_silent:{message.chat.id}:{message.left_chat_member.id}'):
         await message.delete()
 
 
@@ -109,6 +109,9 @@ async def rules_btn(message, strings):
     await send_note(user_id, text, **kwargs)
 
 
+__indexes__ = {'rules': [[('chat_id', 1)]]}
+
+
 async def __export__(chat_id):
     rules = await db.rules.find_one({'chat_id': chat_id})
     if rules:
@@ -17,10 +17,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import datetime
 import html
+from collections import OrderedDict
+from contextlib import suppress
 
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import ChatMemberUpdated
+from pymongo import DeleteMany, UpdateOne
+from pymongo.errors import PyMongoError
 
 from AllMightRobot.decorator import register
 from AllMightRobot.modules import LOADED_MODULES
@@ -29,116 +35,215 @@ from AllMightRobot.utils.logger import log
 from .utils.connections import chat_connection
 from .utils.disable import disableable_dec
 from .utils.language import get_strings_dec
-from .utils.user_details import get_user_dec, get_user_link, is_user_admin, get_admins_rights
+from .utils.user_details import get_user_dec, get_user_link, is_user_admin, get_admins_rights, drop_admins_cache
 from AllMightRobot import dp
 
 
-async def update_users_handler(message):
-    chat_id = message.chat.id
-
-    # Update chat
-    new_chat = message.chat
-    if not new_chat.type == 'private':
-
-        old_chat = await db.chat_list.find_one({'chat_id': chat_id})
-
-        if not hasattr(new_chat, 'username'):
-            chatnick = None
-        else:
-            chatnick = new_chat.username
-
-        if old_chat and 'first_detected_date' in old_chat:
-            first_detected_date = old_chat['first_detected_date']
-        else:
-            first_detected_date = datetime.datetime.now()
-
+# Flush tracked users and chats every N seconds
+FLUSH_INTERVAL = 5
+# Flush right away if so many users and chats are pending
+MAX_PENDING = 5000
+# While the database is down pending users and chats are kept up to this, newer observations are dropped
+MAX_BUFFERED = MAX_PENDING * 4
+# Max seconds between retries of failed flushes
+MAX_FLUSH_BACKOFF = 300
+# How many last seen users and chats states we remember to skip writes of unchanged data
+MAX_FINGERPRINTS = 100000
+# chat_member updates with these statuses change admins list
+ADMIN_STATUSES = {'administrator', 'creator'}
+
+
+class UsersTracker:
+    """Write-behind tracker of users and chats metadata.
+
+    Observations are coalesced in memory and flushed periodically in one bulk write,
+    users and chats whose data wasn't changed since the last observation are skipped.
+    """
+
+    def __init__(self):
+        self.chats = {}
+        self.users = {}
+        self.fingerprints = OrderedDict()
+        self.dropped = 0
+        self._lock = asyncio.Lock()
+        self._flush_needed = None
+
+    @property
+    def pending(self) -> int:
+        return len(self.chats) + len(self.users)
+
+    def _is_changed(self, key, fingerprint) -> bool:
+        if self.fingerprints.get(key) == fingerprint:
+            self.fingerprints.move_to_end(key)
+            return False
+
+        self.fingerprints[key] = fingerprint
+        self.fingerprints.move_to_end(key)
+        while len(self.fingerprints) > MAX_FINGERPRINTS:
+            self.fingerprints.popitem(last=False)
+        return True
+
+    def observe_chat(self, chat):
         chat_new = {
-            "chat_id": chat_id,
-            "chat_title": html.escape(new_chat.title, quote=False),
-            "chat_nick": chatnick,
-            "type": new_chat.type,
-            "first_detected_date": first_detected_date
-        }
-
-        # Check on old chat in DB with same username
-        find_old_chat = {
-            'chat_nick': chat_new['chat_nick'],
-            'chat_id': {'$ne': chat_new['chat_id']}
+            "chat_id": chat.id,
+            "chat_title": html.escape(chat.title, quote=False),
+            "chat_nick": getattr(chat, 'username', None),
+            "type": chat.type
         }
-        if chat_new['chat_nick'] and (check := await db.chat_list.find_one(find_old_chat)):
-            await db.chat_list.delete_one({'_id': check['_id']})
-            log.info(
-                f"Found chat ({check['chat_id']}) with same username as ({chat_new['chat_id']}), old chat was deleted.")
-
-        await db.chat_list.update_one({'chat_id': chat_id}, {"$set": chat_new}, upsert=True)
-
-        log.debug(f"Users: Chat {chat_id} updated")
-
-    # Update users
-    await update_user(chat_id, message.from_user)
-
-    if "reply_to_message" in message and \
-            hasattr(message.reply_to_message.from_user, 'chat_id') and \
-            message.reply_to_message.from_user.chat_id:
-        await update_user(chat_id, message.reply_to_message.from_user)
-
-    if "forward_from" in message:
-        await update_user(chat_id, message.forward_from)
-
-
-async def update_user(chat_id, new_user):
-    old_user = await db.user_list.find_one({'user_id': new_user.id})
-
-    new_chat = [chat_id]
 
-    if old_user and 'chats' in old_user:
-        if old_user['chats']:
-            new_chat = old_user['chats']
-        if not new_chat or chat_id not in new_chat:
-            new_chat.append(chat_id)
+        if self._is_changed(('chat', chat.id), tuple(chat_new.values())):
+            self.chats[chat.id] = chat_new
 
-    if old_user and 'first_detected_date' in old_user:
-        first_detected_date = old_user['first_detected_date']
-    else:
-        first_detected_date = datetime.datetime.now()
-
-    if new_user.username:
-        username = new_user.username.lower()
-    else:
-        username = None
-
-    if hasattr(new_user, 'last_name') and new_user.last_name:
-        last_name = html.escape(new_user.last_name, quote=False)
-    else:
-        last_name = None
-
-    first_name = html.escape(new_user.first_name, quote=False)
-
-    user_new = {
-        'user_id': new_user.id,
-        'first_name': first_name,
-        'last_name': last_name,
-        'username': username,
-        'user_lang': new_user.language_code,
-        'chats': new_chat,
-        'first_detected_date': first_detected_date
-    }
-
-    # Check on old user in DB with same username
-    find_old_user = {
-        'username': user_new['username'],
-        'user_id': {'$ne': user_new['user_id']}
-    }
-    if user_new['username'] and (check := await db.user_list.find_one(find_old_user)):
-        await db.user_list.delete_one({'_id': check['_id']})
-        log.info(
-            f"Found user ({check['user_id']}) with same username as ({user_new['user_id']}), old user was deleted.")
-
-    await db.user_list.update_one({'user_id': new_user.id}, {"$set": user_new}, upsert=True)
+    def observe_user(self, chat_id, user):
+        if hasattr(user, 'last_name') and user.last_name:
+            last_name = html.escape(user.last_name, quote=False)
+        else:
+            last_name = None
+
+        user_new = {
+            'user_id': user.id,
+            'first_name': html.escape(user.first_name, quote=False),
+            'last_name': last_name,
+            'username': user.username.lower() if user.username else None,
+            'user_lang': user.language_code
+        }
 
-    log.debug(f"Users: User {new_user.id} updated")
+        if not self._is_changed(('user', user.id, chat_id), tuple(user_new.values())):
+            return
 
-    return user_new
+        if user.id in self.users:
+            self.users[user.id][0].update(user_new)
+            self.users[user.id][1].add(chat_id)
+        else:
+            self.users[user.id] = (user_new, {chat_id})
+
+    async def observe(self, message):
+        if self.pending >= MAX_BUFFERED:
+            # Skipped before fingerprinting, so these will be observed again after the database is back
+            self.dropped += 1
+            return
+
+        chat_id = message.chat.id
+
+        if not message.chat.type == 'private':
+            self.observe_chat(message.chat)
+
+        self.observe_user(chat_id, message.from_user)
+
+        if "reply_to_message" in message and \
+                hasattr(message.reply_to_message.from_user, 'chat_id') and \
+                message.reply_to_message.from_user.chat_id:
+            self.observe_user(chat_id, message.reply_to_message.from_user)
+
+        if "forward_from" in message:
+            self.observe_user(chat_id, message.forward_from)
+
+        # Flushed by the run loop, message handling never waits for the database
+        if self.pending >= MAX_PENDING and self._flush_needed:
+            self._flush_needed.set()
+
+    async def flush(self) -> bool:
+        """Returns False if something wasn't written, it's kept to be written on the next flush"""
+        async with self._lock:
+            chats, self.chats = self.chats, {}
+            users, self.users = self.users, {}
+            success = True
+
+            now = datetime.datetime.now()
+            if chats:
+                requests = []
+                for chat_id, chat_new in chats.items():
+                    # Chats with same username as this one are outdated
+                    if chat_new['chat_nick']:
+                        requests.append(DeleteMany({'chat_nick': chat_new['chat_nick'], 'chat_id': {'$ne': chat_id}}))
+                    requests.append(UpdateOne(
+                        {'chat_id': chat_id},
+                        {'$set': chat_new, '$setOnInsert': {'first_detected_date': now}},
+                        upsert=True
+                    ))
+                if not await self._bulk_write(db.chat_list, requests):
+                    self._requeue_chats(chats)
+                    success = False
+
+            if users:
+                requests = []
+                for user_id, (user_new, user_chats) in users.items():
+                    # Users with same username as this one are outdated
+                    if user_new['username']:
+                        requests.append(DeleteMany({'username': user_new['username'], 'user_id': {'$ne': user_id}}))
+                    requests.append(UpdateOne(
+                        {'user_id': user_id},
+                        {
+                            '$set': user_new,
+                            '$setOnInsert': {'first_detected_date': now},
+                            '$addToSet': {'chats': {'$each': list(user_chats)}}
+                        },
+                        upsert=True
+                    ))
+                if not await self._bulk_write(db.user_list, requests):
+                    self._requeue_users(users)
+                    success = False
+
+            if success:
+                log.debug(f"Users: flushed {len(users)} users and {len(chats)} chats")
+            return success
+
+    async def _bulk_write(self, collection, requests) -> bool:
+        try:
+            await collection.bulk_write(requests)
+        except PyMongoError:
+            log.error(f"Users: failed to update {collection.name}", exc_info=True)
+            # We can't know which ones were written, so let all entities be written again
+            self.fingerprints.clear()
+            return False
+        return True
+
+    def _requeue_chats(self, chats):
+        # Observations made during the failed write are newer, keep them
+        for chat_id, chat_new in chats.items():
+            if chat_id in self.chats:
+                continue
+            if self.pending >= MAX_BUFFERED:
+                self.dropped += 1
+                continue
+            self.chats[chat_id] = chat_new
+
+    def _requeue_users(self, users):
+        for user_id, (user_new, user_chats) in users.items():
+            if user_id in self.users:
+                self.users[user_id][1].update(user_chats)
+            elif self.pending >= MAX_BUFFERED:
+                self.dropped += 1
+            else:
+                self.users[user_id] = (user_new, user_chats)
+
+    async def run(self):
+        # Created here to bind to the running loop
+        self._flush_needed = asyncio.Event()
+        delay = FLUSH_INTERVAL
+        while True:
+            # Full buffer doesn't cut the backoff short
+            if delay == FLUSH_INTERVAL:
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._flush_needed.wait(), delay)
+            else:
+                await asyncio.sleep(delay)
+            self._flush_needed.clear()
+
+            try:
+                success = await self.flush()
+            except Exception:
+                log.error("Users: failed to flush tracked users", exc_info=True)
+                success = False
+
+            if self.dropped:
+                log.warning(f"Users: buffer is full, dropped {self.dropped} observations")
+                self.dropped = 0
+
+            delay = FLUSH_INTERVAL if success else min(delay * 2, MAX_FLUSH_BACKOFF)
+
+
+TRACKER = UsersTracker()
 
 
 @register(cmds="info")
@@ -231,11 +336,32 @@ async def adminlist(message, chat, strings):
 
 class SaveUser(BaseMiddleware):
     async def on_process_message(self, message, data):
-        await update_users_handler(message)
+        await TRACKER.observe(message)
+
+
+class AdminsCacheUpdater(BaseMiddleware):
+    """Drops admins cache of the chat when somebody becomes an admin, stops being one or gets other rights"""
+
+    @staticmethod
+    async def check(update: ChatMemberUpdated):
+        if {update.old_chat_member.status, update.new_chat_member.status} & ADMIN_STATUSES:
+            await drop_admins_cache(update.chat.id)
+
+    async def on_pre_process_chat_member(self, update: ChatMemberUpdated, data):
+        await self.check(update)
+
+    async def on_pre_process_my_chat_member(self, update: ChatMemberUpdated, data):
+        await self.check(update)
 
 
 async def __before_serving__(loop):
     dp.middleware.setup(SaveUser())
+    dp.middleware.setup(AdminsCacheUpdater())
+    loop.create_task(TRACKER.run())
+
+
+async def __after_serving__(loop):
+    await TRACKER.flush()
 
 
 async def __stats__():
@@ -254,3 +380,9 @@ async def __stats__():
     )
 
     return text
+
+
+__indexes__ = {
+    'user_list': [[('user_id', 1)], [('username', 1)]],
+    'chat_list': [[('chat_id', 1)], [('chat_nick', 1)]]
+}
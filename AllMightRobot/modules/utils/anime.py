@@ -13,6 +13,120 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import json
+import time
+from typing import Optional
+
+from AllMightRobot.services.http import get_session
+from AllMightRobot.services.redis import redis
+from AllMightRobot.utils.cached import L1Cache
+from AllMightRobot.utils.logger import log
+
+ANILIST_URL = 'https://graphql.anilist.co'
+
+# Payloads are served from cache without any requests for FRESH_TTL, then served as is while refreshed in background
+# until STALE_TTL. Airing data is valid only until the next episode airs.
+FRESH_TTL = 24 * 60 * 60
+STALE_TTL = 7 * 24 * 60 * 60
+NOT_FOUND_TTL = 60 * 60
+
+SEARCH_KEY = 'anilist:search:{kind}:{search}'
+PAYLOAD_KEY = 'anilist:{kind}:{id}'
+
+# In-process copy of entries, other processes refresh only Redis so it is kept short
+ANILIST_CACHE = L1Cache(maxsize=1024, ttl=5 * 60)
+# Identical requests and refreshes which are running right now are shared
+_ANILIST_INFLIGHT = {}
+
+
+def _single_flight(key: str, coro):
+    if (future := _ANILIST_INFLIGHT.get(key)) is None:
+        future = _ANILIST_INFLIGHT[key] = asyncio.ensure_future(coro)
+        future.add_done_callback(lambda _: _ANILIST_INFLIGHT.pop(key, None))
+    else:
+        coro.close()
+    return future
+
+
+async def anilist(query: str, variables: dict) -> dict:
+    """Returns 'data' of AniList GraphQL response"""
+    key = query + json.dumps(variables, sort_keys=True)
+    return await asyncio.shield(_single_flight(key, _fetch_anilist(query, variables)))
+
+
+async def _fetch_anilist(query: str, variables: dict) -> dict:
+    async with get_session().post(ANILIST_URL, json={'query': query, 'variables': variables}) as response:
+        # Not found is answered with 404 and data too
+        return (await response.json(content_type=None))['data']
+
+
+async def anilist_lookup(kind: str, search: str) -> Optional[dict]:
+    """
+    Returns Media or Character payload of ANILIST_KINDS query for the search, None if nothing found.
+
+    >>> media = await anilist_lookup('anime', 'Boku no Hero')
+    """
+    search_key = SEARCH_KEY.format(kind=kind, search=' '.join(search.lower().split()))
+    if (entry := ANILIST_CACHE.get(search_key)) is None:
+        entry = await _load_entry(kind, search_key)
+
+    now = time.time()
+    if entry is None or entry['expires_at'] <= now:
+        entry = await asyncio.shield(_single_flight(search_key, _refresh_entry(kind, search, search_key)))
+    elif entry['fresh_until'] <= now:
+        # Stale while revalidate
+        _single_flight(search_key, _refresh_entry(kind, search, search_key))
+
+    return entry['data']
+
+
+async def _load_entry(kind: str, search_key: str) -> Optional[dict]:
+    if not (media_id := await redis.get(search_key)):
+        return None
+    if media_id == '0':
+        entry = {'data': None, 'fresh_until': time.time() + NOT_FOUND_TTL, 'expires_at': time.time() + NOT_FOUND_TTL}
+    elif raw := await redis.get(PAYLOAD_KEY.format(kind=kind, id=media_id)):
+        entry = json.loads(raw)
+    else:
+        return None
+
+    ANILIST_CACHE.set(search_key, entry)
+    return entry
+
+
+async def _refresh_entry(kind: str, search: str, search_key: str) -> dict:
+    query, field, variable = ANILIST_KINDS[kind]
+    try:
+        payload = (await anilist(query, {variable: search})).get(field)
+    except Exception:  # noqa
+        if entry := ANILIST_CACHE.get(search_key):
+            # Stale data is better than nothing while AniList is down
+            log.warning(f'AniList: failed to refresh {search_key}', exc_info=True)
+            return entry
+        raise
+
+    now = time.time()
+    if not payload:
+        entry = {'data': None, 'fresh_until': now + NOT_FOUND_TTL, 'expires_at': now + NOT_FOUND_TTL}
+        await redis.set(search_key, '0', ex=NOT_FOUND_TTL)
+    else:
+        fresh_until, expires_at = now + FRESH_TTL, now + STALE_TTL
+        if kind == 'airing' and (next_episode := payload.get('nextAiringEpisode')):
+            # Countdown and episode number are wrong once the episode aired
+            expires_at = next_episode['airingAt']
+            fresh_until = min(fresh_until, expires_at)
+
+        entry = {'data': payload, 'fresh_until': fresh_until, 'expires_at': expires_at}
+        ttl = max(int(expires_at - now), 1)
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(PAYLOAD_KEY.format(kind=kind, id=payload['id']), json.dumps(entry), ex=ttl)
+            pipe.set(search_key, payload['id'], ex=ttl)
+            await pipe.execute()
+
+    ANILIST_CACHE.set(search_key, entry)
+    return entry
+
 
 def shorten(description, info='anilist.co'):
     ms_g = ""
@@ -156,3 +270,12 @@ query ($id: Int,$search: String) {
       }
     }
 """
+
+
+# kind: (query, payload field, search variable)
+ANILIST_KINDS = {
+    'airing': (airing_query, 'Media', 'search'),
+    'anime': (anime_query, 'Media', 'search'),
+    'manga': (manga_query, 'Media', 'search'),
+    'character': (character_query, 'Character', 'query')
+}
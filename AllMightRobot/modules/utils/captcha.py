@@ -0,0 +1,116 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import io
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+from AllMightRobot.stuff.fonts import ALL_FONTS
+from AllMightRobot.utils.logger import log
+
+# Ready captchas kept in memory, refilled in background when less than half is left
+POOL_SIZE = 64
+WORKERS = 2
+
+
+def render_captcha(number: str) -> bytes:
+    """Runs in the worker process, returns PNG image"""
+    # Pulls in PIL, imported on first use to speed up startup
+    from captcha.image import ImageCaptcha
+
+    captcha = ImageCaptcha(fonts=ALL_FONTS, width=200, height=100).generate_image(number)
+    img = io.BytesIO()
+    captcha.save(img, 'PNG')
+    return img.getvalue()
+
+
+def random_number() -> str:
+    return str(random.randint(10001, 99999))
+
+
+class CaptchaPool:
+    """Ring buffer of pre-rendered captchas, rendering happens in a process pool off the event loop"""
+
+    def __init__(self, size: int = POOL_SIZE, workers: int = WORKERS):
+        self.size = size
+        self.workers = workers
+        self.buffer = deque(maxlen=size)
+        self._executor = None
+        self._refill_task = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def _render_png(self, number: str) -> bytes:
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                return await asyncio.get_event_loop().run_in_executor(executor, render_captcha, number)
+            except BrokenProcessPool:
+                # Worker was killed, e.g. by OOM killer. The pool is unusable, so start a new one
+                log.warning('Captcha: process pool is broken, restarting it')
+                if self._executor is executor:
+                    executor.shutdown(wait=False)
+                    self._executor = None
+                if attempt:
+                    raise
+
+    async def render(self, number: Optional[str] = None) -> Tuple[io.BytesIO, str]:
+        """Renders the captcha right now, for a given number"""
+        number = number or random_number()
+        png = await self._render_png(number)
+        return io.BytesIO(png), number
+
+    async def get(self) -> Tuple[io.BytesIO, str]:
+        if len(self.buffer) <= self.size // 2:
+            self.refill()
+        if not self.buffer:
+            # Buffer is drained by a raid, render this one directly
+            return await self.render()
+
+        number, png = self.buffer.popleft()
+        return io.BytesIO(png), number
+
+    def refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    async def _refill(self):
+        try:
+            while (missing := self.size - len(self.buffer)) > 0:
+                numbers = [random_number() for _ in range(min(missing, self.workers))]
+                images = await asyncio.gather(*[self._render_png(number) for number in numbers])
+                self.buffer.extend(zip(numbers, images))
+        except Exception:  # noqa
+            log.error('Captcha: failed to refill the pool', exc_info=True)
+
+    def close(self):
+        if self._refill_task:
+            self._refill_task.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+CAPTCHA_POOL = CaptchaPool()
@@ -19,29 +19,22 @@ from aiogram.utils.exceptions import Unauthorized
 
 from AllMightRobot.modules.utils.user_details import is_user_admin
 from AllMightRobot.services.mongo import db
-from AllMightRobot.services.redis import redis
 from AllMightRobot.utils.cached import cached
+from AllMightRobot.utils.update_context import memoize
 
 async def get_connected_chat(message, admin=False, only_groups=False, from_id=None, command=None):
     # admin - Require admin rights in connected chat
     # only_in_groups - disable command when bot's pm not connected to any chat
     real_chat_id = message.chat.id
     user_id = from_id or message.from_user.id
-    key = 'connection_cache_' + str(user_id)
 
     if not message.chat.type == 'private':
-        _chat = await db.chat_list.find_one({'chat_id': real_chat_id})
+        _chat = await memoize(('chat', real_chat_id), db.chat_list.find_one, {'chat_id': real_chat_id})
         chat_title = _chat['chat_title'] if _chat is not None else message.chat.title
         # On some strange cases such as Database is fresh or new ; it doesn't contain chat data
         # Only to "handle" the error, we do the above workaround - getting chat title from the update
         return {'status': 'chat', 'chat_id': real_chat_id, 'chat_title': chat_title}
 
-    # Cached
-    if cached := redis.hgetall(key):
-        cached['status'] = True
-        cached['chat_id'] = int(cached['chat_id'])
-        # return cached
-
     # if pm and not connected
     if not (connected := await get_connection_data(user_id)) or 'chat_id' not in connected:
         if only_groups:
@@ -53,11 +46,11 @@ async def get_connected_chat(message, admin=False, only_groups=False, from_id=No
 
     # Get chats where user was detected and check if user in connected chat
     # TODO: Really get the user and check on banned
-    user_chats = (await db.user_list.find_one({'user_id': user_id}))['chats']
+    user_chats = (await memoize(('user', user_id), db.user_list.find_one, {'user_id': user_id}))['chats']
     if chat_id not in user_chats:
         return {'status': None, 'err_msg': 'not_in_chat'}
 
-    chat_title = (await db.chat_list.find_one({'chat_id': chat_id}))['chat_title']
+    chat_title = (await memoize(('chat', chat_id), db.chat_list.find_one, {'chat_id': chat_id}))['chat_title']
 
     # Admin rights check if admin=True
     try:
@@ -77,24 +70,18 @@ async def get_connected_chat(message, admin=False, only_groups=False, from_id=No
             return {'status': 'private', 'chat_id': user_id, 'chat_title': 'Local chat'}
 
     # Check on /allowusersconnect enabled
-    if settings := await db.chat_connection_settings.find_one({'chat_id': chat_id}):
+    if settings := await memoize(
+        ('connection_settings', chat_id), db.chat_connection_settings.find_one, {'chat_id': chat_id}
+    ):
         if 'allow_users_connect' in settings and settings['allow_users_connect'] is False and not user_admin:
             return {'status': None, 'err_msg': 'conn_not_allowed'}
 
-    data = {
+    return {
         'status': True,
         'chat_id': chat_id,
         'chat_title': chat_title
     }
 
-    # Cache connection status for 15 minutes
-    cached = data
-    cached['status'] = 1
-    redis.hmset(key, cached)
-    redis.expire(key, 900)
-
-    return data
-
 
 def chat_connection(**dec_kwargs):
     def wrapped(func):
@@ -118,8 +105,6 @@ def chat_connection(**dec_kwargs):
 
 
 async def set_connected_chat(user_id, chat_id):
-    key = f'connection_cache_{user_id}'
-    redis.delete(key)
     if not chat_id:
         await db.connections.update_one({'user_id': user_id}, {"$unset": {'chat_id': 1, 'command': 1}}, upsert=True)
         await get_connection_data.reset_cache(user_id)
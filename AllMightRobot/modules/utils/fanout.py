@@ -0,0 +1,144 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+from collections import Counter
+from typing import Optional
+
+from aiogram.utils.exceptions import RetryAfter, NetworkError
+
+from AllMightRobot.services.mongo import db
+from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.rate_limit import TokenBucket, TokenBuckets
+
+# Telegram allows ~30 requests per second per bot, keep some room for the rest of updates
+GLOBAL_RATE = 20
+CHAT_RATE = 1
+CONCURRENCY = 10
+# Processed targets are saved to the database by chunks, a restart repeats at most one chunk
+CHUNK_SIZE = 50
+PROGRESS_INTERVAL = 5
+MAX_ATTEMPTS = 3
+
+# kind: {'action': ..., 'checkpoint': ..., 'progress': ..., 'done': ...}
+FANOUT_KINDS = {}
+
+global_bucket = TokenBucket(GLOBAL_RATE)
+chat_buckets = TokenBuckets(CHAT_RATE)
+_semaphore = None
+
+
+def _get_semaphore():
+    global _semaphore
+    # Created lazily to bind to the running loop
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(CONCURRENCY)
+    return _semaphore
+
+
+async def _call(kind: dict, job: dict, target: list) -> Optional[bool]:
+    """Returns None if the action failed with an error"""
+    chat_id = target[1]
+    for _ in range(MAX_ATTEMPTS):
+        async with _get_semaphore():
+            await global_bucket.acquire()
+            await chat_buckets[chat_id].acquire()
+            try:
+                return bool(await kind['action'](job, target))
+            except RetryAfter as err:
+                log.warning(f'Fanout: got RetryAfter for {err.timeout} seconds, pausing all jobs')
+                global_bucket.pause(err.timeout)
+            except NetworkError:
+                await asyncio.sleep(1)
+            except Exception as err:  # noqa
+                # One broken chat shouldn't stop the whole job
+                log.debug(f"Fanout: {job['kind']} action failed in {chat_id} - {err!r}")
+                return None
+    return False
+
+
+async def run_job(job: dict):
+    """
+    Job is a database document with 'kind' and 'targets' - list of [group, chat_id].
+    The 'counts' field holds number of succeeded targets per group, 'failed' - number of targets with errors.
+    Checkpoint returns False to stop the job, when it isn't needed anymore.
+    """
+    kind = FANOUT_KINDS[job['kind']]
+    job.setdefault('offset', 0)
+    job.setdefault('counts', {})
+    job.setdefault('failed', 0)
+
+    targets = job['targets']
+    last_progress = 0.0
+    while job['offset'] < len(targets):
+        chunk = targets[job['offset']:job['offset'] + CHUNK_SIZE]
+        results = await asyncio.gather(*[_call(kind, job, target) for target in chunk])
+        succeeded = [target for target, ok in zip(chunk, results) if ok]
+        failed = results.count(None)
+
+        # Let the kind save results first, so repeating the chunk after a restart is harmless
+        if await kind['checkpoint'](job, succeeded) is False:
+            log.info(f"Fanout: {job['kind']} job {job['_id']} was stopped at {job['offset']}/{len(targets)}")
+            await db.fanout_jobs.delete_one({'_id': job['_id']})
+            return
+
+        job['offset'] += len(chunk)
+        job['failed'] += failed
+        counts = Counter(target[0] for target in succeeded)
+        for group, count in counts.items():
+            job['counts'][group] = job['counts'].get(group, 0) + count
+
+        await db.fanout_jobs.update_one(
+            {'_id': job['_id']},
+            {
+                '$set': {'offset': job['offset']},
+                '$inc': {'failed': failed, **{f'counts.{g}': c for g, c in counts.items()}}
+            }
+        )
+
+        if job['offset'] < len(targets) and time.monotonic() - last_progress > PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await kind['progress'](job)
+
+    if job['failed']:
+        log.warning(f"Fanout: {job['kind']} job {job['_id']} failed in {job['failed']} chats")
+    await kind['done'](job)
+    await db.fanout_jobs.delete_one({'_id': job['_id']})
+
+
+async def _run_job_safe(job: dict):
+    try:
+        await run_job(job)
+    except Exception:
+        # The job stays in the database and will be resumed after restart
+        log.error(f"Fanout: job {job['_id']} failed", exc_info=True)
+
+
+async def submit_job(job: dict):
+    """Saves the job and runs it in background"""
+    job.update({'offset': 0, 'counts': {}, 'failed': 0})
+    job['_id'] = (await db.fanout_jobs.insert_one(job)).inserted_id
+    asyncio.ensure_future(_run_job_safe(job))
+
+
+async def resume_jobs():
+    async for job in db.fanout_jobs.find({}):
+        if job['kind'] not in FANOUT_KINDS:
+            continue
+        log.info(f"Fanout: resuming {job['kind']} job {job['_id']} from {job['offset']}/{len(job['targets'])}")
+        asyncio.ensure_future(_run_job_safe(job))
@@ -0,0 +1,242 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hashlib
+import math
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from AllMightRobot.services.mongo import db
+from AllMightRobot.services.redis import bredis, pipeline, redis
+from AllMightRobot.utils.logger import log
+
+# Federation bans filters are kept in Redis, one per fed and sized by its bans count.
+# Small feds get an exact set of banned ids, bigger ones a Bloom filter in a bitmap, whose
+# offset 0 is the "ready" flag and bits start at offset 1. The set has a "ready" member instead.
+# Because the flag lives in the same key, an evicted or removed filter is never mistaken for an empty one.
+BLOOM_ERROR_RATE = 0.001
+# Feds with fewer bans than this are kept in a set
+BLOOM_SET_MAX = 1000
+# Filters are sized for twice the current bans count, and rebuilt when it's outgrown
+BLOOM_HEADROOM = 2
+BLOOM_BATCH = 5000
+BLOOM_SET_READY = b'ready'
+
+
+def _bloom_key(fed_id: str) -> str:
+    return f'fbans_bloom:{fed_id}'
+
+
+def _set_key(fed_id: str) -> str:
+    return f'fbans_set:{fed_id}'
+
+
+def _meta_key(fed_id: str) -> str:
+    return f'fbans_filter:{fed_id}'
+
+
+def bloom_params(capacity: int, error_rate: float = BLOOM_ERROR_RATE) -> Tuple[int, int]:
+    """Optimal bits and hashes count for the given number of items"""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def bloom_offsets(user_id: int, bits: int, hashes: int) -> List[int]:
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [1 + (h1 + i * h2) % bits for i in range(hashes)]
+
+
+async def _get_filters_meta(feds_list: List[str]) -> List[dict]:
+    pipe = bredis.pipeline(transaction=False)
+    for fed_id in feds_list:
+        pipe.hgetall(_meta_key(fed_id))
+    results = await pipe.execute()
+    return [{k.decode(): v for k, v in meta.items()} for meta in results]
+
+
+async def add_to_fbans_bloom(fed_id: str, user_ids: Iterable[int]):
+    # Should be called only after the ban was written to the database, see rebuild_fbans_bloom
+    user_ids = list(user_ids)
+    if not user_ids or not (meta := (await _get_filters_meta([fed_id]))[0]):
+        # Filter will be built from the database on the next check
+        return
+
+    pipe = bredis.pipeline(transaction=False)
+    if meta['kind'] == b'set':
+        pipe.sadd(_set_key(fed_id), *user_ids)
+    else:
+        bits, hashes = int(meta['bits']), int(meta['hashes'])
+        for user_id in user_ids:
+            for offset in bloom_offsets(user_id, bits, hashes):
+                pipe.setbit(_bloom_key(fed_id), offset, 1)
+    pipe.hincrby(_meta_key(fed_id), 'count', len(user_ids))
+    count = (await pipe.execute())[-1]
+
+    # Set grew too big or filter's error rate is going up, resize it
+    if count > int(meta['capacity']):
+        asyncio.ensure_future(rebuild_fbans_bloom(fed_id))
+
+
+async def may_be_fbanned(feds_list: List[str], user_id: int) -> bool:
+    """False means the user is surely not banned in any of given feds"""
+    metas = await _get_filters_meta(feds_list)
+
+    pipe = bredis.pipeline(transaction=False)
+    checks = []
+    for fed_id, meta in zip(feds_list, metas):
+        if not meta:
+            checks.append(0)
+        elif meta['kind'] == b'set':
+            pipe.sismember(_set_key(fed_id), BLOOM_SET_READY)
+            pipe.sismember(_set_key(fed_id), user_id)
+            checks.append(2)
+        else:
+            pipe.getbit(_bloom_key(fed_id), 0)
+            offsets = bloom_offsets(user_id, int(meta['bits']), int(meta['hashes']))
+            for offset in offsets:
+                pipe.getbit(_bloom_key(fed_id), offset)
+            checks.append(len(offsets) + 1)
+    results = await pipe.execute()
+
+    idx = 0
+    for fed_id, step in zip(feds_list, checks):
+        if not step:
+            asyncio.ensure_future(rebuild_fbans_bloom(fed_id))
+            return True
+
+        ready, *bits = results[idx:idx + step]
+        idx += step
+
+        if not ready:
+            asyncio.ensure_future(rebuild_fbans_bloom(fed_id))
+            return True
+        if all(bits):
+            return True
+
+    return False
+
+
+async def rebuild_fbans_bloom(fed_id: str) -> int:
+    lock = f'fbans_bloom_lock:{fed_id}'
+    if not await bredis.set(lock, 1, nx=True, ex=600):
+        return 0
+
+    try:
+        bans_count = await db.fed_bans.count_documents({'fed_id': fed_id})
+        if bans_count < BLOOM_SET_MAX:
+            meta = {'kind': 'set', 'capacity': BLOOM_SET_MAX}
+        else:
+            capacity = bans_count * BLOOM_HEADROOM
+            bits, hashes = bloom_params(capacity)
+            meta = {'kind': 'bloom', 'capacity': capacity, 'bits': bits, 'hashes': hashes}
+
+        # Bans added while we are here are written into the fresh filter as well,
+        # bans written to the database before it are caught by the scan below.
+        async with pipeline(bredis, transaction=True) as pipe:
+            pipe.delete(_bloom_key(fed_id), _set_key(fed_id), _meta_key(fed_id))
+            pipe.hset(_meta_key(fed_id), mapping={**meta, 'count': 0})
+
+        count = 0
+        batch = []
+        async for ban in db.fed_bans.find({'fed_id': fed_id}, {'_id': 0, 'user_id': 1}).batch_size(BLOOM_BATCH):
+            batch.append(ban['user_id'])
+            if len(batch) >= BLOOM_BATCH:
+                await add_to_fbans_bloom(fed_id, batch)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            await add_to_fbans_bloom(fed_id, batch)
+            count += len(batch)
+
+        if meta['kind'] == 'set':
+            await bredis.sadd(_set_key(fed_id), BLOOM_SET_READY)
+        else:
+            await bredis.setbit(_bloom_key(fed_id), 0, 1)
+        log.debug(f"Feds: rebuilt fbans {meta['kind']} of {fed_id} with {count} bans")
+        return count
+    finally:
+        await bredis.delete(lock)
+
+
+async def drop_fbans_bloom(fed_id: str):
+    await bredis.delete(_bloom_key(fed_id), _set_key(fed_id), _meta_key(fed_id))
+
+
+class FedsGraph:
+    """Federations subscriptions graph with memoized transitive closures"""
+
+    def __init__(self, version, feds: Iterable[dict]):
+        self.version = version
+        self.subscriptions: Dict[str, Set[str]] = {}
+        self.subscribers: Dict[str, Set[str]] = {}
+        self._closures: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+
+        for fed in feds:
+            self.subscriptions[fed['fed_id']] = set(fed['subscribed'])
+            for sfed_id in fed['subscribed']:
+                self.subscribers.setdefault(sfed_id, set()).add(fed['fed_id'])
+
+    def _closure(self, kind: str, edges: Dict[str, Set[str]], fed_id: str) -> Tuple[str, ...]:
+        if (closure := self._closures.get((kind, fed_id))) is not None:
+            return closure
+
+        # BFS, given fed goes first
+        closure, seen = [fed_id], {fed_id}
+        queue = deque([fed_id])
+        while queue:
+            for next_fed in edges.get(queue.popleft(), ()):
+                if next_fed not in seen:
+                    seen.add(next_fed)
+                    closure.append(next_fed)
+                    queue.append(next_fed)
+
+        self._closures[(kind, fed_id)] = closure = tuple(closure)
+        return closure
+
+    def subscribers_closure(self, fed_id: str) -> Tuple[str, ...]:
+        """Fed and all feds which are subscribed on it, directly or not. Bans of the fed are applied in all of them."""
+        return self._closure('subscribers', self.subscribers, fed_id)
+
+    def subscriptions_closure(self, fed_id: str) -> Tuple[str, ...]:
+        """Fed and all feds it's subscribed on, directly or not. Bans of all of them are applied in the fed."""
+        return self._closure('subscriptions', self.subscriptions, fed_id)
+
+
+_FEDS_GRAPH: Optional[FedsGraph] = None
+
+
+async def get_feds_graph() -> FedsGraph:
+    global _FEDS_GRAPH
+
+    version = await redis.get('feds_graph_ver')
+    if _FEDS_GRAPH is None or _FEDS_GRAPH.version != version:
+        feds = db.feds.find({'subscribed.0': {'$exists': True}}, {'_id': 0, 'fed_id': 1, 'subscribed': 1})
+        _FEDS_GRAPH = FedsGraph(version, await feds.to_list(None))
+
+    return _FEDS_GRAPH
+
+
+async def reset_feds_graph():
+    # Bumping the version makes every process reload the graph
+    global _FEDS_GRAPH
+    _FEDS_GRAPH = None
+    await redis.incr('feds_graph_ver')
@@ -17,84 +17,156 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import pickle
+from contextlib import suppress
+from types import MappingProxyType
 
 import yaml
 from babel.core import Locale
 
 from AllMightRobot.services.mongo import db
 from AllMightRobot.services.redis import redis
+from AllMightRobot.utils.cached import L1Cache, ensure_listener, publish_invalidation, register_l1
 from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.startup import STARTUP
+from AllMightRobot.utils.update_context import forget, memoize
+
+LOCALIZATION_DIR = 'AllMightRobot/localization'
+# Parsed YAML files, reused while none of them is changed
+LOCALIZATION_CACHE = 'data/localization.cache'
+LOCALIZATION_CACHE_VERSION = 1
 
 LANGUAGES = {}
 
-log.info("Loading localizations...")
 
-for filename in os.listdir('AllMightRobot/localization'):
-    log.debug('Loading language file ' + filename)
-    with open('AllMightRobot/localization/' + filename, "r", encoding='utf8') as f:
-        lang = yaml.load(f, Loader=yaml.CLoader)
+def _localization_files_key() -> tuple:
+    files = sorted(f for f in os.listdir(LOCALIZATION_DIR) if f.endswith('.yaml'))
+    stats = [(f, (stat := os.stat(os.path.join(LOCALIZATION_DIR, f))).st_mtime_ns, stat.st_size) for f in files]
+    return LOCALIZATION_CACHE_VERSION, tuple(stats)
+
+
+def _load_localization() -> dict:
+    files_key = _localization_files_key()
+    with suppress(OSError, pickle.UnpicklingError, EOFError, ValueError):
+        with open(LOCALIZATION_CACHE, 'rb') as f:
+            if (cache := pickle.load(f))['key'] == files_key:
+                log.debug('Using compiled localization cache')
+                return cache['languages']
+
+    languages = {}
+    for filename, _, _ in files_key[1]:
+        log.debug('Loading language file ' + filename)
+        with open(os.path.join(LOCALIZATION_DIR, filename), "r", encoding='utf8') as f:
+            lang = yaml.load(f, Loader=yaml.CLoader)
+            languages[lang['language_info']['code']] = lang
+
+    with suppress(OSError):
+        os.makedirs(os.path.dirname(LOCALIZATION_CACHE), exist_ok=True)
+        with open(LOCALIZATION_CACHE, 'wb') as f:
+            pickle.dump({'key': files_key, 'languages': languages}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return languages
 
-        lang_code = lang['language_info']['code']
-        lang['language_info']['babel'] = Locale(lang_code)
 
+log.info("Loading localizations...")
+
+with STARTUP.phase('localization'):
+    for lang_code, lang in _load_localization().items():
+        lang['language_info']['babel'] = Locale(lang_code)
         LANGUAGES[lang_code] = lang
 
 log.info("Languages loaded: {}".format(
     [language['language_info']['babel'].display_name for language in LANGUAGES.values()]))
 
 
+def _build_strings_tables() -> dict:
+    """
+    Merges every module block over the English one, so missing strings fall back to English without
+    second lookup, and freezes them. Shared LANGUAGES dicts stay untouched.
+    """
+    tables = {}
+    english = LANGUAGES['en']
+    for lang_code, lang in LANGUAGES.items():
+        for mas_name in {*english, *lang}:
+            if mas_name == 'language_info':
+                continue
+
+            en_section = english.get(mas_name) or {}
+            section = lang.get(mas_name) or {}
+            for module in {*en_section, *section}:
+                if not isinstance(block := section.get(module, en_section.get(module)), dict):
+                    # Lists of random strings
+                    tables[(lang_code, mas_name, module)] = tuple(block or ())
+                    continue
+
+                data = {**(en_section.get(module) or {}), **(section.get(module) or {})}
+                if mas_name == 'STRINGS':
+                    data['language_info'] = lang['language_info']
+                tables[(lang_code, mas_name, module)] = MappingProxyType(data)
+    return tables
+
+
+STRINGS_TABLES = _build_strings_tables()
+EMPTY_STRINGS = MappingProxyType({})
+
+LANG_CACHE_KEY = 'lang_cache_{}'
+# chat_id: lang, changes are broadcasted through cached invalidation channel
+LANG_L1 = register_l1(L1Cache(maxsize=50000, ttl=60 * 60))
+
+
 async def get_chat_lang(chat_id):
-    r = redis.get('lang_cache_{}'.format(chat_id))
+    return await memoize(('lang', chat_id), _get_chat_lang, chat_id)
+
+
+async def _get_chat_lang(chat_id):
+    key = LANG_CACHE_KEY.format(chat_id)
+    if (lang := LANG_L1.get(key)) is not None:
+        return lang
+
+    ensure_listener()
+    if not (lang := await _load_chat_lang(key, chat_id)):
+        # Default isn't remembered, the language may be detected later
+        return 'en'
+
+    LANG_L1.set(key, lang)
+    return lang
+
+
+async def _load_chat_lang(key, chat_id):
+    r = await redis.get(key)
     if r:
         return r
     else:
         db_lang = await db.lang.find_one({'chat_id': chat_id})
         if db_lang:
             # Rebuild lang cache
-            redis.set('lang_cache_{}'.format(chat_id), db_lang['lang'])
+            await redis.set(key, db_lang['lang'])
             return db_lang['lang']
         user_lang = await db.user_list.find_one({'user_id': chat_id})
         if user_lang and user_lang['user_lang'] in LANGUAGES:
             # Add telegram language in lang cache
-            redis.set('lang_cache_{}'.format(chat_id), user_lang['user_lang'])
+            await redis.set(key, user_lang['user_lang'])
             return user_lang['user_lang']
         else:
-            return 'en'
+            return None
 
 
 async def change_chat_lang(chat_id, lang):
-    redis.set('lang_cache_{}'.format(chat_id), lang)
+    forget(('lang', chat_id))
+    key = LANG_CACHE_KEY.format(chat_id)
+    await redis.set(key, lang)
     await db.lang.update_one({'chat_id': chat_id}, {"$set": {'chat_id': chat_id, 'lang': lang}}, upsert=True)
+    await publish_invalidation(key)
+    LANG_L1.set(key, lang)
 
 
 async def get_strings(chat_id, module, mas_name="STRINGS"):
     chat_lang = await get_chat_lang(chat_id)
     if chat_lang not in LANGUAGES:
         await change_chat_lang(chat_id, 'en')
+        chat_lang = 'en'
 
-    class Strings:
-        def get_strings(self, lang, mas_name, module):
-
-            if mas_name not in LANGUAGES[lang] or module not in LANGUAGES[lang][mas_name]:
-                return {}
-
-            data = LANGUAGES[lang][mas_name][module]
-
-            if mas_name == 'STRINGS':
-                data['language_info'] = LANGUAGES[chat_lang]['language_info']
-            return data
-
-        def get_string(self, name):
-            data = self.get_strings(chat_lang, mas_name, module)
-            if name not in data:
-                data = self.get_strings('en', mas_name, module)
-
-            return data[name]
-
-        def __getitem__(self, key):
-            return self.get_string(key)
-
-    return Strings()
+    return STRINGS_TABLES.get((chat_lang, mas_name, module), EMPTY_STRINGS)
 
 
 async def get_string(chat_id, module, name, mas_name="STRINGS"):
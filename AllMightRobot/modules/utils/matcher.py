@@ -0,0 +1,170 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+# Copyright (C) 2019 Aiogram
+#
+# This file is part of AllMightBot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import OrderedDict, deque
+from typing import Iterable, List, Optional
+
+import regex
+
+from AllMightRobot.utils.logger import log
+
+# Overall time budget for all regex handlers of one chat per message
+MATCH_TIMEOUT = 0.3
+
+
+class AhoCorasick:
+    """Finds every stored keyword in a text with a single left-to-right scan."""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+
+        for keyword in keywords:
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].add(keyword)
+
+        # Build failure links with BFS
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.out[next_state] |= self.out[self.fail[next_state]]
+
+    def search(self, text: str) -> set:
+        found = set()
+        state = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class FiltersMatcher:
+    """Compiled set of chat filters handlers.
+
+    Plain handlers are folded into one case-insensitive Aho-Corasick automaton,
+    're:' handlers are compiled once and share a single time budget.
+    """
+
+    def __init__(self, handlers: Iterable[str]):
+        self.handlers = tuple(handlers)
+
+        self.patterns = []
+        plain = []
+        for handler in self.handlers:
+            if handler.startswith('re:'):
+                try:
+                    self.patterns.append((handler, regex.compile(handler.replace('re:', '', 1))))
+                except regex.error as err:
+                    log.debug(f'Filters: skipping invalid handler {handler!r} - {err}')
+            else:
+                plain.append(handler.lower())
+
+        self.automaton = AhoCorasick(plain) if plain else None
+
+    @property
+    def has_patterns(self) -> bool:
+        return bool(self.patterns)
+
+    def match(self, text: str, timeout: float = MATCH_TIMEOUT) -> List[str]:
+        """Returns matched handlers, in the same order as they were given"""
+        found_plain = self.automaton.search(text.lower()) if self.automaton else set()
+        found_patterns = set()
+
+        deadline = time.monotonic() + timeout
+        for handler, pattern in self.patterns:
+            if (remaining := deadline - time.monotonic()) <= 0:
+                log.debug('Filters: time budget exceeded, skipping rest of regex handlers')
+                break
+            try:
+                if pattern.search(text, timeout=remaining):
+                    found_patterns.add(handler)
+            except TimeoutError:
+                continue
+
+        return [
+            h for h in self.handlers
+            if (h in found_patterns if h.startswith('re:') else h.lower() in found_plain)
+        ]
+
+
+class ChatFilters:
+    """Filters documents of one chat grouped by handler, with their compiled matcher"""
+
+    def __init__(self, version, filters: Iterable[dict]):
+        self.version = version
+        self.by_handler = OrderedDict()
+        for filter in filters:
+            self.by_handler.setdefault(filter['handler'], []).append(filter)
+
+        self.matcher = FiltersMatcher(self.by_handler.keys())
+
+    def __bool__(self):
+        return bool(self.by_handler)
+
+
+class FiltersIndex:
+    """In-process LRU of chats filters.
+
+    Every entry remembers the version it was loaded with, an entry with other version is treated as missing.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, chat_id: int, version) -> Optional[ChatFilters]:
+        if (chat_filters := self._data.get(chat_id)) is None:
+            return None
+
+        # Filters was updated by other process
+        if chat_filters.version != version:
+            del self._data[chat_id]
+            return None
+
+        self._data.move_to_end(chat_id)
+        return chat_filters
+
+    def set(self, chat_id: int, chat_filters: ChatFilters):
+        self._data[chat_id] = chat_filters
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, chat_id: int):
+        self._data.pop(chat_id, None)
@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import html
 import re
 import sys
@@ -263,7 +264,7 @@ async def get_parsed_note_list(message, allow_reply_message=True, split_args=1):
     return note
 
 
-async def t_unparse_note_item(message, db_item, chat_id, noformat=None, event=None, user=None):
+async def t_unparse_note_item(message, db_item, chat_id, noformat=None, event=None, user=None, members=None):
     text = db_item['text'] if 'text' in db_item else ""
 
     file_id = None
@@ -297,9 +298,9 @@ async def t_unparse_note_item(message, db_item, chat_id, noformat=None, event=No
         if 'parse_mode' not in db_item or db_item['parse_mode'] == 'none':
             db_item['parse_mode'] = None
         elif db_item['parse_mode'] == 'md':
-            text = await vars_parser(text, message, chat_id, md=True, event=event, user=user)
+            text = await vars_parser(text, message, chat_id, md=True, event=event, user=user, members=members)
         elif db_item['parse_mode'] == 'html':
-            text = await vars_parser(text, message, chat_id, md=False, event=event, user=user)
+            text = await vars_parser(text, message, chat_id, md=False, event=event, user=user, members=members)
 
         if 'preview' in db_item and db_item['preview']:
             preview = True
@@ -405,7 +406,7 @@ def button_parser(chat_id, texts, pm=False, aio=False, row_width=None):
     return text, buttons
 
 
-async def vars_parser(text, message, chat_id, md=False, event: Message = None, user=None):
+async def vars_parser(text, message, chat_id, md=False, event: Message = None, user=None, members=None):
     if event is None:
         event = message
 
@@ -417,16 +418,30 @@ async def vars_parser(text, message, chat_id, md=False, event: Message = None, u
 
     first_name = html.escape(user.first_name, quote=False)
     last_name = html.escape(user.last_name or "", quote=False)
-    user_id = ([user.id for user in event.new_chat_members][0]
-               if 'new_chat_members' in event and event.new_chat_members != [] else user.id)
+    # Greeted users are given by caller, join message can have other users too
+    if not members and 'new_chat_members' in event and event.new_chat_members:
+        members = event.new_chat_members
+    user_id = members[0].id if members else user.id
     mention = await get_user_link(user_id, md=md)
 
-    if hasattr(event, 'new_chat_members') and event.new_chat_members and event.new_chat_members[0].username:
-        username = "@" + event.new_chat_members[0].username
+    if members and members[0].username:
+        username = "@" + members[0].username
     elif user.username:
         username = "@" + user.username
     else:
         username = mention
+    full_name = first_name + " " + last_name
+
+    if members and len(members) > 1:
+        # Several users joined at once, all of them are greeted by one message
+        first_name = ', '.join(html.escape(member.first_name, quote=False) for member in members)
+        last_name = ', '.join(html.escape(member.last_name or "", quote=False) for member in members)
+        full_name = ', '.join(html.escape(member.full_name, quote=False) for member in members)
+        links = await asyncio.gather(*[get_user_link(member.id, md=md) for member in members])
+        mention = ', '.join(links)
+        username = ', '.join(
+            "@" + member.username if member.username else link for member, link in zip(members, links)
+        )
 
     chat_id = message.chat.id
     chat_name = html.escape(message.chat.title or 'Local', quote=False)
@@ -438,7 +453,7 @@ async def vars_parser(text, message, chat_id, md=False, event: Message = None, u
 
     text = text.replace('{first}', first_name) \
         .replace('{last}', last_name) \
-        .replace('{fullname}', first_name + " " + last_name) \
+        .replace('{fullname}', full_name) \
         .replace('{id}', str(user_id).replace('{userid}', str(user_id))) \
         .replace('{mention}', mention) \
         .replace('{username}', username) \
@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import pickle
 import re
 from contextlib import suppress
@@ -27,13 +28,26 @@ from aiogram.types import CallbackQuery, Message
 from aiogram.utils.exceptions import BadRequest, Unauthorized, ChatNotFound
 from telethon.tl.functions.users import GetFullUserRequest
 
-from AllMightRobot import OPERATORS, bot
+from AllMightRobot import BOT_ID, OPERATORS, bot
 from AllMightRobot.services.mongo import db
-from AllMightRobot.services.redis import bredis
+from AllMightRobot.services.redis import bredis, pipeline
 from AllMightRobot.services.telethon import tbot
+from AllMightRobot.utils.cached import L1Cache, ensure_listener, publish_invalidation, register_l1
+from AllMightRobot.utils.update_context import forget, memoize
 from .language import get_string
 from .message import get_arg
 
+ADMINS_CACHE_KEY = 'admin_cache:'
+ADMINS_CACHE_TTL = 15 * 60
+# Telegram sends chat_member updates only where the bot is admin, only there lists are dropped on changes
+# and expiration just covers lost updates
+ADMINS_CACHE_BOT_ADMIN_TTL = 6 * 60 * 60
+# Bumped on every drop, refreshes which started before it don't write their list
+ADMINS_VERSION_KEY = 'admin_cache_version:'
+ADMINS_L1 = register_l1(L1Cache(maxsize=4096, ttl=ADMINS_CACHE_TTL))
+# chat_id: future of running refresh
+_ADMINS_REFRESHES = {}
+
 
 async def add_user_to_db(user):
     if hasattr(user, 'user'):
@@ -111,21 +125,19 @@ async def get_user_by_username(username):
     return user
 
 
-async def get_user_link(user_id, custom_name=None, md=False):
-    user = await db.user_list.find_one({'user_id': user_id})
+async def _get_user_name(user_id):
+    if user := await db.user_list.find_one({'user_id': user_id}):
+        return user['first_name']
 
-    if user:
-        user_name = user['first_name']
-    else:
-        try:
-            user = await add_user_to_db(await tbot(GetFullUserRequest(int(user_id))))
-        except (ValueError, TypeError):
-            user_name = str(user_id)
-        else:
-            user_name = user['first_name']
+    try:
+        user = await add_user_to_db(await tbot(GetFullUserRequest(int(user_id))))
+    except (ValueError, TypeError):
+        return str(user_id)
+    return user['first_name']
 
-    if custom_name:
-        user_name = custom_name
+
+async def get_user_link(user_id, custom_name=None, md=False):
+    user_name = custom_name or await memoize(('user_name', user_id), _get_user_name, user_id)
 
     if md:
         return "[{name}](tg://user?id={id})".format(name=user_name, id=user_id)
@@ -133,36 +145,104 @@ async def get_user_link(user_id, custom_name=None, md=False):
         return "<a href=\"tg://user?id={id}\">{name}</a>".format(name=user_name, id=user_id)
 
 
-async def get_admins_rights(chat_id, force_update=False):
-    key = 'admin_cache:' + str(chat_id)
-    if (alist := bredis.get(key)) and not force_update:
-        return pickle.loads(alist)
-    else:
-        alist = {}
-        admins = await bot.get_chat_administrators(chat_id)
-        for admin in admins:
-            user_id = admin['user']['id']
-            alist[user_id] = {
-                'status': admin['status'],
-                'admin': True,
-                'title': admin['custom_title'],
-                'anonymous': admin['is_anonymous'],
-                'can_change_info': admin['can_change_info'],
-                'can_delete_messages': admin['can_delete_messages'],
-                'can_invite_users': admin['can_invite_users'],
-                'can_restrict_members': admin['can_restrict_members'],
-                'can_pin_messages': admin['can_pin_messages'],
-                'can_promote_members': admin['can_promote_members']
-            }
-
-            with suppress(KeyError):  # Optional permissions
-                alist[user_id]['can_post_messages'] = admin['can_post_messages']
-
-        bredis.set(key, pickle.dumps(alist))
-        bredis.expire(key, 900)
+async def fetch_admins_rights(chat_id) -> dict:
+    alist = {}
+    admins = await bot.get_chat_administrators(chat_id)
+    for admin in admins:
+        user_id = admin['user']['id']
+        alist[user_id] = {
+            'status': admin['status'],
+            'admin': True,
+            'title': admin['custom_title'],
+            'anonymous': admin['is_anonymous'],
+            'can_change_info': admin['can_change_info'],
+            'can_delete_messages': admin['can_delete_messages'],
+            'can_invite_users': admin['can_invite_users'],
+            'can_restrict_members': admin['can_restrict_members'],
+            'can_pin_messages': admin['can_pin_messages'],
+            'can_promote_members': admin['can_promote_members']
+        }
+
+        with suppress(KeyError):  # Optional permissions
+            alist[user_id]['can_post_messages'] = admin['can_post_messages']
+
     return alist
 
 
+# Sets the admins list only if its version wasn't changed since refresh started
+# KEYS: list, version; ARGV: expected version, list, ttl
+SET_ADMINS_SCRIPT = bredis.register_script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+""")
+
+
+async def _refresh_admins_rights(chat_id) -> dict:
+    key = ADMINS_CACHE_KEY + str(chat_id)
+    version_key = ADMINS_VERSION_KEY + str(chat_id)
+
+    # Second attempt happens only if admins were changed during the first one
+    for _ in range(2):
+        version = await bredis.get(version_key) or b'0'
+        alist = await fetch_admins_rights(chat_id)
+        ttl = ADMINS_CACHE_BOT_ADMIN_TTL if BOT_ID in alist else ADMINS_CACHE_TTL
+        if await SET_ADMINS_SCRIPT(keys=[key, version_key], args=[version, pickle.dumps(alist), ttl]):
+            # Other processes will load the new list from Redis
+            await publish_invalidation(key)
+            ADMINS_L1.set(key, alist)
+            break
+    return alist
+
+
+async def get_admins_rights(chat_id, force_update=False):
+    """
+    Admins list is cached in-process and in Redis, it's dropped on admins changes
+    (see drop_admins_cache) in chats where the bot is admin, other chats rely on short TTL.
+    Concurrent refreshes of one chat share a single request to Telegram.
+    """
+    if force_update:
+        forget(('admins', chat_id))
+    return await memoize(('admins', chat_id), _get_admins_rights, chat_id, force_update=force_update)
+
+
+async def _get_admins_rights(chat_id, force_update=False):
+    ensure_listener()
+    key = ADMINS_CACHE_KEY + str(chat_id)
+
+    if not force_update:
+        if (alist := ADMINS_L1.get(key)) is not None:
+            return alist
+        elif raw := await bredis.get(key):
+            ADMINS_L1.set(key, alist := pickle.loads(raw))
+            return alist
+
+    if (future := _ADMINS_REFRESHES.get(chat_id)) is None:
+        future = _ADMINS_REFRESHES[chat_id] = asyncio.ensure_future(_refresh_admins_rights(chat_id))
+        future.add_done_callback(
+            # drop_admins_cache could already replace it with a newer refresh
+            lambda f: _ADMINS_REFRESHES.pop(chat_id) if _ADMINS_REFRESHES.get(chat_id) is f else None
+        )
+
+    # Cancelling of one waiter shouldn't cancel the request for others
+    return await asyncio.shield(future)
+
+
+async def drop_admins_cache(chat_id):
+    forget(('admins', chat_id))
+    # Next callers shouldn't wait for a refresh which may return the old list
+    _ADMINS_REFRESHES.pop(chat_id, None)
+    key = ADMINS_CACHE_KEY + str(chat_id)
+    ADMINS_L1.delete(key)
+    async with pipeline(bredis, transaction=True) as pipe:
+        pipe.incr(ADMINS_VERSION_KEY + str(chat_id))
+        pipe.expire(ADMINS_VERSION_KEY + str(chat_id), ADMINS_CACHE_BOT_ADMIN_TTL)
+        pipe.delete(key)
+    await publish_invalidation(key)
+
+
 async def is_user_admin(chat_id, user_id):
     # User's pm should have admin rights
     if chat_id == user_id:
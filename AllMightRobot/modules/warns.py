@@ -287,6 +287,13 @@ async def max_warn_func(chat_id, user_id):
         return await ban_user(chat_id, user_id)
 
 
+__indexes__ = {
+    'warns': [[('chat_id', 1), ('user_id', 1)]],
+    'warnmode': [[('chat_id', 1)]],
+    'warnlimit': [[('chat_id', 1)]]
+}
+
+
 async def __export__(chat_id):
     if data := await db.warnlimit.find_one({'chat_id': chat_id}):
         number = data['num']
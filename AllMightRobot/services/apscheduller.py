@@ -16,6 +16,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+
 from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.jobstores.redis import RedisJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -23,8 +25,11 @@ from pytz import utc
 
 from AllMightRobot.config import get_str_key, get_int_key
 from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.updates_stream import ROLE, is_leader
 
 DEFAULT = "default"
+# How often the leader looks for jobs added by other processes
+POLL_INTERVAL = 1
 
 jobstores = {
     DEFAULT: RedisJobStore(
@@ -40,5 +45,20 @@ scheduler = AsyncIOScheduler(
     jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone=utc
 )
 
-log.info("Starting apscheduller...")
-scheduler.start()
+
+async def _poll_jobs():
+    # Scheduler sleeps till its next known job, so jobs added by other processes would wait for it
+    while True:
+        await asyncio.sleep(POLL_INTERVAL)
+        scheduler.wakeup()
+
+
+# RedisJobStore has no locks, so only one process may run the jobs, others only add and remove them
+if is_leader():
+    log.info("Starting apscheduller...")
+    scheduler.start()
+    if ROLE != 'single':
+        asyncio.ensure_future(_poll_jobs())
+else:
+    log.info("Starting apscheduller paused, jobs are run by the leader...")
+    scheduler.start(paused=True)
@@ -0,0 +1,42 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Optional
+
+import aiohttp
+
+# Third party APIs should never hold a handler for long
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+HTTP_MAX_CONNECTIONS = 100
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Shared pooled session, created on first use as it needs the running loop"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=HTTP_TIMEOUT,
+            connector=aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, ttl_dns_cache=300)
+        )
+    return _session
+
+
+async def close_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
@@ -16,26 +16,31 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import asyncio
 import sys
 
 from motor import motor_asyncio
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from pymongo.errors import ServerSelectionTimeoutError
 
 from AllMightRobot import log
 from AllMightRobot.config import get_str_key, get_int_key
+from AllMightRobot.utils.indexes import QUERY_SHAPES
 
 MONGO_URI = get_str_key("MONGO_URI")
 MONGO_PORT = get_int_key("MONGO_PORT")
 MONGO_DB = get_str_key("MONGO_DB")
 
+# Should be registered before clients are created
+monitoring.register(QUERY_SHAPES)
+
 # Init MongoDB
 mongodb = MongoClient(MONGO_URI, MONGO_PORT)[MONGO_DB]
 motor = motor_asyncio.AsyncIOMotorClient(MONGO_URI, MONGO_PORT)
 db = motor[MONGO_DB]
 
-try:
-    asyncio.get_event_loop().run_until_complete(motor.server_info())
-except ServerSelectionTimeoutError:
-    sys.exit(log.critical("Can't connect to mongodb! Exiting..."))
+
+async def connect_mongo():
+    try:
+        await motor.server_info()
+    except ServerSelectionTimeoutError:
+        sys.exit(log.critical("Can't connect to mongodb! Exiting..."))
@@ -16,27 +16,65 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import redis as redis_lib
 import sys
+from contextlib import asynccontextmanager
+
+import redis as redis_lib
+from redis import asyncio as aioredis
 
 from AllMightRobot import log
 from AllMightRobot.config import get_str_key, get_int_key
 
+REDIS_HOST = get_str_key("REDIS_URI")
+REDIS_PORT = get_str_key("REDIS_PORT")
+REDIS_DB = get_int_key("REDIS_DB_FSM")
+REDIS_MAX_CONNECTIONS = get_int_key("REDIS_MAX_CONNECTIONS")
+REDIS_POOL_TIMEOUT = get_int_key("REDIS_POOL_TIMEOUT")
+
+
+def make_pool(**kwargs) -> aioredis.BlockingConnectionPool:
+    """When all connections are busy, callers wait for a free one instead of failing with 'Too many connections'"""
+    return aioredis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        **kwargs
+    )
+
+
 # Init Redis
-redis = redis_lib.StrictRedis(
-    host=get_str_key("REDIS_URI"),
-    port=get_str_key("REDIS_PORT"),
-    db=get_int_key("REDIS_DB_FSM"),
+redis = aioredis.StrictRedis(connection_pool=make_pool(decode_responses=True))
+
+bredis = aioredis.StrictRedis(connection_pool=make_pool())
+
+# Blocking client, only for places where we can't await, like signal handlers
+sync_redis = redis_lib.StrictRedis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
     decode_responses=True
 )
 
-bredis = redis_lib.StrictRedis(
-    host=get_str_key("REDIS_URI"),
-    port=get_str_key("REDIS_PORT"),
-    db=get_int_key("REDIS_DB_FSM")
-)
 
-try:
-    redis.ping()
-except redis_lib.ConnectionError:
-    sys.exit(log.critical("Can't connect to RedisDB! Exiting..."))
+@asynccontextmanager
+async def pipeline(client=redis, transaction=False):
+    """
+    Sends all queued commands in one round trip on exit.
+
+    >>> async with pipeline() as pipe:
+    >>>     pipe.set(key, value)
+    >>>     pipe.expire(key, 900)
+    """
+
+    async with client.pipeline(transaction=transaction) as pipe:
+        yield pipe
+        await pipe.execute()
+
+
+async def connect_redis():
+    try:
+        await redis.ping()
+    except redis_lib.ConnectionError:
+        sys.exit(log.critical("Can't connect to RedisDB! Exiting..."))
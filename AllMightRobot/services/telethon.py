@@ -19,18 +19,61 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+
 from telethon import TelegramClient
 
 from AllMightRobot.config import get_str_key, get_int_key
+from AllMightRobot.utils.outbound import OUTBOUND
 
 TOKEN = get_str_key("TOKEN", required=True)
 NAME = TOKEN.split(':')[0]
 
-tbot = TelegramClient(
+
+class ScheduledTelegramClient(TelegramClient):
+    """Telethon client which sends every request through the outbound scheduler"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._deleting = {}
+
+    async def __call__(self, request, *args, **kwargs):
+        return await OUTBOUND.call(
+            lambda: super(ScheduledTelegramClient, self).__call__(request, *args, **kwargs),
+            type(request).__name__
+        )
+
+    async def delete_messages(self, entity, message_ids, *args, **kwargs):
+        # Messages which already being deleted are not requested again, only waited
+        if not isinstance(message_ids, (list, tuple, set)):
+            message_ids = [message_ids]
+        if not isinstance(entity, int):
+            return await super().delete_messages(entity, message_ids, *args, **kwargs)
+
+        pending = {self._deleting[(entity, m_id)] for m_id in message_ids if (entity, m_id) in self._deleting}
+        new_ids = [m_id for m_id in message_ids if (entity, m_id) not in self._deleting]
+
+        result = []
+        if new_ids:
+            future = asyncio.ensure_future(super().delete_messages(entity, new_ids, *args, **kwargs))
+            for m_id in new_ids:
+                self._deleting[(entity, m_id)] = future
+            future.add_done_callback(lambda _: [self._deleting.pop((entity, m_id), None) for m_id in new_ids])
+            result = await asyncio.shield(future)
+
+        if pending:
+            await asyncio.gather(*map(asyncio.shield, pending), return_exceptions=True)
+        return result
+
+
+tbot = ScheduledTelegramClient(
     NAME,
     get_int_key("APP_ID", required=True),
-    get_str_key("APP_HASH", required=True)
+    get_str_key("APP_HASH", required=True),
+    # Flood waits are handled by the outbound scheduler
+    flood_sleep_threshold=0
 )
 
-# Telethon
-tbot.start(bot_token=TOKEN)
+
+async def connect_telethon():
+    await tbot.start(bot_token=TOKEN)
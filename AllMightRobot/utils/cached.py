@@ -15,29 +15,131 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-
 import asyncio
 import functools
 import pickle
+import time
+from collections import OrderedDict
 from typing import Optional, Union
 
 from AllMightRobot.services.redis import bredis
 from AllMightRobot.utils.logger import log
 
+INVALIDATE_CHANNEL = 'cached:invalidate'
+
+# Max lifetime of in-process entries, in case some invalidation message was lost
+L1_TTL = 60
+L1_MAXSIZE = 2048
+# Backoff of the invalidation listener reconnects, in seconds
+LISTENER_RETRY_DELAY = 1
+LISTENER_MAX_RETRY_DELAY = 30
+
+# In-process caches, which are invalidated by keys from INVALIDATE_CHANNEL
+_L1_CACHES = []
+_listener = None
+
 
 async def set_value(key, value, ttl):
     value = pickle.dumps(value)
-    bredis.set(key, value)
-    if ttl:
-        bredis.expire(key, ttl)
+    await bredis.set(key, value, ex=ttl)
+
+
+class L1Cache:
+    """In-process LRU with expiration, cached decorator keeps pickled values in it so callers get their own copy"""
+
+    def __init__(self, maxsize: int, ttl: Optional[Union[int, float]]):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        if (item := self._data.get(key)) is None:
+            return None
+
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+async def _invalidation_listener():
+    delay = LISTENER_RETRY_DELAY
+    while True:
+        pubsub = bredis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            delay = LISTENER_RETRY_DELAY
+            async for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                key = message['data'].decode()
+                for l1 in _L1_CACHES:
+                    l1.delete(key)
+        except Exception:
+            # Invalidations sent till we resubscribe are lost, so nothing in-process can be trusted
+            log.error(f'Cached: lost invalidation channel, dropping in-process caches, '
+                      f'reconnecting in {delay}s', exc_info=True)
+            for l1 in _L1_CACHES:
+                l1.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTENER_MAX_RETRY_DELAY)
+        finally:
+            try:
+                await pubsub.reset()
+            except Exception:
+                pass
+
+
+def ensure_listener():
+    global _listener
+    if _listener is None:
+        _listener = asyncio.ensure_future(_invalidation_listener())
+
+
+def register_l1(l1: L1Cache) -> L1Cache:
+    """Makes other in-process cache to be invalidated through the same channel"""
+    _L1_CACHES.append(l1)
+    return l1
+
+
+async def publish_invalidation(key: str):
+    """Drops the key from in-process caches of all processes"""
+    await bredis.publish(INVALIDATE_CHANNEL, key)
 
 
 class cached:
 
-    def __init__(self, ttl: Optional[Union[int, float]] = None, key: Optional[str] = None, no_self: bool = False):
+    def __init__(self, ttl: Optional[Union[int, float]] = None, key: Optional[str] = None, no_self: bool = False,
+                 l1_maxsize: int = L1_MAXSIZE):
         self.ttl = ttl
         self.key = key
         self.no_self = no_self
+        self.l1 = L1Cache(l1_maxsize, min(ttl, L1_TTL) if ttl else L1_TTL)
+
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+
+        register_l1(self.l1)
 
     def __call__(self, *args, **kwargs):
         if not hasattr(self, 'func'):
@@ -49,15 +151,24 @@ class cached:
         return self._set(*args, **kwargs)
 
     async def _set(self, *args: dict, **kwargs: dict):
+        ensure_listener()
         key = self.__build_key(*args, **kwargs)
 
-        if bredis.exists(key):
-            value = pickle.loads(bredis.get(key))
+        if (raw := self.l1.get(key)) is not None:
+            self.l1_hits += 1
+        elif (raw := await bredis.get(key)) is not None:
+            self.l2_hits += 1
+            self.l1.set(key, raw)
+
+        if raw is not None:
+            value = pickle.loads(raw)
             return value if type(value) is not _NotSet else value.real_value
 
+        self.misses += 1
         result = await self.func(*args, **kwargs)
         if result is None:
             result = _NotSet()
+        self.l1.set(key, pickle.dumps(result))
         asyncio.ensure_future(set_value(key, result, ttl=self.ttl))
         log.debug(f'Cached: writing new data for key - {key}')
         return result if type(result) is not _NotSet else result.real_value
@@ -87,9 +198,22 @@ class cached:
         """
 
         key = self.__build_key(*args, **kwargs)
+        self.l1.delete(key)
         if new_value:
-            return set_value(key, new_value, ttl=self.ttl)
-        return bredis.delete(key)
+            await set_value(key, new_value, ttl=self.ttl)
+        else:
+            await bredis.delete(key)
+
+        # Drop in-process copies in other processes too
+        await publish_invalidation(key)
+
+    def cache_info(self) -> dict:
+        return {
+            'l1_hits': self.l1_hits,
+            'l2_hits': self.l2_hits,
+            'misses': self.misses,
+            'l1_size': len(self.l1)
+        }
 
 
 class _NotSet:
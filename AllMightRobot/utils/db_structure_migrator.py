@@ -17,14 +17,104 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import sys
 import time
 from importlib import import_module
+from typing import Any, Iterable, Optional, Tuple
 
 from AllMightRobot import bot, OWNER_ID
-from AllMightRobot.services.mongo import mongodb
+from AllMightRobot.config import get_bool_key, get_int_key
+from AllMightRobot.services.mongo import db
 from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.updates_stream import is_leader
 from AllMightRobot.versions import DB_STRUCTURE_VER
 
+MIGRATIONS_DELAY = get_int_key('DB_MIGRATIONS_DELAY') or 0
+# Only reports what would be changed and exits, nothing is written
+DRY_RUN = get_bool_key('DB_MIGRATIONS_DRY_RUN')
+PROGRESS_INTERVAL = 10
+
+
+class Migration:
+    """
+    One step of database structure update, defined as `migration` in AllMightRobot/db/<version>.py
+
+    Documents of `collection` which match `query` are read by batches in _id order, `ops` yields
+    (collection name, pymongo write operation) pairs for every document, they are written by one
+    unordered bulk_write per collection. The last processed _id is saved after every batch,
+    so an interrupted migration continues from there. Operations should be safe to repeat for one batch.
+    """
+
+    description = ''
+    collection: Optional[str] = None
+    query: dict = {}
+    batch_size = 500
+    # Can be done while the bot is serving, otherwise it's done before serving
+    online = False
+
+    def ops(self, doc: dict) -> Iterable[Tuple[str, Any]]:
+        return ()
+
+
+def load_migration(version: int) -> Migration:
+    return import_module("AllMightRobot.db." + str(version)).migration
+
+
+async def run_migration(version: int, migration: Migration, dry_run: bool = False) -> dict:
+    state = {} if dry_run else (await db.db_migrations.find_one({'version': version}) or {})
+    last_id = state.get('last_id')
+    stats = {'processed': state.get('processed', 0), 'changed': state.get('changed', 0)}
+
+    log.info(f"Database v{version}: {migration.description}")
+    if not migration.collection:
+        return stats
+
+    if last_id is not None:
+        log.info(f"Database v{version}: resuming after {stats['processed']} processed documents")
+
+    total = await db[migration.collection].count_documents(migration.query)
+    last_progress = time.monotonic()
+    while True:
+        query = dict(migration.query)
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        docs = await db[migration.collection].find(query).sort('_id', 1).limit(migration.batch_size).to_list(None)
+        if not docs:
+            break
+
+        queues = {}
+        for doc in docs:
+            ops = list(migration.ops(doc))
+            if ops:
+                stats['changed'] += 1
+            for collection, op in ops:
+                queues.setdefault(collection, []).append(op)
+
+        last_id = docs[-1]['_id']
+        stats['processed'] += len(docs)
+
+        if not dry_run:
+            for collection, queue in queues.items():
+                await db[collection].bulk_write(queue, ordered=False)
+            await db.db_migrations.update_one(
+                {'version': version},
+                {'$set': {'last_id': last_id, **stats}},
+                upsert=True
+            )
+
+        if time.monotonic() - last_progress > PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            log.info(f"Database v{version}: processed {stats['processed']} of ~{total}, changed {stats['changed']}")
+
+    log.info(f"Database v{version}: done, processed {stats['processed']}, changed {stats['changed']}")
+    return stats
+
+
+async def apply_migration(version: int, migration: Migration):
+    await run_migration(version, migration)
+    await db.db_structure.update_one({'db_ver': version - 1}, {"$set": {'db_ver': version}})
+    await db.db_migrations.delete_one({'version': version})
+
 
 async def notify_bot_owner(old_ver, new_ver):
     await bot.send_message(
@@ -33,42 +123,68 @@ async def notify_bot_owner(old_ver, new_ver):
     )
 
 
-# TODO: Logs channel
+async def apply_online_migrations(migrations: list, old_ver: int):
+    try:
+        for version, migration in migrations:
+            await apply_migration(version, migration)
+    except Exception:
+        log.error('Online database update failed, it will be continued on next start', exc_info=True)
+        return
+
+    log.warn(f"Database update done to {migrations[-1][0]} successfully!")
+    await notify_bot_owner(old_ver, migrations[-1][0])
 
 
-log.debug("Checking on database structure update...")
+async def dry_run(curr_ver: int):
+    log.info("Dry run of database update, nothing will be written")
+    for version in range(curr_ver + 1, DB_STRUCTURE_VER + 1):
+        await run_migration(version, load_migration(version), dry_run=True)
+    sys.exit(log.info("Dry run is done, exiting"))
+
+
+async def run_migrations():
+    """
+    Migrations which can't be done online are awaited, the rest (starting from the first online one,
+    to keep the order) continue in background while the bot is serving.
+    """
+    log.debug("Checking on database structure update...")
+
+    if not (data := await db.db_structure.find_one({'db_ver': {"$exists": True}})):
+        log.info("Your database is empty! Creating database structure key...")
+        await db.db_structure.insert_one({'db_ver': DB_STRUCTURE_VER})
+        log.info("Database structure version is: " + str(DB_STRUCTURE_VER))
+        return
 
-if not (data := mongodb.db_structure.find_one({'db_ver': {"$exists": True}})):
-    log.info("Your database is empty! Creating database structure key...")
-    mongodb.db_structure.insert_one({'db_ver': DB_STRUCTURE_VER})
-    log.info("Database structure version is: " + str(DB_STRUCTURE_VER))
-else:
     curr_ver = data['db_ver']
     log.info("Your database structure version is: " + str(curr_ver))
-    if DB_STRUCTURE_VER > curr_ver:
-        log.error("Your database is old! Waiting 20 seconds till update...")
-        log.info("Press CTRL + C to cancel!")
-        time.sleep(20)
-        log.debug("Trying to update database structure...")
-        log.info("--------------------------------")
-        log.info("Your current database structure version: " + str(curr_ver))
-        log.info("New database structure version: " + str(DB_STRUCTURE_VER))
-        log.info("--------------------------------")
-        old_ver = curr_ver
-        while curr_ver < DB_STRUCTURE_VER:
-            new_ver = curr_ver + 1
-            log.info(f"Trying update to {str(new_ver)}...")
-
-            log.debug("Importing: AllMightRobot.db." + str(new_ver))
-            import_module("AllMightRobot.db." + str(new_ver))
-
-            curr_ver += 1
-            mongodb.db_structure.update_one({'db_ver': curr_ver - 1}, {"$set": {'db_ver': curr_ver}})
-
-        log.warn(f"Database update done to {str(curr_ver)} successfully!")
-        log.debug("Let's notify the bot owner")
-        loop = asyncio.get_event_loop()
-        bot_info = loop.run_until_complete(notify_bot_owner(old_ver, curr_ver))
-        log.info("Rescue normal bot startup...")
-    else:
+    if DB_STRUCTURE_VER <= curr_ver:
         log.debug("No database structure updates found, skipping!")
+        return
+    elif not is_leader():
+        log.info("Database structure will be updated by the leader process, skipping!")
+        return
+    elif DRY_RUN:
+        return await dry_run(curr_ver)
+
+    log.error(f"Your database is old! Waiting {MIGRATIONS_DELAY} seconds till update...")
+    log.info("Press CTRL + C to cancel!")
+    await asyncio.sleep(MIGRATIONS_DELAY)
+    log.debug("Trying to update database structure...")
+    log.info("--------------------------------")
+    log.info("Your current database structure version: " + str(curr_ver))
+    log.info("New database structure version: " + str(DB_STRUCTURE_VER))
+    log.info("--------------------------------")
+
+    migrations = [(version, load_migration(version)) for version in range(curr_ver + 1, DB_STRUCTURE_VER + 1)]
+    while migrations and not migrations[0][1].online:
+        await apply_migration(*migrations.pop(0))
+
+    if migrations:
+        log.info(f"Continuing database update to {DB_STRUCTURE_VER} in background")
+        asyncio.ensure_future(apply_online_migrations(migrations, curr_ver))
+        return
+
+    log.warn(f"Database update done to {DB_STRUCTURE_VER} successfully!")
+    log.debug("Let's notify the bot owner")
+    await notify_bot_owner(curr_ver, DB_STRUCTURE_VER)
+    log.info("Rescue normal bot startup...")
@@ -19,20 +19,36 @@
 import os
 import signal
 
-from AllMightRobot.services.redis import redis
+from AllMightRobot.services.redis import sync_redis
 from AllMightRobot.utils.logger import log
 
 
+EXITING = False
+
+
 def exit_gracefully(signum, frame):
+    global EXITING
+
+    # Second CTRL + C or SIGTERM
+    if EXITING:
+        log.error("Exiting immediately!")
+        os.kill(os.getpid(), signal.SIGUSR1)
+
     log.warning("Bye!")
+    EXITING = True
 
     try:
-        redis.save()
+        sync_redis.save()
     except Exception:
         log.error("Exiting immediately!")
-    os.kill(os.getpid(), signal.SIGUSR1)
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+    # Let the executor stop polling and run shutdown tasks, like flushing of pending data
+    raise KeyboardInterrupt
 
 
 # Signal exit
 log.info("Setting exit_gracefully task...")
 signal.signal(signal.SIGINT, exit_gracefully)
+# Sent by docker, systemd and other supervisors on stop
+signal.signal(signal.SIGTERM, exit_gracefully)
@@ -0,0 +1,119 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generates fake Telegram updates and posts them to the local webhook, to test webhook mode offline.
+Doesn't import the bot, so can be run as a plain script:
+
+    python AllMightRobot/utils/fake_updates.py http://localhost:8080/<secret> --count 5000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+
+TEXTS = ['hi', 'hello there', '/start', '/help', '#notes', 'some longer message with a few words in it']
+
+
+class FakeUpdates:
+    def __init__(self, chats: int = 10, users: int = 100, seed: int = None):
+        self.random = random.Random(seed)
+        self.update_id = self.random.randint(1, 10 ** 6)
+        self.message_id = 0
+        self.chats = [-1001000000000 - i for i in range(chats)]
+        self.users = [100000 + i for i in range(users)]
+
+    def message(self, text: str = None) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        chat_id = self.random.choice(self.chats)
+        user_id = self.random.choice(self.users)
+        text = text or self.random.choice(TEXTS)
+
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Fake chat {-chat_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'fake{user_id}'},
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+
+        return {'update_id': self.update_id, 'message': message}
+
+
+async def post_updates(url: str, count: int, concurrency: int, generator: FakeUpdates, secret: str = None):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(count):
+        queue.put_nowait(generator.message())
+
+    async def worker(session):
+        nonlocal errors
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.monotonic()
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    if response.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    print(f'Posted {count} updates in {elapsed:.2f}s ({count / elapsed:.0f}/s), errors: {errors}')
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f'Latency p50: {p50 * 1000:.1f}ms, p99: {p99 * 1000:.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('url', help='webhook url, including the secret path')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument(
+        '--secret', help='value for X-Telegram-Bot-Api-Secret-Token header, the last part of url by default'
+    )
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    generator = FakeUpdates(chats=args.chats, users=args.users, seed=args.seed)
+    asyncio.get_event_loop().run_until_complete(
+        post_updates(
+            args.url, args.count, args.concurrency, generator, secret=args.secret or args.url.rstrip('/').split('/')[-1]
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import Counter
+
+from pymongo import IndexModel, monitoring
+from pymongo.errors import PyMongoError
+
+from AllMightRobot.utils.logger import log
+
+# Commands and the field with query filter in them
+FILTER_FIELDS = {
+    'find': 'filter',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+}
+
+
+def collect_indexes(modules) -> dict:
+    """
+    Merges __indexes__ of modules:
+
+    >>> __indexes__ = {'filters': [[('chat_id', 1), ('handler', 1)]]}
+    """
+    indexes = {}
+    for module in modules:
+        for collection, keys_list in getattr(module, '__indexes__', {}).items():
+            for keys in keys_list:
+                if keys not in (known := indexes.setdefault(collection, [])):
+                    known.append(keys)
+    return indexes
+
+
+def filter_shape(query: dict) -> tuple:
+    """Sorted top-level fields of the query, conditions of $and / $or are flattened"""
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor') and isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    fields.update(filter_shape(item))
+        elif not key.startswith('$'):
+            fields.add(key.split('.')[0])
+    return tuple(sorted(fields))
+
+
+class QueryShapesMonitor(monitoring.CommandListener):
+    """
+    Counts query shapes which can't use any index of the collection.
+    Only index prefixes are checked, it's a hint where an index is missing, not a query planner.
+    """
+
+    def __init__(self):
+        # collection: first fields of its indexes
+        self.indexed_fields = {}
+        # Till indexes of all collections are loaded, unknown collections aren't checked
+        self.loaded = False
+        self.unindexed = Counter()
+        self._lock = threading.Lock()
+
+    def set_indexes(self, collection: str, index_info: dict):
+        self.indexed_fields[collection] = {info['key'][0][0].split('.')[0] for info in index_info.values()}
+
+    def check(self, collection: str, query):
+        if not isinstance(query, dict) or not (shape := filter_shape(query)):
+            return
+
+        if (fields := self.indexed_fields.get(collection)) is None:
+            if not self.loaded:
+                return
+            # Created after the start or has no indexes, so only the default one
+            fields = {'_id'}
+        if fields.intersection(shape):
+            return
+
+        with self._lock:
+            self.unindexed[(collection, shape)] += 1
+            if self.unindexed[(collection, shape)] == 1:
+                log.warning(f'Indexes: query on {collection} by {shape} has no index')
+
+    def started(self, event):
+        command = event.command
+        if event.command_name in FILTER_FIELDS:
+            self.check(command[event.command_name], command.get(FILTER_FIELDS[event.command_name]))
+        elif event.command_name in ('update', 'delete'):
+            for statement in command.get(event.command_name + 's', []):
+                self.check(command[event.command_name], statement.get('q'))
+        elif event.command_name == 'aggregate' and (pipeline := command.get('pipeline')):
+            if '$match' in pipeline[0]:
+                self.check(command['aggregate'], pipeline[0]['$match'])
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def top(self, count: int = 20) -> list:
+        with self._lock:
+            return self.unindexed.most_common(count)
+
+
+QUERY_SHAPES = QueryShapesMonitor()
+
+
+async def ensure_indexes(db, indexes: dict, create: bool = True):
+    """Creates missing indexes one by one, so it's fine to run it while serving"""
+    # Collections without declared indexes are checked with their existing ones
+    try:
+        collections = await db.list_collection_names()
+    except PyMongoError:
+        log.error('Indexes: failed to list collections', exc_info=True)
+        collections = []
+    for collection in set(collections) - set(indexes):
+        try:
+            QUERY_SHAPES.set_indexes(collection, await db[collection].index_information())
+        except PyMongoError:
+            log.error(f'Indexes: failed to load indexes of {collection}', exc_info=True)
+
+    for collection, keys_list in indexes.items():
+        try:
+            info = await db[collection].index_information()
+            existing = [info_item['key'] for info_item in info.values()]
+            if missing := [keys for keys in keys_list if [tuple(k) for k in keys] not in existing]:
+                if create:
+                    for keys in missing:
+                        log.info(f'Indexes: creating {keys} on {collection}')
+                        await db[collection].create_indexes([IndexModel(keys, background=True)])
+                    info = await db[collection].index_information()
+                else:
+                    log.debug(f'Indexes: {collection} misses {missing}')
+            QUERY_SHAPES.set_indexes(collection, info)
+        except PyMongoError:
+            log.error(f'Indexes: failed to ensure indexes of {collection}', exc_info=True)
+
+    QUERY_SHAPES.loaded = True
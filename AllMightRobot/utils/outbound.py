@@ -0,0 +1,198 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Hashable, Optional
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+from telethon.errors import FloodWaitError
+
+from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.rate_limit import TokenBuckets
+
+# Telegram allows about 30 requests per second per bot and 1 message per second per chat with small bursts
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+MAX_RETRIES = 3
+# Longer waits are not retried, the error goes to the handler
+MAX_RETRY_AFTER = 60
+
+MODERATION_METHODS = {
+    'kickChatMember', 'banChatMember', 'unbanChatMember', 'restrictChatMember', 'promoteChatMember',
+    'deleteMessage', 'EditBannedRequest', 'DeleteMessagesRequest', 'EditAdminRequest'
+}
+# Methods which count in per chat messages limit
+CHAT_LIMITED_PREFIXES = ('send', 'forward', 'copy', 'edit')
+# MTProto requests which send or change messages, like SendMessageRequest
+MTPROTO_PACED_PREFIXES = ('Send', 'Forward', 'Edit')
+
+
+def is_paced(method: str) -> bool:
+    """Only writes are paced, reads like getUpdates or getChatMember don't count in the messages limits"""
+    return method in MODERATION_METHODS or method.startswith(CHAT_LIMITED_PREFIXES + MTPROTO_PACED_PREFIXES)
+
+
+class Priority(IntEnum):
+    MODERATION = 0
+    NORMAL = 1
+    WELCOME = 2
+    FUN = 3
+
+
+# Priority of requests made by the current handler, modules set it with __outbound_priority__
+outbound_priority = ContextVar('outbound_priority', default=Priority.NORMAL)
+
+
+class PriorityTokenBucket:
+    """Token bucket which serves waiters with lower priority value first, FIFO inside one priority"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._granter = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int = Priority.NORMAL):
+        self._refill()
+        if not self._waiters and self.tokens >= 1 and time.monotonic() >= self.paused_until:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.ensure_future(self._grant())
+        await future
+
+    async def _grant(self):
+        while self._waiters:
+            if (wait := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            # Cancelled waiters don't take tokens
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class OutboundScheduler:
+    """
+    Paces Bot API and MTProto writes with a global priority token bucket and per chat buckets,
+    waits and retries on flood errors, and shares one request between duplicated calls.
+    """
+
+    def __init__(self):
+        self.global_bucket = PriorityTokenBucket(GLOBAL_RATE)
+        self.chat_buckets = TokenBuckets(CHAT_RATE, CHAT_BURST)
+        self._inflight = {}
+        self.retries = 0
+
+    async def call(self, func, method: str, chat_id=None, coalesce_key: Hashable = None, retry: bool = True):
+        """func is a coroutine function without arguments which does the request"""
+        if coalesce_key is None:
+            return await self._call(func, method, chat_id, retry)
+
+        if (future := self._inflight.get(coalesce_key)) is None:
+            future = self._inflight[coalesce_key] = asyncio.ensure_future(self._call(func, method, chat_id, retry))
+            future.add_done_callback(lambda _: self._inflight.pop(coalesce_key, None))
+        return await asyncio.shield(future)
+
+    async def _call(self, func, method: str, chat_id, retry: bool):
+        if not is_paced(method):
+            return await self._call_unpaced(func, method, retry)
+
+        priority = Priority.MODERATION if method in MODERATION_METHODS else outbound_priority.get()
+        chat_bucket = None
+        if chat_id is not None and method.startswith(CHAT_LIMITED_PREFIXES):
+            chat_bucket = self.chat_buckets[chat_id]
+
+        for attempt in range(MAX_RETRIES + 1):
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self.global_bucket.acquire(priority)
+
+            try:
+                return await func()
+            except (RetryAfter, FloodWaitError) as err:
+                timeout = err.timeout if isinstance(err, RetryAfter) else err.seconds
+                if not retry or attempt == MAX_RETRIES or timeout > MAX_RETRY_AFTER:
+                    raise
+
+                log.warning(f'Outbound: {method} hit flood limit, retrying in {timeout} seconds')
+                self.retries += 1
+                # Per chat limits are usually hit by messages, the rest slows down everything
+                (chat_bucket or self.global_bucket).pause(timeout)
+
+    async def _call_unpaced(self, func, method: str, retry: bool):
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return await func()
+            except (RetryAfter, FloodWaitError) as err:
+                timeout = err.timeout if isinstance(err, RetryAfter) else err.seconds
+                if not retry or attempt == MAX_RETRIES or timeout > MAX_RETRY_AFTER:
+                    raise
+
+                # Limits of reads are separate, so only this call waits
+                log.warning(f'Outbound: {method} hit flood limit, retrying in {timeout} seconds')
+                self.retries += 1
+                await asyncio.sleep(timeout)
+
+
+OUTBOUND = OutboundScheduler()
+
+
+class ScheduledBot(Bot):
+    """aiogram Bot which sends every request through the outbound scheduler"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = data.get('chat_id') if data else None
+        coalesce_key = None
+        if method == 'deleteMessage':
+            coalesce_key = (method, chat_id, data.get('message_id'))
+
+        # Files streams can't be sent twice
+        return await OUTBOUND.call(
+            lambda: super(ScheduledBot, self).request(method, data, files, **kwargs),
+            method, chat_id=chat_id, coalesce_key=coalesce_key, retry=not files
+        )
@@ -0,0 +1,82 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    >>> bucket = TokenBucket(rate=30)
+    >>> await bucket.acquire()  # waits till a token is available
+
+    :param rate: tokens added per second
+    :param capacity: max tokens, which is a burst size [optional, equal to rate by default]
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1):
+        # Waiters are served one by one, in order of arrival
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Stops giving tokens for some time, used on Telegram's RetryAfter"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class TokenBuckets:
+    """LRU of token buckets with same rate, one per key (chat id for example)"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, maxsize: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __getitem__(self, key) -> TokenBucket:
+        if (bucket := self._data.get(key)) is None:
+            bucket = self._data[key] = TokenBucket(self.rate, self.capacity)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return bucket
@@ -0,0 +1,47 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from contextlib import contextmanager
+
+from AllMightRobot.utils.logger import log
+
+
+class StartupTimer:
+    """Measures startup phases, the report is logged when the bot starts serving"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self, top: int = 10):
+        total = time.perf_counter() - self.started
+        text = f'Startup took {total:.2f}s, slowest phases:\n'
+        for name, duration in sorted(self.phases, key=lambda x: x[1], reverse=True)[:top]:
+            text += f'  {duration:7.3f}s  {name}\n'
+        log.info(text.rstrip())
+
+
+STARTUP = StartupTimer()
@@ -0,0 +1,69 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextvars import ContextVar
+from typing import Hashable, Optional
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+_CURRENT = ContextVar('update_context', default=None)
+_MISSING = object()
+
+
+class UpdateContext(dict):
+    """Values which were already resolved while handling the current update"""
+
+    def __init__(self):
+        super().__init__()
+        # Background tasks started by handlers inherit the context, they shouldn't use it after the update
+        self.active = True
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        _CURRENT.set(UpdateContext())
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        if (context := _CURRENT.get()) is not None:
+            context.active = False
+
+
+def current_context() -> Optional[UpdateContext]:
+    if (context := _CURRENT.get()) is not None and context.active:
+        return context
+    return None
+
+
+async def memoize(key: Hashable, func, *args, **kwargs):
+    """
+    Awaits func only once per update for the same key, outside of updates just awaits it.
+
+    >>> chat_lang = await memoize(('lang', chat_id), get_chat_lang_from_db, chat_id)
+    """
+    if (context := current_context()) is None:
+        return await func(*args, **kwargs)
+
+    if (value := context.get(key, _MISSING)) is _MISSING:
+        value = context[key] = await func(*args, **kwargs)
+    return value
+
+
+def forget(key: Hashable):
+    """Should be called when the memoized value is changed by the handler"""
+    if (context := current_context()) is not None:
+        context.pop(key, None)
@@ -0,0 +1,297 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import time
+
+import ujson
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import Methods
+from redis.exceptions import RedisError, ResponseError
+
+from AllMightRobot.config import get_int_key, get_str_key
+from AllMightRobot.services.redis import pipeline, redis
+from AllMightRobot.utils.logger import log
+
+# 'single' - polls and handles updates in one process,
+# 'ingest' - only receives updates (polling or webhook) and pushes them to the stream,
+# 'worker' - handles updates of own partitions of the stream
+ROLE = (get_str_key('ROLE') or 'single').lower()
+PARTITIONS = get_int_key('STREAM_PARTITIONS')
+WORKERS = get_int_key('STREAM_WORKERS')
+WORKER_ID = get_int_key('WORKER_ID') or 0
+
+STREAM_KEY = 'updates_stream:{}'
+GROUP = 'workers'
+STREAM_MAXLEN = 100000
+BATCH_SIZE = 100
+BLOCK_MS = 5000
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_KEY = 'updates_stream_worker:{}'
+POLLING_TIMEOUT = 20
+POLLING_LIMIT = 100
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+# Types of updates which have a chat, in order of Update fields
+CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member')
+USER_UPDATES = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'poll_answer')
+
+
+def is_leader() -> bool:
+    """Only one process should run singleton background jobs"""
+    return ROLE == 'single' or (ROLE == 'worker' and WORKER_ID == 0)
+
+
+def get_update_chat_id(data: dict) -> int:
+    for name in CHAT_UPDATES:
+        if name in data:
+            return data[name]['chat']['id']
+
+    if query := data.get('callback_query'):
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+
+    for name in USER_UPDATES:
+        if name in data:
+            return data[name].get('from', data[name].get('user', {})).get('id', 0)
+
+    return 0
+
+
+def get_partition(chat_id: int) -> int:
+    return abs(chat_id) % PARTITIONS
+
+
+def own_partitions(worker_id: int = WORKER_ID, workers: int = WORKERS) -> list:
+    return [p for p in range(PARTITIONS) if p % workers == worker_id]
+
+
+async def push_updates(updates: list):
+    """Appends updates to their partitions in update_id order, in one round trip"""
+    async with pipeline() as pipe:
+        for raw in sorted(updates, key=lambda u: u['update_id']):
+            stream = STREAM_KEY.format(get_partition(get_update_chat_id(raw)))
+            pipe.xadd(stream, {'u': ujson.dumps(raw)}, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+class StreamIngest:
+    """
+    Polls updates and pushes them to the stream. Batches are fetched and appended one by one,
+    so updates of one chat always land in their partition in update_id order.
+    The offset moves only after a batch was appended, failed batches are fetched again.
+    """
+
+    def __init__(self, bot: Bot, allowed_updates: list = None):
+        self.bot = bot
+        self.allowed_updates = allowed_updates
+        self.offset = None
+
+    async def get_updates(self) -> list:
+        payload = {'timeout': POLLING_TIMEOUT, 'limit': POLLING_LIMIT}
+        if self.offset is not None:
+            payload['offset'] = self.offset
+        if self.allowed_updates is not None:
+            payload['allowed_updates'] = ujson.dumps(self.allowed_updates)
+
+        # Raw dicts, so no fields are lost on the way to the stream
+        return await self.bot.request(Methods.GET_UPDATES, payload, timeout=POLLING_TIMEOUT + 2)
+
+    async def run(self):
+        Bot.set_current(self.bot)
+        await self.bot.delete_webhook()
+        log.info('Stream: ingesting updates')
+
+        delay = RETRY_DELAY
+        while True:
+            try:
+                updates = await self.get_updates()
+                if updates:
+                    await push_updates(updates)
+                    self.offset = updates[-1]['update_id'] + 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.error(f'Stream: failed to ingest updates, retrying in {delay}s', exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+            else:
+                delay = RETRY_DELAY
+
+
+class StreamWorker:
+    """
+    Consumes own partitions of the stream. Updates of one chat are handled strictly in order,
+    updates of different chats of a batch are handled concurrently.
+    """
+
+    def __init__(self, dp: Dispatcher, worker_id: int = WORKER_ID, workers: int = WORKERS):
+        self.dp = dp
+        self.worker_id = worker_id
+        self.consumer = f'worker-{worker_id}'
+        self.partitions = own_partitions(worker_id, workers)
+
+        self.started = time.time()
+        self.processed = 0
+        self.errors = 0
+        # Partition: age of the last handled update in seconds
+        self.lag = {}
+
+    async def ensure_group(self, stream: str):
+        try:
+            await redis.xgroup_create(stream, GROUP, id='0', mkstream=True)
+        except ResponseError as err:
+            # Group already exists
+            if 'BUSYGROUP' not in str(err):
+                raise
+
+    async def process_chat(self, updates: list):
+        for update in updates:
+            try:
+                await self.dp.process_update(types.Update(**update))
+            except Exception:
+                self.errors += 1
+                log.error(f"Stream: failed to process update {update.get('update_id')}", exc_info=True)
+            self.processed += 1
+
+    async def process_batch(self, partition: int, entries: list):
+        by_chat = {}
+        for _, fields in entries:
+            update = ujson.loads(fields['u'])
+            by_chat.setdefault(get_update_chat_id(update), []).append(update)
+
+        await asyncio.gather(*[self.process_chat(updates) for updates in by_chat.values()])
+
+        # Entry id starts with the time it was added in milliseconds
+        last_ms = int(entries[-1][0].split('-')[0])
+        self.lag[partition] = max(0.0, time.time() - last_ms / 1000)
+
+    async def consume(self, partition: int):
+        stream = STREAM_KEY.format(partition)
+        last_id = None
+        delay = RETRY_DELAY
+        while True:
+            try:
+                if last_id is None:
+                    # Group is created again if Redis lost it
+                    await self.ensure_group(stream)
+                    # Firstly handle entries which were read but not acknowledged before restart or failure
+                    last_id = '0'
+
+                block = None if last_id == '0' else BLOCK_MS
+                response = await redis.xreadgroup(
+                    GROUP, self.consumer, {stream: last_id}, count=BATCH_SIZE, block=block
+                )
+                delay = RETRY_DELAY
+                entries = response[0][1] if response else []
+                if not entries:
+                    last_id = '>'
+                    self.lag[partition] = 0.0
+                    continue
+
+                await self.process_batch(partition, entries)
+                await redis.xack(stream, GROUP, *[entry_id for entry_id, _ in entries])
+            except (RedisError, ConnectionError):
+                self.errors += 1
+                log.error(f'Stream: partition {partition} failed, retrying in {delay}s', exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                last_id = None
+
+    async def heartbeat(self):
+        while True:
+            try:
+                await redis.set(HEARTBEAT_KEY.format(self.worker_id), ujson.dumps({
+                    'pid': os.getpid(),
+                    'time': time.time(),
+                    'uptime': time.time() - self.started,
+                    'processed': self.processed,
+                    'errors': self.errors,
+                    'partitions': self.partitions,
+                    'lag': max(self.lag.values(), default=0.0)
+                }), ex=HEARTBEAT_INTERVAL * 3)
+            except (RedisError, ConnectionError):
+                log.warning('Stream: failed to send heartbeat', exc_info=True)
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def run(self):
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.dp.bot)
+        log.info(f'Stream: worker {self.worker_id} consumes partitions {self.partitions}')
+        await asyncio.gather(self.heartbeat(), *[self.consume(p) for p in self.partitions])
+
+
+async def get_workers_stats() -> dict:
+    """Alive workers heartbeats and per partition stream lengths and pending entries"""
+    workers = {}
+    for worker_id in range(WORKERS):
+        if data := await redis.get(HEARTBEAT_KEY.format(worker_id)):
+            workers[worker_id] = ujson.loads(data)
+
+    partitions = {}
+    for partition in range(PARTITIONS):
+        stream = STREAM_KEY.format(partition)
+        try:
+            groups = await redis.xinfo_groups(stream)
+        except ResponseError:
+            # Stream wasn't created yet
+            continue
+        group = next((g for g in groups if g['name'] == GROUP), {})
+        partitions[partition] = {
+            'length': await redis.xlen(stream),
+            'pending': group.get('pending', 0),
+            # Entries not yet delivered to the worker, available since Redis 7.0
+            'lag': group.get('lag')
+        }
+
+    return {'workers': workers, 'partitions': partitions}
+
+
+def start_worker(dp: Dispatcher, loop, on_startup=None, on_shutdown=None):
+    """Runs the worker till KeyboardInterrupt, counterpart of executor.start_polling"""
+    if WORKER_ID >= WORKERS:
+        log.critical(f'WORKER_ID must be less than STREAM_WORKERS ({WORKERS})')
+        exit(2)
+
+    worker = StreamWorker(dp)
+
+    if on_startup:
+        loop.run_until_complete(on_startup(dp))
+    try:
+        loop.run_until_complete(worker.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if on_shutdown:
+            loop.run_until_complete(on_shutdown(dp))
+
+
+def start_ingest(dp: Dispatcher, loop, allowed_updates: list = None, on_startup=None, on_shutdown=None):
+    """Polls updates into the stream till KeyboardInterrupt, counterpart of executor.start_polling"""
+    ingest = StreamIngest(dp.bot, allowed_updates)
+
+    if on_startup:
+        loop.run_until_complete(on_startup(dp))
+    try:
+        loop.run_until_complete(ingest.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if on_shutdown:
+            loop.run_until_complete(on_shutdown(dp))
@@ -0,0 +1,195 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hashlib
+import hmac
+
+import ujson
+from aiogram import Bot, Dispatcher, types
+
+from AllMightRobot import ALLOWED_UPDATES
+from AllMightRobot.config import get_str_key, get_int_key
+from AllMightRobot.utils.logger import log
+from AllMightRobot.utils.updates_stream import push_updates
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+def make_secret(token: str) -> str:
+    """Default secret, stable between restarts and unguessable without the bot token"""
+    return hashlib.sha256(f'webhook:{token}'.encode()).hexdigest()[:32]
+
+
+class WebhookApp:
+    """
+    Minimal ASGI application which feeds Telegram updates into the dispatcher.
+
+    Only POST requests to /<secret> are accepted, the response is sent as soon as
+    the update is parsed, processing goes in background with bounded concurrency.
+    With ingest=True updates are pushed to the updates stream instead, see utils/updates_stream.py.
+    """
+
+    def __init__(self, dp: Dispatcher, secret: str, max_concurrency: int = 100, ingest: bool = False):
+        self.dp = dp
+        self.secret = secret
+        self.path = '/' + secret
+        self.max_concurrency = max_concurrency
+        self.ingest = ingest
+        self._semaphore = None
+        self._ingest_lock = None
+        self._tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            return
+
+        if not hmac.compare_digest(scope['path'], self.path):
+            return await self.respond(send, 404)
+        elif scope['method'] != 'POST':
+            return await self.respond(send, 405)
+
+        # Webhook is set with secret_token, so Telegram always sends it in the header
+        headers = dict(scope['headers'])
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, b''), self.secret.encode()):
+            return await self.respond(send, 403)
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        try:
+            data = ujson.loads(body)
+        except ValueError:
+            return await self.respond(send, 400)
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return await self.respond(send, 400)
+
+        if self.ingest:
+            return await self.respond(send, await self.push_update(data))
+
+        update = types.Update(**data)
+
+        # Waiting here slows down Telegram instead of piling up tasks
+        await self.semaphore.acquire()
+        task = asyncio.ensure_future(self.process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        await self.respond(send, 200)
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily to bind to the serving loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def push_update(self, data: dict) -> int:
+        # Created lazily to bind to the serving loop
+        if self._ingest_lock is None:
+            self._ingest_lock = asyncio.Lock()
+
+        # Telegram waits for the response before sending the next update over the single connection,
+        # so appending before responding keeps the update_id order in the stream
+        try:
+            async with self._ingest_lock:
+                await push_updates([data])
+        except Exception:
+            log.error(f"Webhook: failed to push update {data['update_id']}, Telegram will resend it", exc_info=True)
+            return 500
+        return 200
+
+    async def process_update(self, update: types.Update):
+        Dispatcher.set_current(self.dp)
+        Bot.set_current(self.dp.bot)
+        try:
+            await self.dp.process_update(update)
+        except Exception:
+            log.error(f'Webhook: failed to process update {update.update_id}', exc_info=True)
+        finally:
+            self.semaphore.release()
+
+    async def wait_closed(self):
+        """Waits for updates which are still processing"""
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.wait_closed()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def respond(send, status: int):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain')]
+        })
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def start_webhook(dp: Dispatcher, loop, on_startup=None, on_shutdown=None, ingest: bool = False):
+    """Serves webhook with hypercorn till KeyboardInterrupt, counterpart of executor.start_polling"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    secret = get_str_key('WEBHOOK_SECRET') or make_secret(dp.bot._token)
+    app = WebhookApp(dp, secret, max_concurrency=get_int_key('WEBHOOK_MAX_CONCURRENCY'), ingest=ingest)
+
+    config = Config()
+    config.bind = [f"{get_str_key('WEBHOOK_HOST')}:{get_int_key('API_PORT')}"]
+    config.accesslog = None
+
+    async def startup():
+        if on_startup:
+            await on_startup(dp)
+
+        # Without public url updates can still be posted locally, see utils/fake_updates.py
+        if url := get_str_key('WEBHOOK_URL'):
+            await dp.bot.set_webhook(
+                # Updates of parallel connections may come out of order, the stream needs them ordered
+                url.rstrip('/') + app.path, max_connections=1 if ingest else 100, allowed_updates=ALLOWED_UPDATES,
+                secret_token=secret
+            )
+            log.info('Webhook is set')
+
+    async def shutdown():
+        await app.wait_closed()
+        if on_shutdown:
+            await on_shutdown(dp)
+
+    loop.run_until_complete(startup())
+    log.info(f'Serving webhook on {config.bind[0]}')
+    try:
+        # Own shutdown trigger, so hypercorn doesn't override the SIGINT handler of exit_gracefully
+        loop.run_until_complete(serve(app, config, shutdown_trigger=asyncio.Event().wait))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(shutdown())
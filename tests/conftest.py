@@ -0,0 +1,35 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Config and modules list are read by relative paths
+os.chdir(ROOT)
+
+# The package connects to Telegram and the databases on import, so modules are imported without running it
+if 'AllMightRobot' not in sys.modules:
+    package = types.ModuleType('AllMightRobot')
+    package.__path__ = [os.path.join(ROOT, 'AllMightRobot')]
+    sys.modules['AllMightRobot'] = package
+
+    from AllMightRobot.utils.logger import log
+
+    package.log = log
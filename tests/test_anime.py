@@ -0,0 +1,167 @@
+# Copyright (C) 2018 - 2020 MrYacha. All rights reserved. Source code available under the AGPL.
+#
+# This file is part of AllMightRobot.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from AllMightRobot.modules.utils import anime
+from AllMightRobot.services.http import close_session
+
+SEARCH = 'Boku no Hero'
+
+
+def media(title: str) -> dict:
+    return {'Media': {'id': 1, 'title': {'romaji': title}}}
+
+
+class FakeRedis:
+    """In-memory part of Redis used by the AniList cache"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = str(value)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def set(self, *args, **kwargs):
+        self.commands.append((args, kwargs))
+
+    async def execute(self):
+        for args, kwargs in self.commands:
+            await self.redis.set(*args, **kwargs)
+
+
+class StubAniList:
+    """GraphQL endpoint which answers with given (status, data) in turn, the last one is repeated"""
+
+    def __init__(self, responses: list, delay: float = 0):
+        self.responses = responses
+        self.delay = delay
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(await request.json())
+        status, data = self.responses[min(len(self.requests), len(self.responses)) - 1]
+        await asyncio.sleep(self.delay)
+        return web.json_response({'data': data}, status=status)
+
+
+@pytest.fixture(autouse=True)
+def clean_cache(monkeypatch):
+    monkeypatch.setattr(anime, 'redis', FakeRedis())
+    anime.ANILIST_CACHE.clear()
+    anime._ANILIST_INFLIGHT.clear()
+
+
+def run_with_stub(monkeypatch, scenario, responses: list, delay: float = 0):
+    async def main():
+        stub = StubAniList(responses, delay)
+        app = web.Application()
+        app.router.add_post('/', stub.handle)
+        server = TestServer(app)
+        await server.start_server()
+        monkeypatch.setattr(anime, 'ANILIST_URL', str(server.make_url('/')))
+        try:
+            await scenario(stub)
+            # Let background refreshes finish before the server is gone
+            await asyncio.gather(*anime._ANILIST_INFLIGHT.values())
+        finally:
+            await close_session()
+            await server.close()
+
+    asyncio.run(main())
+
+
+def test_concurrent_requests_are_shared(monkeypatch):
+    async def scenario(stub):
+        query, _, variable = anime.ANILIST_KINDS['anime']
+        results = await asyncio.gather(*[anime.anilist(query, {variable: SEARCH}) for _ in range(5)])
+        assert results == [media('A')] * 5
+        assert len(stub.requests) == 1
+
+    run_with_stub(monkeypatch, scenario, [(200, media('A'))], delay=0.1)
+
+
+def test_concurrent_lookups_are_shared(monkeypatch):
+    async def scenario(stub):
+        results = await asyncio.gather(*[anime.anilist_lookup('anime', SEARCH) for _ in range(5)])
+        assert results == [media('A')['Media']] * 5
+        assert len(stub.requests) == 1
+
+    run_with_stub(monkeypatch, scenario, [(200, media('A'))], delay=0.1)
+
+
+def test_cached_lookups_make_no_requests(monkeypatch):
+    async def scenario(stub):
+        assert await anime.anilist_lookup('anime', SEARCH) == media('A')['Media']
+        # Search is normalized
+        assert await anime.anilist_lookup('anime', '  boku NO hero') == media('A')['Media']
+        # Other processes have only the Redis copy
+        anime.ANILIST_CACHE.clear()
+        assert await anime.anilist_lookup('anime', SEARCH) == media('A')['Media']
+        assert len(stub.requests) == 1
+
+    run_with_stub(monkeypatch, scenario, [(200, media('A'))])
+
+
+def test_stale_lookups_are_refreshed_in_background(monkeypatch):
+    monkeypatch.setattr(anime, 'FRESH_TTL', 0)
+
+    async def scenario(stub):
+        assert await anime.anilist_lookup('anime', SEARCH) == media('A')['Media']
+
+        # Stale payload is returned right away, the refresh goes in background
+        assert await anime.anilist_lookup('anime', SEARCH) == media('A')['Media']
+        assert anime._ANILIST_INFLIGHT
+        await asyncio.gather(*anime._ANILIST_INFLIGHT.values())
+        assert len(stub.requests) == 2
+
+        assert await anime.anilist_lookup('anime', SEARCH) == media('B')['Media']
+
+    run_with_stub(monkeypatch, scenario, [(200, media('A')), (200, media('B'))])
+
+
+def test_not_found_is_cached(monkeypatch):
+    async def scenario(stub):
+        assert await anime.anilist_lookup('anime', SEARCH) is None
+        assert await anime.anilist_lookup('anime', SEARCH) is None
+        anime.ANILIST_CACHE.clear()
+        assert await anime.anilist_lookup('anime', SEARCH) is None
+        assert len(stub.requests) == 1
+
+    run_with_stub(monkeypatch, scenario, [(404, {'Media': None})])